@@ -21,6 +21,8 @@ if sys.version_info.major != 2 and sys.version_info.minor != 7:
 
 from .prog import Program
 from .instrument import Instrumentation
+from .selector import Selector
+from .importer import InstrumentationFinder
 from .analysis import ControlFlow
 from .bytecode import BytecodeObject
 from .rewriter import SimpleRewriter
@@ -28,4 +30,5 @@ from .visitors import MethodVisitor,   \
                       ClassVisitor,    \
                       ModuleVisitor,   \
                       BytecodeVisitor, \
-                      BlockVisitor
+                      BlockVisitor,    \
+                      CompositeVisitor
@@ -9,6 +9,7 @@
   :license: Apache 2, see LICENSE for more details.
 """
 
+from ..bytecode.utils import get_code_object_bytecode
 from .ast import Statement
 
 class BasicBlock(object):
@@ -78,16 +79,9 @@ class BasicBlock(object):
       if self.kind in (BasicBlock.ENTRY, BasicBlock.IMPLICIT_RETURN):
         self._bytecode = []
       else:
-        bc = self.decl.bytecode
-        start_index = [j for j in range(len(bc)) if bc[j][0] == 0][0]
-        prev_co = bc[start_index][5]
-        slice_bytecode = [tpl for tpl in bc[start_index:] if tpl[5] == prev_co]
-        bc = []
-        for l in slice_bytecode:
-          idx = l[0]
-          if idx >= self._index and idx < self._index + self._length:
-            bc.append(l)
-        self._bytecode = bc
+        self._bytecode = get_code_object_bytecode(self.decl.bytecode,
+                                                  self._index,
+                                                  self._index + self._length)
     return self._bytecode
 
   @property
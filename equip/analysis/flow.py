@@ -9,11 +9,12 @@
   :license: Apache 2, see LICENSE for more details.
 """
 import opcode
+import logging
 from operator import itemgetter, attrgetter
 from itertools import tee, izip
 from ..utils.log import logger
 from ..utils.structures import intervalmap
-from ..bytecode.utils import show_bytecode
+from ..bytecode.utils import show_bytecode, get_code_object_bytecode
 
 from .graph import DiGraph, Edge, Node, Walker, EdgeVisitor, Tree, TreeNode
 from .graph import DominatorTree, ControlDependence
@@ -430,14 +431,11 @@ class ControlFlow(object):
     """
     blocks = set()
     block_map = {} # bytecode index -> block
-    logger.debug("CFG:\n%s", show_bytecode(bytecode))
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug("CFG:\n%s", show_bytecode(bytecode))
 
-    i, length = 0, len(bytecode)
-    start_index = [j for j in range(length) if bytecode[j][0] == 0][0]
-    prev_co = bytecode[start_index][5]
     prev_op = None
-
-    slice_bytecode = [tpl for tpl in bytecode[start_index:] if tpl[5] == prev_co]
+    slice_bytecode = get_code_object_bytecode(bytecode)
 
     slice_length = len(slice_bytecode)
     known_targets = ControlFlow.find_targets(slice_bytecode)
@@ -11,6 +11,7 @@
 """
 
 from .code import BytecodeObject
+from .compact import CompactBytecode, BytecodeView
 from .decl import Declaration, \
                   ImportDeclaration, \
                   ModuleDeclaration, \
@@ -10,6 +10,7 @@
 """
 import dis
 import opcode
+import logging
 import marshal
 import time
 import struct
@@ -17,11 +18,13 @@ import types
 import operator
 import traceback
 import imp
-from dis import findlinestarts, findlabels
+from dis import findlinestarts
 
 from ..utils.log import logger
+from ..utils.structures import lrucache
 
-from .utils import show_bytecode
+from .utils import show_bytecode, replace_nested_code_objects
+from .compact import CompactBytecode
 from .decl import ModuleDeclaration, \
                   TypeDeclaration,   \
                   MethodDeclaration, \
@@ -31,7 +34,8 @@ from ..visitors import BytecodeVisitor, \
                        ClassVisitor,    \
                        MethodVisitor,   \
                        ModuleVisitor,   \
-                       BlockVisitor
+                       BlockVisitor,    \
+                       CompositeVisitor
 
 from ..analysis.python.opcodes import *
 
@@ -52,6 +56,14 @@ CO_FUTURE_ABSOLUTE_IMPORT = 0x4000
 CO_FUTURE_WITH_STATEMENT  = 0x8000
 
 
+#: Version of the serialized declarations. See ``BytecodeObject.dump_declarations``.
+DECLARATIONS_FORMAT = 1
+
+#: Decoded bytecode of the code objects, keyed by ``(id(code_object), recursive)``.
+#: See ``BytecodeObject.get_parsed_code``.
+PARSED_CODE_CACHE = lrucache(maxsize=256)
+
+
 class BytecodeObject(object):
   """
     This class parses the bytecode from a file and constructs the representation from it.
@@ -62,23 +74,36 @@ class BytecodeObject(object):
     * Construction of nested declarations, and hierarchy of declaration types.
   """
 
-  def __init__(self, pyc_file, lazy_load=True):
+  def __init__(self, pyc_file, lazy_load=True, lazy_decode=False, cache=None):
     """
       Builds the representation of the bytecode, as well as the nested ``Declaration``
       structures based on the bytecode contained in the binary file.
 
       :param pyc_file: The compiled python file that contains the bytecode.
+      :param lazy_load: Whether to wait for the first visitor before parsing the file.
+      :param lazy_decode: When ``True``, the declarations are built from the nesting of
+                          the code objects (``co_consts``), and the bytecode of each
+                          declaration is only decoded when it is accessed. Defaults
+                          to ``False``.
+      :param cache: An ``InstrumentationCache`` where the declarations are persisted,
+                    keyed by the content of the pyc file. When they are found in the
+                    cache, the tree of declarations is loaded from it and the bytecode
+                    is decoded on demand, like in the ``lazy_decode`` mode.
     """
     self.code = None
     self.magic = None
     self.moddate = None
     self.modif_date = None
     self.pyc_file = pyc_file
-    if not lazy_load:
-      self.parse()
+    self.lazy_decode = lazy_decode
+    self.cache = cache
     self.main_module = None
-    self.bytecode = []
+    self._bytecode = []
     self.all_decls = set()
+    self.reset_index()
+    self.reset_staging()
+    if not lazy_load:
+      self.parse()
 
 
   def parse(self):
@@ -86,12 +111,133 @@ class BytecodeObject(object):
       Parses the binary file (pyc) and extract the bytecode out of it. Keeps the magic number
       as well as the timestamp for serialization.
     """
-    fd = open(self.pyc_file, 'rb')
-    self.magic = fd.read(4)
-    self.moddate = fd.read(4)
+    if self.cache is None:
+      self.parse_code(self.read())
+      return
+
+    with open(self.pyc_file, 'rb') as fd:
+      content = fd.read()
+    code_object = self.read(content)
+    key = self.cache.make_declarations_key(content)
+    data = self.cache.get_entry(key)
+    if data is not None and self.load_declarations(code_object, data):
+      return
+
+    self.parse_code(code_object)
+    if self.main_module is not None:
+      try:
+        self.cache.write_entry(key, self.dump_declarations())
+      except (IOError, OSError), ex:
+        logger.error("Cannot store the declarations of %s in the cache: %s", self.pyc_file, ex)
+
+
+  def read(self, content=None):
+    """
+      Reads the header and the code object of the binary file (pyc), without parsing
+      the code object. Returns the code object.
+
+      :param content: The content of the pyc file, if it was already read.
+    """
+    if content is None:
+      with open(self.pyc_file, 'rb') as fd:
+        content = fd.read()
+    self.magic = content[:4]
+    self.moddate = content[4:8]
     self.modif_date = long(struct.unpack('<l', self.moddate)[0])
-    co = marshal.load(fd)
-    self.parse_code(co)
+    return marshal.loads(content[8:])
+
+
+  def dump_declarations(self):
+    """
+      Serializes (with ``marshal``) the tree of declarations, with the imports, the
+      superclasses and the formal parameters. The code objects are referenced by the
+      path of indices in the ``co_consts`` that leads to them from the module.
+    """
+    # id(code object) -> path of co_consts indices
+    paths = {id(self.code): ()}
+    worklist = [self.code]
+    while worklist:
+      co = worklist.pop()
+      for i, const in enumerate(co.co_consts):
+        if isinstance(const, types.CodeType) and id(const) not in paths:
+          paths[id(const)] = paths[id(co)] + (i,)
+          worklist.append(const)
+
+    imports = [(imp_stmt.root, list(imp_stmt.aliases), imp_stmt.dots, imp_stmt.star) \
+               for imp_stmt in self.main_module.imports]
+
+    decls = []
+    positions = {id(self.main_module): -1}
+    worklist = list(self.main_module.children)
+    while worklist:
+      decl = worklist.pop(0)
+      if decl.is_type():
+        details = (decl.type_name, tuple(sorted(decl.superclasses)))
+      else:
+        details = (decl.method_name, tuple(getattr(decl, 'formal_params', ())))
+      positions[id(decl)] = len(decls)
+      decls.append((paths[id(decl.code_object)], decl.kind, details, tuple(decl.lines),
+                    positions[id(decl.parent)]))
+      worklist.extend(decl.children)
+
+    return marshal.dumps((DECLARATIONS_FORMAT, tuple(self.main_module.lines), imports, decls))
+
+
+  def load_declarations(self, code_object, data):
+    """
+      Builds the tree of declarations of ``code_object`` from its serialized form (see
+      ``dump_declarations``), without decoding the bytecode. The bytecode is then
+      decoded on demand, like in the ``lazy_decode`` mode. Returns ``False`` if the
+      data cannot be loaded.
+
+      :param code_object: The code object of the module.
+      :param data: The serialized declarations.
+    """
+    try:
+      version, module_lines, imports, decl_entries = marshal.loads(data)
+    except (EOFError, ValueError, TypeError):
+      return False
+    if version != DECLARATIONS_FORMAT:
+      return False
+
+    self.code = code_object
+    self.lazy_decode = True
+    self.bytecode = None
+    self.all_decls = set()
+    self.reset_index()
+
+    self.main_module = ModuleDeclaration(self.pyc_file, code_object)
+    self.main_module.bytecode = None
+    self.main_module.lines = module_lines
+    self.add_decl(self.main_module)
+    for root, aliases, dots, star in imports:
+      imp_stmt = ImportDeclaration(code_object)
+      imp_stmt.root = root
+      imp_stmt.aliases = aliases
+      imp_stmt.dots = dots
+      imp_stmt.star = star
+      self.main_module.add_import(imp_stmt)
+
+    decls = []
+    for path, kind, details, lines, parent_position in decl_entries:
+      co = code_object
+      for i in path:
+        co = co.co_consts[i]
+      if kind == TypeDeclaration.TYPE:
+        decl = TypeDeclaration(details[0], co)
+        decl.superclasses = set(details[1])
+      else:
+        decl = MethodDeclaration(details[0], co)
+        decl.formal_params = details[1]
+      decl.bytecode = None
+      decl.lines = lines
+      self.add_decl(decl)
+      decls.append(decl)
+      decl.parent = decls[parent_position] if parent_position >= 0 else self.main_module
+
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug('\n' + BytecodeObject.build_tree(self.main_module))
+    return True
 
 
   def parse_code(self, co):
@@ -102,12 +248,50 @@ class BytecodeObject(object):
     self.bytecode = []
 
     try:
-      self.load_bytecode(self.code)
-      self.build_representation()
+      if self.lazy_decode:
+        self.bytecode = None
+        self.build_lazy_representation()
+      else:
+        self.load_bytecode(self.code)
+        self.build_representation()
     except Exception, ex:
       logger.error("parse error: %s", repr(ex), exc_info=ex)
 
 
+  @property
+  def bytecode(self):
+    """
+      The bytecode of the module (including the nested code objects). In the
+      ``lazy_decode`` mode, it is decoded on the first access.
+    """
+    if self._bytecode is None:
+      self._bytecode = []
+      if self.code is not None:
+        self.load_bytecode(self.code)
+    return self._bytecode
+
+  @bytecode.setter
+  def bytecode(self, value):
+    self._bytecode = value
+
+
+  def release(self):
+    """
+      Drops the representation of the bytecode (declarations, expanded bytecode and
+      code objects). The links between the declarations are cut so that the memory is
+      reclaimed right away instead of waiting for the cycle collector.
+    """
+    for decl in self.all_decls:
+      BytecodeObject.invalidate_parsed_code(decl.code_object)
+      decl.release()
+    self.all_decls = set()
+    self.reset_index()
+    self.reset_staging()
+    self.main_module = None
+    self.bytecode = []
+    self.code = None
+
+
   def get_module(self):
     """
       Returns the ModuleDeclaration associated with the current bytecode.
@@ -133,24 +317,30 @@ class BytecodeObject(object):
   @property
   def has_changes(self):
     """
-      Returns `True` if any change was performed on the module. This is used
-      to know if we need to rewrite or not a pyc file.
+      Returns `True` if any change was performed on the module, including the
+      changes staged but not committed yet. This is used to know if we need to
+      rewrite or not a pyc file.
     """
-    return self.main_module.has_changes
+    return bool(self._staged) or self.main_module.has_changes
 
 
   def accept(self, visitor):
     """
       Runs the visitor over the nested declarations found in the this module, or
-      the entire bytecode if it's a `BytecodeVisitor`.
+      the entire bytecode if it's a `BytecodeVisitor`. A list of visitors, or a
+      `CompositeVisitor`, is run in a single traversal.
     """
     if not self.code:
       self.parse()
 
-    if isinstance(visitor, BytecodeVisitor):
-      for i in xrange(len(self.bytecode)):
-        index, lineno, op, arg, cflow_in, _ = self.bytecode[i]
-        visitor.visit(index, op, arg=arg, lineno=lineno, cflow_in=cflow_in)
+    if isinstance(visitor, (list, tuple)):
+      visitor = CompositeVisitor(visitor)
+
+    if isinstance(visitor, CompositeVisitor):
+      self.__composite_visitor_run(visitor)
+
+    elif isinstance(visitor, BytecodeVisitor):
+      self.__visit_bytecode([visitor])
 
     elif isinstance(visitor, ModuleVisitor):
       visitor.visit(self.main_module)
@@ -184,6 +374,91 @@ class BytecodeObject(object):
         visitor.visit(block)
 
 
+  def __visit_bytecode(self, visitors):
+    """
+      Calls the bytecode visitors on each instruction. When the visitors use the
+      default dispatch, only the instructions they handle are read.
+    """
+    bytecode = self.bytecode
+    default_dispatch = all(type(v).visit.im_func is BytecodeVisitor.visit.im_func \
+                           for v in visitors)
+    if default_dispatch and isinstance(bytecode, CompactBytecode):
+      tables = [v.get_instance_handlers() for v in visitors]
+      handled = [any(table[op] is not None for table in tables) for op in xrange(256)]
+      get_instruction = bytecode.get
+      for i, op in enumerate(bytecode.opcodes):
+        if not handled[op]:
+          continue
+        index, lineno, op, arg, cflow_in, _ = get_instruction(i)
+        for visitor in visitors:
+          visitor.visit(index, op, arg=arg, lineno=lineno, cflow_in=cflow_in)
+      return
+
+    for index, lineno, op, arg, cflow_in, _ in bytecode:
+      for visitor in visitors:
+        visitor.visit(index, op, arg=arg, lineno=lineno, cflow_in=cflow_in)
+
+
+  def __composite_visitor_run(self, composite):
+    """
+      Runs all the visitors of the ``composite`` in one traversal. The bytecode is
+      iterated once for all the bytecode visitors, then each declaration selected
+      by the ``selector`` of the composite is handed to the matching visitors, and
+      its CFG is built at most once.
+    """
+    from ..analysis import ControlFlow
+
+    logger.debug("Execute composite visitor on: %s, main_module=%s", composite, self.main_module)
+
+    if composite.bytecode_visitors:
+      self.__visit_bytecode(composite.bytecode_visitors)
+
+    for visitor in composite.module_visitors:
+      visitor.visit(self.main_module)
+
+    if not self.main_module:
+      logger.debug("No main_module")
+      return
+
+    decl_visitors = [v for v in composite.visitors \
+                     if not isinstance(v, (BytecodeVisitor, ModuleVisitor))]
+    if not decl_visitors:
+      return
+
+    selector = composite.selector
+
+    def visit_decl(decl):
+      if selector is not None and not selector.matches(decl):
+        return
+      cflow = None
+      for visitor in decl_visitors:
+        if isinstance(visitor, BlockVisitor):
+          if cflow is None:
+            cflow = ControlFlow(decl)
+          visitor.control_flow = cflow
+          visitor.new_control_flow()
+          for block in cflow.blocks:
+            visitor.visit(block)
+        elif isinstance(visitor, ClassVisitor):
+          if isinstance(decl, TypeDeclaration):
+            visitor.visit(decl)
+        elif isinstance(decl, MethodDeclaration):
+          visitor.visit(decl)
+
+    visit_decl(self.main_module)
+    cache = set()
+    stack = [self.main_module]
+    while stack:
+      current = stack.pop(0)
+      for child in current.children:
+        if not child:
+          continue
+        if child not in cache:
+          visit_decl(child)
+          cache.add(child)
+        stack.insert(0, child)
+
+
   def __depth_visitor_run(self, visitor):
     """
       Needs to traverse the entire tree structure of declaration objects, to execute
@@ -249,14 +524,19 @@ class BytecodeObject(object):
     rewriter.insert_exit_code(python_code, import_code)
 
 
-  def write(self):
+  def write(self, output_file=None):
     """
       Persists the changes in the bytecode. This overwrites the current file that
       contains the bytecode with the new bytecode while preserving the timestamp.
+      The staged changes are committed first.
 
       Note that the magic number if changed to be the one from the current Python
       version that runs the instrumentation process.
+
+      :param output_file: The path of the file to write the bytecode to. Defaults to
+                          the file the bytecode was read from.
     """
+    self.commit()
     if not self.has_changes:
       logger.debug("Skip writing %s, no changes detected.", self.main_module.module_path)
       return
@@ -271,7 +551,9 @@ class BytecodeObject(object):
         timestamp = long(os.stat(source_file).st_mtime)
       except:
         pass
-      fd = open(self.main_module.module_path, 'wb')
+      if output_file is None:
+        output_file = self.main_module.module_path
+      fd = open(output_file, 'wb')
       fd.write('\0\0\0\0') # Magic placeholder
       fd.write(struct.pack('<l', timestamp))
       marshal.dump(new_co, fd)
@@ -279,7 +561,7 @@ class BytecodeObject(object):
       fd.seek(0, 0)
       fd.write(imp.get_magic())
       fd.close()
-      logger.debug("Wrote file %s", self.main_module.module_path)
+      logger.debug("Wrote file %s", output_file)
       return True
     except Exception, ex:
       logger.error("Exception- %s", str(ex))
@@ -308,31 +590,32 @@ class BytecodeObject(object):
 
     decl_counter = 0
     self.all_decls = set()
+    self.reset_index()
     decl_map = {}
 
     # logger.debug("Bytecode:\n%s", show_bytecode(self.bytecode))
 
-    class_decl_indices, method_decl_indices = BytecodeObject.find_classes_methods(self.bytecode)
+    class_decl_indices, method_decl_indices, end_lines, max_lineno = \
+        BytecodeObject.find_declaration_spans(self.bytecode)
     interest_indices = class_decl_indices.union(method_decl_indices)
 
     current_co = self.bytecode[0][5]
     self.main_module = ModuleDeclaration(self.pyc_file, current_co)
     self.main_module.bytecode = self.bytecode
-    self.main_module.bytecode_object = self
 
-    module_lines = (1, max([self.bytecode[i][1] for i in xrange(len(self.bytecode))]), decl_counter)
+    module_lines = (1, max_lineno, decl_counter)
     self.main_module.lines = module_lines
     BytecodeObject.parse_imports(self.main_module, self.bytecode)
     decl_map[module_lines] = self.main_module
     decl_counter += 1
 
-    self.all_decls.add(self.main_module)
+    self.add_decl(self.main_module)
 
     for tpl_indices in interest_indices:
       decl = None
       start_index, end_index = tpl_indices
       index, lineno, op, arg, _, co = self.bytecode[start_index]
-      end_lineno = max([self.bytecode[i][1] for i in xrange(start_index, min(end_index + 1, len(self.bytecode)))])
+      end_lineno = end_lines[tpl_indices]
       decl_co = BytecodeObject.next_code_object(self.bytecode, start_index)
 
       lines_tuple = (lineno, end_lineno, decl_counter)
@@ -350,36 +633,46 @@ class BytecodeObject(object):
       decl.bytecode = self.bytecode[start_index:end_index]
       decl.lines = lines_tuple[:2]
 
-      self.all_decls.add(decl)
+      self.add_decl(decl)
       decl_map[lines_tuple] = decl
       decl_counter += 1
 
 
-    co_deps_graph = {
-      self.main_module.code_object : {}
-    }
+    # (id(parent code object), id(nested code object)) already linked. The code
+    # objects are not hashed as their hash covers all the nested code objects.
+    co_deps = set()
 
     i, length = 0, len(self.bytecode)
     while i < length:
       op, arg, co = self.bytecode[i][2], self.bytecode[i][3], self.bytecode[i][5]
       if op == LOAD_CONST and isinstance(arg, types.CodeType):
-        if co not in co_deps_graph:
-          co_deps_graph[co] = dict()
-        if arg not in co_deps_graph[co]:
-          co_deps_graph[co][arg] = dict()
+        dep = (id(co), id(arg))
+        if dep not in co_deps:
+          co_deps.add(dep)
 
           decl_parent = self.get_decl(code_object=co)
           decl_child = self.get_decl(code_object=arg)
           decl_child.parent = decl_parent
       i += 1
 
-    logger.debug('\n' + BytecodeObject.build_tree(self.main_module))
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug('\n' + BytecodeObject.build_tree(self.main_module))
 
 
   def __build_inheritance(self, type_decl, start_index, end_index):
-    i = start_index - 1
+    BytecodeObject.find_superclasses(type_decl, self.bytecode, start_index - 1)
+
+
+  @staticmethod
+  def find_superclasses(type_decl, bytecode, class_index):
+    """
+      Adds the superclasses of ``type_decl`` by walking back the bytecode from
+      ``class_index`` (the ``LOAD_CONST`` of its code object) up to the ``LOAD_CONST``
+      of its name.
+    """
+    i = class_index
     while i >= 0:
-      index, lineno, op, arg, _, co = self.bytecode[i]
+      index, lineno, op, arg, _, co = bytecode[i]
       if op == LOAD_CONST and arg == type_decl.type_name:
         break
       if op != LOAD_NAME:
@@ -390,37 +683,267 @@ class BytecodeObject(object):
       i -= 1
 
 
+  def build_lazy_representation(self):
+    """
+      Builds the tree of declarations from the nesting of the code objects, without
+      decoding their bytecode. The code objects of the class bodies are the ones
+      returning their locals (``LOAD_LOCALS``), the other ones are methods. The
+      bytecode, the superclasses and the imports are loaded on demand (see
+      ``load_decl_bytecode``, ``load_superclasses`` and ``load_imports``).
+
+      The result is the same tree as the one of ``build_representation``.
+    """
+    self.all_decls = set()
+    self.reset_index()
+
+    nodes, lines = BytecodeObject.get_code_object_tree(self.code)
+
+    self.main_module = ModuleDeclaration(self.pyc_file, self.code)
+    self.main_module.bytecode = None
+    self.main_module.lines = (1, lines[id(self.code)][1], 0)
+    self.add_decl(self.main_module)
+
+    decls = {id(self.code): self.main_module}
+    for co, parent_co in nodes[1:]:
+      if BytecodeObject.is_class_code_object(co):
+        decl = TypeDeclaration(co.co_name, co)
+      else:
+        decl = MethodDeclaration(co.co_name, co)
+        decl.formal_params = BytecodeObject.get_formal_params(co)
+      decl.bytecode = None
+      decl.lines = tuple(lines[id(co)])
+      self.add_decl(decl)
+      decls[id(co)] = decl
+      decl.parent = decls[id(parent_co)]
+
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug('\n' + BytecodeObject.build_tree(self.main_module))
+
+
+  @staticmethod
+  def get_code_object_tree(code_object):
+    """
+      Walks the code objects nested in ``code_object`` (through ``co_consts``) without
+      decoding them. Returns the list of ``(code object, parent code object)``, parents
+      first, and the lines of each code object as a dict ``id(code object) -> [first
+      lineno, max lineno]``, where the max line includes the nested code objects.
+    """
+    nodes = []
+    seen = set()
+    stack = [(code_object, None)]
+    while stack:
+      co, parent_co = stack.pop()
+      if id(co) in seen:
+        continue
+      seen.add(id(co))
+      nodes.append((co, parent_co))
+      nested = [c for c in co.co_consts if isinstance(c, types.CodeType)]
+      for nested_co in reversed(nested):
+        stack.append((nested_co, co))
+
+    lines = {}
+    for co, _ in nodes:
+      linestarts = list(findlinestarts(co))
+      lines[id(co)] = [linestarts[0][1], max([l for _, l in linestarts])]
+    for co, parent_co in reversed(nodes):
+      if parent_co is not None:
+        parent_lines = lines[id(parent_co)]
+        parent_lines[1] = max(parent_lines[1], lines[id(co)][1])
+    return nodes, lines
+
+
+  @staticmethod
+  def is_class_code_object(code_object):
+    """
+      Returns ``True`` if the ``code_object`` is the body of a class.
+    """
+    return not (code_object.co_flags & CO_OPTIMIZED) \
+           and code_object.co_code[-2:] == chr(LOAD_LOCALS) + chr(RETURN_VALUE)
+
+
+  def load_decl_bytecode(self, decl):
+    """
+      Decodes the bytecode of ``decl``. Like in ``build_representation``, it contains
+      the bytecode of the nested code objects, but not the last instruction of the
+      declaration (except for the module).
+    """
+    if decl is self.main_module:
+      return self.bytecode
+    return BytecodeObject.get_parsed_code(decl.code_object)[:-1]
+
+
+  def load_superclasses(self, type_decl):
+    """
+      Finds the superclasses of ``type_decl`` in the bytecode of its parent.
+    """
+    if type_decl.parent is None:
+      return
+    bytecode = BytecodeObject.get_parsed_code(type_decl.parent.code_object, recursive=False)
+    for i in xrange(len(bytecode)):
+      if bytecode[i][2] == LOAD_CONST and bytecode[i][3] is type_decl.code_object:
+        BytecodeObject.find_superclasses(type_decl, bytecode, i)
+        return
+
+
+  def load_imports(self, module_decl):
+    """
+      Finds the import statements of the module.
+    """
+    BytecodeObject.parse_imports(module_decl, self.bytecode)
+
+
+  def reset_index(self):
+    # id(code object) -> decl, method name -> [decls], type name -> [decls]
+    self._decls_by_co = {}
+    self._decls_by_method_name = {}
+    self._decls_by_type_name = {}
+
+
+  def add_decl(self, decl):
+    """
+      Registers the declaration in this ``BytecodeObject`` and in the indices
+      used by ``get_decl``.
+
+      :param decl: The ``Declaration`` to add.
+    """
+    self.all_decls.add(decl)
+    decl.bytecode_object = self
+    self._decls_by_co[id(decl.code_object)] = decl
+    if isinstance(decl, MethodDeclaration):
+      self._decls_by_method_name.setdefault(decl.method_name, []).append(decl)
+    elif isinstance(decl, TypeDeclaration):
+      self._decls_by_type_name.setdefault(decl.type_name, []).append(decl)
+
+
+  def reindex_decl(self, decl, original_co):
+    """
+      Updates the code object index after the code object of ``decl`` was replaced
+      (e.g., by the rewriter).
+
+      :param decl: The ``Declaration`` that changed.
+      :param original_co: The code object that was previously associated with ``decl``.
+    """
+    if self._decls_by_co.get(id(original_co)) is decl:
+      del self._decls_by_co[id(original_co)]
+    self._decls_by_co[id(decl.code_object)] = decl
+
+
+  def reset_staging(self):
+    # id(parent decl) -> (depth, parent decl, {id(nested code object): decl})
+    self._staged = {}
+    self._global_names = None
+
+
+  def replace_code_object(self, decl, new_co):
+    """
+      Replaces the code object of ``decl`` by ``new_co``. The code objects of the
+      parents, which nest the one of ``decl`` in their ``co_consts``, are not rebuilt
+      right away: the replacement is staged, and all the parents are rebuilt once by
+      ``commit``.
+
+      :param decl: The ``Declaration`` that changed.
+      :param new_co: Its new code object.
+    """
+    self.get_global_names()
+    self._global_names.update(BytecodeObject.get_global_names_of(new_co))
+    self.__stage_code_object(decl, new_co)
+
+
+  def __stage_code_object(self, decl, new_co):
+    original_co = decl.code_object
+    decl.code_object = new_co
+    decl.has_changes = True
+    BytecodeObject.invalidate_parsed_code(original_co)
+
+    parent = decl.parent
+    if parent is None:
+      return
+    # The decoded bytecode of the parent contains the previous nested code
+    BytecodeObject.invalidate_parsed_code(parent.code_object)
+    staged = self._staged.get(id(parent))
+    if staged is None:
+      depth = 0
+      ancestor = parent.parent
+      while ancestor is not None:
+        depth += 1
+        ancestor = ancestor.parent
+      staged = self._staged[id(parent)] = (depth, parent, {})
+    # Keep the code object the parent contains, if ``decl`` is replaced again
+    staged[2].setdefault(id(original_co), (original_co, decl))
+
+
+  def commit(self):
+    """
+      Rebuilds the code objects of the parents of the declarations that were replaced
+      (see ``replace_code_object``), from the deepest to the module. Each parent is
+      rebuilt once, regardless of the number of its nested code objects that changed.
+    """
+    while self._staged:
+      depth = max(staged[0] for staged in self._staged.itervalues())
+      for key, (parent_depth, parent, nested) in self._staged.items():
+        if parent_depth != depth:
+          continue
+        del self._staged[key]
+        replacements = dict((co_id, decl.code_object) \
+                            for co_id, (_, decl) in nested.iteritems())
+        self.__stage_code_object(parent,
+                                 replace_nested_code_objects(parent.code_object, replacements))
+
+
+  def get_global_names(self):
+    """
+      Returns the set of the global names loaded (``LOAD_GLOBAL``) in the code objects
+      of the module. It is kept up to date when the code objects are replaced.
+    """
+    if self._global_names is None:
+      self._global_names = set()
+      if self.main_module is not None:
+        # Decode each code object on its own, so the ones that did not change since
+        # a previous insertion are found in the decoding cache.
+        worklist = [self.main_module.code_object]
+        while worklist:
+          code_object = worklist.pop()
+          self._global_names.update(BytecodeObject.get_global_names_of(code_object))
+          worklist.extend(c for c in code_object.co_consts if isinstance(c, types.CodeType))
+    return self._global_names
+
+
+  @staticmethod
+  def get_global_names_of(code_object):
+    return set(bc_tpl[3] for bc_tpl in BytecodeObject.get_parsed_code(code_object, recursive=False) \
+               if bc_tpl[2] == LOAD_GLOBAL)
+
+
   def get_decl(self, code_object=None, method_name=None, type_name=None):
     """
       Returns the declaration associated to the code_object ``co``, or supplied
       name.
 
-      Warning: This is only valid until the rewriter is called on the declarations.
+      The code objects are looked up by identity first. The index is kept up to
+      date when the rewriter replaces the code object of a declaration.
 
       :param code_object: Python code object type
       :param method_name: Name of the method.
       :param type_name: Name of the type.
     """
     if code_object is not None:
+      decl = self._decls_by_co.get(id(code_object))
+      if decl is not None and decl.code_object is code_object:
+        return decl
+      # Not one of our code objects, fallback on the equality
       for decl in self.declarations:
         if decl.code_object == code_object:
           return decl
     elif method_name is not None:
-      results = []
-      for decl in self.declarations:
-        if isinstance(decl, MethodDeclaration) and decl.method_name == method_name:
-          results.append(decl)
+      results = self._decls_by_method_name.get(method_name)
       if not results:
         return None
-      return results[0] if len(results) == 1 else results
+      return results[0] if len(results) == 1 else list(results)
     elif type_name is not None:
-      results = []
-      for decl in self.declarations:
-        if isinstance(decl, TypeDeclaration) and decl.type_name == type_name:
-          results.append(decl)
+      results = self._decls_by_type_name.get(type_name)
       if not results:
         return None
-      return results[0] if len(results) == 1 else results
+      return results[0] if len(results) == 1 else list(results)
     return None
 
 
@@ -470,57 +993,81 @@ class BytecodeObject(object):
       by matching code_object of the declaration and the ``MAKE_FUNCTION`` or ``BUILD_CLASS``
       opcode.
     """
+    class_indices, method_indices, _, _ = BytecodeObject.find_declaration_spans(bytecode)
+    return class_indices, method_indices
+
+
+  @staticmethod
+  def find_declaration_spans(bytecode):
+    """
+      Single pass over the bytecode that finds the classes and methods declared in it
+      (see ``find_classes_methods``). Returns a tuple with:
+
+      * the set of ``(start, end)`` indices of the classes
+      * the set of ``(start, end)`` indices of the methods
+      * a dict ``(start, end) -> end_lineno`` for these declarations, where the end line
+        number accounts for the nested declarations
+      * the max line number of the whole bytecode
+    """
     class_indices = set()
     method_indices = set()
-    class_lines = set()
-    method_lines = set()
 
-    # code object -> (start, end)
-    co_lines = {}
-    classes_co = set()
-    methods_co = set()
+    # id(code object) -> [first index, last index, max lineno, parent id]
+    co_spans = {}
+    # ids of the code objects, in order of first appearance
+    co_order = []
+    classes_co = {}
+    methods_co = {}
 
     i, length = 0, len(bytecode)
     while i < length:
       tpl = bytecode[i]
       lineno, op_code, co = tpl[1], tpl[2], tpl[5]
+
+      key = id(co)
+      span = co_spans.get(key)
+      if span is None:
+        # Nested code objects are expanded right after their LOAD_CONST
+        parent_key = id(bytecode[i - 1][5]) if i > 0 else None
+        co_spans[key] = [i, i, lineno, parent_key]
+        co_order.append(key)
+      else:
+        span[1] = i
+        if lineno > span[2]:
+          span[2] = lineno
+
       if op_code == BUILD_CLASS:
         class_co = bytecode[i - 3][5]
-        co_lines[class_co] = lineno
-        classes_co.add(class_co)
-        class_lines.add(lineno)
+        classes_co[id(class_co)] = class_co
       elif op_code in (MAKE_FUNCTION, MAKE_CLOSURE):
         if i < length - 3 and bytecode[i + 1][2] == CALL_FUNCTION and bytecode[i + 2][2] == BUILD_CLASS:
           i += 1
           continue
         prev_co = bytecode[i - 1][5]
-        method_lines.add(lineno)
-        methods_co.add(prev_co)
-        co_lines[prev_co] = lineno
+        methods_co[id(prev_co)] = prev_co
       i += 1
 
-    # This multi-pass should be refactored...
-    for decl_co in co_lines:
-      if decl_co not in methods_co and decl_co not in classes_co:
-        continue
-      dest_set = method_indices if decl_co in methods_co else class_indices
-      i, length = 0, len(bytecode)
-      start_index, end_index = 0, 0
-      while i < length:
-        co = bytecode[i][5]
-        if co == decl_co:
-          start_index = i
-          j = i + 1
-          while j < length:
-            if bytecode[j][5] == decl_co:
-              end_index = j
-            j += 1
-          break
-        i += 1
-      # logger.debug("decl_co(%d, %d) := %s", start_index, end_index, decl_co)
+    # Propagate the line numbers of the nested code objects to their parents;
+    # children always appear after their parents.
+    for key in reversed(co_order):
+      span = co_spans[key]
+      parent_key = span[3]
+      if parent_key is not None and parent_key in co_spans:
+        parent_span = co_spans[parent_key]
+        if span[2] > parent_span[2]:
+          parent_span[2] = span[2]
+
+    end_lines = {}
+    for key in set(classes_co.keys()) | set(methods_co.keys()):
+      dest_set = method_indices if key in methods_co else class_indices
+      start_index, end_index, end_lineno, _ = co_spans[key]
+      if end_index == start_index:
+        end_index = 0
       dest_set.add((start_index, end_index))
+      end_lines[(start_index, end_index)] = end_lineno
 
-    return class_indices, method_indices
+    max_lineno = co_spans[co_order[0]][2] if co_order else -1
+    return class_indices, method_indices, end_lines, max_lineno
 
 
   @staticmethod
@@ -537,84 +1084,62 @@ class BytecodeObject(object):
 
 
   def load_bytecode(self, code_object):
-    BytecodeObject.parse_code_object(code_object, self.bytecode)
+    self.bytecode = BytecodeObject.get_parsed_code(code_object)
     # logger.debug("Bytecode for %s:\n%s" % (code_object, show_bytecode(self.bytecode)))
 
 
   @staticmethod
-  def get_parsed_code(code_object):
-    bytecode = []
-    BytecodeObject.parse_code_object(code_object, bytecode)
+  def get_parsed_code(code_object, recursive=True):
+    """
+      Returns the decoded bytecode of the ``code_object`` (see ``parse_code_object``).
+      The result is memoized in ``PARSED_CODE_CACHE`` by identity of the code object,
+      and must not be modified.
+
+      :param code_object: The code object to decode.
+      :param recursive: Whether the nested code objects are decoded as well.
+    """
+    key = (id(code_object), recursive)
+    entry = PARSED_CODE_CACHE.get(key)
+    # The cache holds a reference to the code object, so its id cannot be
+    # reused while the entry exists.
+    if entry is not None and entry[0] is code_object:
+      return entry[1]
+    bytecode = CompactBytecode()
+    BytecodeObject.parse_code_object(code_object, bytecode, recursive)
+    PARSED_CODE_CACHE.put(key, (code_object, bytecode))
     return bytecode
 
 
   @staticmethod
-  def parse_code_object(code_object, bytecode):
+  def invalidate_parsed_code(code_object):
+    """
+      Drops the decoded bytecode of ``code_object`` from ``PARSED_CODE_CACHE``. This
+      is called when a code object is replaced by the rewriter.
+    """
+    PARSED_CODE_CACHE.discard((id(code_object), True))
+    PARSED_CODE_CACHE.discard((id(code_object), False))
+
+
+  @staticmethod
+  def parse_code_object(code_object, bytecode, recursive=True):
     """
       Parses the bytecode (``co_code`` field of the code object) and dereferences the
-      ``oparg`` for later analysis.
+      ``oparg`` for later analysis. See ``CompactBytecode.decode``.
 
       :param code_object: The code object containing the bytecode to analyze
-      :param bytecode: The list that will be used to append the expanded bytecode
-                       sequences.
+      :param bytecode: The ``CompactBytecode`` (or list) that will be used to append
+                       the expanded bytecode sequences.
+      :param recursive: Whether the nested code objects are expanded after their
+                        ``LOAD_CONST``. Defaults to ``True``.
     """
     if not code_object:
       return
-    code = code_object.co_code
-
-    labels = findlabels(code_object.co_code)
-    linestarts = dict(findlinestarts(code_object))
-
-    global_free = code_object.co_cellvars + code_object.co_freevars
-    newlocals = bool(code_object.co_flags & CO_NEWLOCALS)
-
-    length = len(code)
-    i = 0
-    lineno = -1
-    extended_arg = 0
-
-    while i < length:
-      c = code[i]
-      op = ord(c)
-
-      if i in linestarts:
-        lineno = linestarts[i]
-
-      arg1 = None
-      cflow_in = i in labels
-      current_index = i
-      i += 1
-
-      if op >= opcode.HAVE_ARGUMENT:
-        oparg = ord(code[i]) + (ord(code[i + 1]) << 8) + extended_arg
-        i += 2
-        label = -1
-        extended_arg = 0
-
-        if op == opcode.EXTENDED_ARG:
-          extended_arg = (oparg << 16)
-
-        if op in opcode.hasconst:
-          arg1 = code_object.co_consts[oparg]
-        elif op in opcode.hasname:
-          arg1 = code_object.co_names[oparg]
-        elif op in opcode.haslocal:
-          arg1 = code_object.co_varnames[oparg]
-        elif op in opcode.hascompare:
-          arg1 = opcode.cmp_op[oparg]
-        elif op in opcode.hasfree:
-          arg1 = global_free[oparg]
-        elif op in opcode.hasjrel:
-          arg1 = oparg
-        elif op in opcode.hasjabs:
-          arg1 = oparg
-        else:
-          arg1 = oparg
-
-      bytecode.append((current_index, lineno, op, arg1, cflow_in, code_object))
-
-      if arg1 and isinstance(arg1, types.CodeType):
-        BytecodeObject.parse_code_object(arg1, bytecode)
+    if isinstance(bytecode, CompactBytecode):
+      bytecode.decode(code_object, recursive)
+    else:
+      compact = CompactBytecode()
+      compact.decode(code_object, recursive)
+      bytecode.extend(compact)
 
 
   @staticmethod
@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+"""
+  equip.bytecode.compact
+  ~~~~~~~~~~~~~~~~~~~~~~
+
+  Compact (struct of arrays) storage of the decoded bytecode.
+
+  :copyright: (c) 2014 by Romain Gaucher (@rgaucher)
+  :license: Apache 2, see LICENSE for more details.
+"""
+import types
+import opcode
+from array import array
+from bisect import bisect_left
+
+
+# Kinds of oparg, used to dereference the raw oparg when an instruction is read
+ARG_NONE = 0
+ARG_RAW = 1
+ARG_CONST = 2
+ARG_NAME = 3
+ARG_LOCAL = 4
+ARG_COMPARE = 5
+ARG_FREE = 6
+
+
+def make_arg_kinds():
+  kinds = [ARG_NONE] * 256
+  for op in xrange(opcode.HAVE_ARGUMENT, 256):
+    if op in opcode.hasconst:
+      kinds[op] = ARG_CONST
+    elif op in opcode.hasname:
+      kinds[op] = ARG_NAME
+    elif op in opcode.haslocal:
+      kinds[op] = ARG_LOCAL
+    elif op in opcode.hascompare:
+      kinds[op] = ARG_COMPARE
+    elif op in opcode.hasfree:
+      kinds[op] = ARG_FREE
+    else:
+      kinds[op] = ARG_RAW
+  return tuple(kinds)
+
+#: Kind of oparg for each opcode
+ARG_KINDS = make_arg_kinds()
+
+# Kinds of jump, used to find the jump targets while decoding
+JUMP_NONE = 0
+JUMP_REL = 1
+JUMP_ABS = 2
+
+#: Kind of jump for each opcode
+JUMP_KINDS = tuple(JUMP_REL if op in opcode.hasjrel else
+                   JUMP_ABS if op in opcode.hasjabs else
+                   JUMP_NONE
+                   for op in xrange(256))
+
+HAVE_ARGUMENT = opcode.HAVE_ARGUMENT
+EXTENDED_ARG = opcode.EXTENDED_ARG
+LOAD_CONST = opcode.opmap['LOAD_CONST']
+
+
+class CompactBytecode(object):
+  """
+    Stores the decoded instructions in parallel arrays instead of one tuple per
+    instruction:
+
+    * ``offsets``: offset of the instruction in its ``co_code``
+    * ``linenos``: line number of the instruction
+    * ``opcodes``: the opcode
+    * ``opargs``: the raw oparg (``-1`` when the opcode has no argument)
+    * ``cflow``: ``1`` if the instruction is a jump target
+    * ``co_indices``: index of the code object of the instruction in ``code_objects``
+
+    The arguments are dereferenced when an instruction is read, through a table per
+    code object (consts, names, varnames, etc.). Reading an instruction returns the
+    usual tuple ``(index, lineno, op, arg, cflow_in, code_object)``, and slicing
+    returns a ``BytecodeView``, so the storage can be used in place of the list of
+    tuples.
+
+    The offsets are stored as unsigned ints since ``co_code`` can be larger than 64K.
+
+    Each decoded code object also gets an offset to position index, so the position
+    of an instruction is found from its offset in constant time (see ``position_of``),
+    and ``offsets`` gives the offset of a position.
+  """
+
+  def __init__(self):
+    self.offsets = array('I')
+    self.linenos = array('i')
+    self.opcodes = array('B')
+    self.opargs = array('i')
+    self.cflow = array('B')
+    self.co_indices = array('I')
+    self.code_objects = []
+    self._arg_tables = []
+    self._co_index = {}
+    # co index -> array(offset -> position)
+    self._offset_positions = []
+    # co index -> positions of the instructions of the code object
+    self._co_positions = {}
+
+
+  def add_code_object(self, code_object):
+    """
+      Registers the ``code_object`` and returns its index.
+    """
+    key = id(code_object)
+    if key in self._co_index:
+      return self._co_index[key]
+    co_index = len(self.code_objects)
+    self.code_objects.append(code_object)
+    self._arg_tables.append((
+      None,
+      None,
+      code_object.co_consts,
+      code_object.co_names,
+      code_object.co_varnames,
+      opcode.cmp_op,
+      code_object.co_cellvars + code_object.co_freevars,
+    ))
+    self._co_index[key] = co_index
+    self._offset_positions.append(None)
+    return co_index
+
+
+  def add(self, index, lineno, op, oparg, cflow_in, co_index):
+    """
+      Appends an instruction.
+
+      :param index: The offset of the instruction.
+      :param lineno: The line number of the instruction.
+      :param op: The opcode.
+      :param oparg: The raw oparg, or ``-1`` if the opcode has no argument.
+      :param cflow_in: ``True`` if the instruction is a jump target.
+      :param co_index: The index of the code object, as returned by ``add_code_object``.
+    """
+    self.offsets.append(index)
+    self.linenos.append(lineno)
+    self.opcodes.append(op)
+    self.opargs.append(oparg)
+    self.cflow.append(1 if cflow_in else 0)
+    self.co_indices.append(co_index)
+
+
+  def decode(self, code_object, recursive=True):
+    """
+      Decodes the ``co_code`` of the ``code_object`` and appends its instructions.
+      When ``recursive`` is set, the instructions of a nested code object are
+      appended right after the ``LOAD_CONST`` that loads it.
+
+      The bytecode is read as a ``bytearray``, and the kinds of arguments and
+      jumps come from the precomputed tables (``ARG_KINDS``, ``JUMP_KINDS``).
+      The jump targets are flagged once the whole code object is decoded.
+
+      :param code_object: The code object to decode.
+      :param recursive: Whether to decode the nested code objects.
+    """
+    code = bytearray(code_object.co_code)
+    length = len(code)
+    co_index = self.add_code_object(code_object)
+
+    # Line number table: the line changes at each of ``line_addrs``
+    lnotab = bytearray(code_object.co_lnotab)
+    line_addrs, line_numbers = [], []
+    addr, lineno = 0, code_object.co_firstlineno
+    for k in xrange(0, len(lnotab), 2):
+      addr += lnotab[k]
+      lineno += lnotab[k + 1]
+      line_addrs.append(addr)
+      line_numbers.append(lineno)
+    line_addrs.append(length + 1)
+    lineno, next_line = code_object.co_firstlineno, 0
+
+    nested = None
+    if recursive:
+      nested = [isinstance(c, types.CodeType) for c in code_object.co_consts]
+
+    offsets_append = self.offsets.append
+    linenos_append = self.linenos.append
+    opcodes_append = self.opcodes.append
+    opargs_append = self.opargs.append
+    cflow_append = self.cflow.append
+    co_indices_append = self.co_indices.append
+    jump_kinds = JUMP_KINDS
+
+    # offset -> position, also used to flag the jump targets
+    positions = array('i', [-1]) * length
+    position = len(self.opcodes)
+    targets = []
+    extended_arg = 0
+    i = 0
+    while i < length:
+      while line_addrs[next_line] <= i:
+        lineno = line_numbers[next_line]
+        next_line += 1
+
+      op = code[i]
+      positions[i] = position
+      position += 1
+      offsets_append(i)
+      linenos_append(lineno)
+      opcodes_append(op)
+      cflow_append(0)
+      co_indices_append(co_index)
+
+      if op < HAVE_ARGUMENT:
+        opargs_append(-1)
+        i += 1
+        continue
+
+      oparg = code[i + 1] + (code[i + 2] << 8) + extended_arg
+      opargs_append(oparg)
+      i += 3
+      extended_arg = 0
+
+      if op == EXTENDED_ARG:
+        extended_arg = oparg << 16
+        continue
+
+      jump_kind = jump_kinds[op]
+      if jump_kind == JUMP_REL:
+        targets.append(i + oparg)
+      elif jump_kind == JUMP_ABS:
+        targets.append(oparg)
+      elif op == LOAD_CONST and nested is not None and nested[oparg]:
+        self.decode(code_object.co_consts[oparg], recursive)
+        position = len(self.opcodes)
+
+    cflow = self.cflow
+    for target in targets:
+      if 0 <= target < length and positions[target] >= 0:
+        cflow[positions[target]] = 1
+    self._offset_positions[co_index] = positions
+    self._co_positions.pop(co_index, None)
+
+
+  def get_code_object_index(self, code_object=None):
+    """
+      Returns the index of the ``code_object`` in ``code_objects``, or -1 if it was
+      not decoded in this storage. Defaults to the first decoded code object.
+    """
+    if code_object is None:
+      return 0 if self.code_objects else -1
+    co_index = self._co_index.get(id(code_object), -1)
+    if co_index < 0 or self.code_objects[co_index] is not code_object:
+      return -1
+    return co_index
+
+
+  def get_offset_positions(self, code_object=None):
+    """
+      Returns the array that maps each offset of the ``co_code`` of ``code_object``
+      to the position of its instruction, or -1 when no instruction starts at that
+      offset.
+    """
+    co_index = self.get_code_object_index(code_object)
+    if co_index < 0:
+      return None
+    return self._offset_positions[co_index]
+
+
+  def position_of(self, offset, code_object=None):
+    """
+      Returns the position of the instruction of ``code_object`` at ``offset``, or
+      -1 if there is none. Defaults to the first decoded code object.
+    """
+    positions = self.get_offset_positions(code_object)
+    if positions is None or offset < 0 or offset >= len(positions):
+      return -1
+    return positions[offset]
+
+
+  def offset_of(self, position):
+    """
+      Returns the offset of the instruction at ``position``.
+    """
+    return self.offsets[position]
+
+
+  def get_start_code_object(self):
+    """
+      Returns the code object whose first instruction (at offset 0) comes first in
+      the storage, or ``None`` if the storage is empty.
+    """
+    return self.code_objects[0] if self.code_objects else None
+
+
+  def get_code_object_positions(self, code_object=None):
+    """
+      Returns the ordered positions of the instructions of ``code_object``, without
+      the ones of its nested code objects.
+    """
+    co_index = self.get_code_object_index(code_object)
+    if co_index < 0:
+      return array('i')
+    if co_index not in self._co_positions:
+      self._co_positions[co_index] = array('i', [p for p in self._offset_positions[co_index] if p >= 0])
+    return self._co_positions[co_index]
+
+
+  def get_arg(self, i):
+    """
+      Returns the dereferenced argument of the instruction at position ``i``.
+    """
+    kind = ARG_KINDS[self.opcodes[i]]
+    if kind == ARG_NONE:
+      return None
+    oparg = self.opargs[i]
+    if kind == ARG_RAW:
+      return oparg
+    return self._arg_tables[self.co_indices[i]][kind][oparg]
+
+
+  def get(self, i):
+    co_index = self.co_indices[i]
+    op = self.opcodes[i]
+    kind = ARG_KINDS[op]
+    if kind == ARG_NONE:
+      arg = None
+    elif kind == ARG_RAW:
+      arg = self.opargs[i]
+    else:
+      arg = self._arg_tables[co_index][kind][self.opargs[i]]
+    return (self.offsets[i], self.linenos[i], op, arg,
+            self.cflow[i] == 1, self.code_objects[co_index])
+
+
+  def __len__(self):
+    return len(self.opcodes)
+
+
+  def __getitem__(self, key):
+    if isinstance(key, slice):
+      start, stop, step = key.indices(len(self.opcodes))
+      if step != 1:
+        return [self.get(i) for i in xrange(start, stop, step)]
+      return BytecodeView(self, start, max(start, stop))
+    if key < 0:
+      key += len(self.opcodes)
+    if key < 0 or key >= len(self.opcodes):
+      raise IndexError('bytecode index out of range')
+    return self.get(key)
+
+
+  def __iter__(self):
+    get = self.get
+    for i in xrange(len(self.opcodes)):
+      yield get(i)
+
+
+  # The storage is not modified once decoded, so it is shared by the copies
+  # of the declarations (see ``SimpleRewriter``).
+  def __copy__(self):
+    return self
+
+  def __deepcopy__(self, memo):
+    return self
+
+
+  def __repr__(self):
+    return 'CompactBytecode(%d instructions, %d code objects)' \
+           % (len(self.opcodes), len(self.code_objects))
+
+
+
+class BytecodeView(object):
+  """
+    A contiguous slice of a ``CompactBytecode``. It behaves like the list of tuples
+    of the instructions from ``start`` to ``stop`` without copying them.
+  """
+
+  def __init__(self, storage, start, stop):
+    self.storage = storage
+    self.start = start
+    self.stop = stop
+    self._co_positions = {}
+
+
+  def default_code_object(self, code_object=None):
+    if code_object is None and self.stop > self.start:
+      return self.storage.code_objects[self.storage.co_indices[self.start]]
+    return code_object
+
+
+  def position_of(self, offset, code_object=None):
+    """
+      Returns the position (in the view) of the instruction of ``code_object`` at
+      ``offset``, or -1 if there is none. Defaults to the code object of the first
+      instruction of the view.
+    """
+    code_object = self.default_code_object(code_object)
+    if code_object is None:
+      return -1
+    position = self.storage.position_of(offset, code_object)
+    if position < self.start or position >= self.stop:
+      return -1
+    return position - self.start
+
+
+  def offset_of(self, position):
+    """
+      Returns the offset of the instruction at ``position`` in the view.
+    """
+    if position < 0 or position >= self.stop - self.start:
+      raise IndexError('bytecode index out of range')
+    return self.storage.offsets[self.start + position]
+
+
+  def get_start_code_object(self):
+    """
+      Returns the code object whose first instruction (at offset 0) comes first in
+      the view, or ``None`` if there is none.
+    """
+    start_position, start_code_object = self.stop, None
+    for code_object in self.storage.code_objects:
+      position = self.storage.position_of(0, code_object)
+      if self.start <= position < start_position:
+        start_position, start_code_object = position, code_object
+    return start_code_object
+
+
+  def get_code_object_positions(self, code_object=None):
+    """
+      Returns the ordered positions (in the view) of the instructions of
+      ``code_object``, without the ones of its nested code objects. Defaults to
+      the code object of the first instruction of the view.
+    """
+    code_object = self.default_code_object(code_object)
+    if code_object is None:
+      return array('i')
+    key = id(code_object)
+    if key not in self._co_positions:
+      positions = self.storage.get_code_object_positions(code_object)
+      lower = bisect_left(positions, self.start)
+      upper = bisect_left(positions, self.stop)
+      self._co_positions[key] = array('i', [p - self.start for p in positions[lower:upper]])
+    return self._co_positions[key]
+
+
+  def __len__(self):
+    return self.stop - self.start
+
+
+  def __getitem__(self, key):
+    length = self.stop - self.start
+    if isinstance(key, slice):
+      start, stop, step = key.indices(length)
+      if step != 1:
+        return [self.storage.get(self.start + i) for i in xrange(start, stop, step)]
+      return BytecodeView(self.storage, self.start + start, self.start + max(start, stop))
+    if key < 0:
+      key += length
+    if key < 0 or key >= length:
+      raise IndexError('bytecode index out of range')
+    return self.storage.get(self.start + key)
+
+
+  def __iter__(self):
+    get = self.storage.get
+    for i in xrange(self.start, self.stop):
+      yield get(i)
+
+
+  def __copy__(self):
+    return self
+
+  def __deepcopy__(self, memo):
+    return self
+
+
+  def __repr__(self):
+    return 'BytecodeView(%d:%d of %r)' % (self.start, self.stop, self.storage)
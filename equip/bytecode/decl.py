@@ -32,6 +32,7 @@ class Declaration(object):
     self._code_object = _code_object
     self._parent = None
     self._children = []
+    self._children_sorted = True
     self._lines = None
     self._bytecode = []
     self._bytecode_object = None
@@ -82,8 +83,11 @@ class Declaration(object):
   @property
   def children(self):
     """
-      Returns the children of this declaration.
+      Returns the children of this declaration, sorted by line number.
     """
+    if not self._children_sorted:
+      self._children.sort(key=methodcaller('get_start_lineno'))
+      self._children_sorted = True
     return self._children
 
   def add_child(self, child):
@@ -93,9 +97,8 @@ class Declaration(object):
       :param child: A ``Declaration`` that is a child of the current declaration.
     """
     self._children.append(child)
-    # logger.debug("add_child:: Children: %s", self.children)
-    # Keep sorting by line number
-    self._children = sorted(self._children, key=methodcaller('get_start_lineno'))
+    # The children are sorted by line number once they are read
+    self._children_sorted = False
 
   @property
   def parent_module(self):
@@ -129,8 +132,14 @@ class Declaration(object):
   @property
   def bytecode(self):
     """
-      Returns the bytecode associated with this declaration.
+      Returns the bytecode associated with this declaration. When the bytecode was
+      not decoded yet (``None``, see the ``lazy_decode`` mode of ``BytecodeObject``),
+      it is decoded on the first access.
     """
+    if self._bytecode is None:
+      self._bytecode = []
+      if self._bytecode_object is not None:
+        self._bytecode = self._bytecode_object.load_decl_bytecode(self)
     return self._bytecode
 
   @bytecode.setter
@@ -143,12 +152,15 @@ class Declaration(object):
 
   @code_object.setter
   def code_object(self, value):
+    original_co = self._code_object
     self._code_object = value
+    if self._bytecode_object is not None:
+      self._bytecode_object.reindex_decl(self, original_co)
 
   def update_nested_code_object(self, original_co, new_co):
-    self._code_object = update_nested_code_object(self._code_object,
-                                                  original_co,
-                                                  new_co)
+    self.code_object = update_nested_code_object(self._code_object,
+                                                 original_co,
+                                                 new_co)
     self._has_changes = True
 
   @property
@@ -169,10 +181,20 @@ class Declaration(object):
       self._bytecode_object = value
 
 
+  def release(self):
+    """
+      Cuts the links to the parent, children, bytecode and ``BytecodeObject``. The
+      declaration should not be used afterwards.
+    """
+    self._parent = None
+    self._children = []
+    self._bytecode = []
+    self._bytecode_object = None
+
+
   def accept(self, visitor):
     if isinstance(visitor, BytecodeVisitor):
-      for i in xrange(len(self._bytecode)):
-        index, lineno, op, arg, cflow_in, _ = self._bytecode[i]
+      for index, lineno, op, arg, cflow_in, _ in self.bytecode:
         visitor.visit(index, op, arg=arg, lineno=lineno, cflow_in=cflow_in)
 
 
@@ -297,16 +319,28 @@ class ModuleDeclaration(Declaration):
     Declaration.__init__(self, Declaration.MODULE, code_object)
     self._module_path = module_path
 
+    self._imports = None
+    self._classes = None
+    self._functions = None
+
+  def release(self):
+    Declaration.release(self)
     self._imports = []
     self._classes = None
     self._functions = None
 
   def add_import(self, importDecl):
+    if self._imports is None:
+      self._imports = []
     if importDecl not in self._imports:
       self._imports.append(importDecl)
 
   @property
   def imports(self):
+    if self._imports is None:
+      self._imports = []
+      if self._bytecode_object is not None and self._bytecode_object.lazy_decode:
+        self._bytecode_object.load_imports(self)
     return self._imports
 
   @property
@@ -340,7 +374,7 @@ class TypeDeclaration(Declaration):
     Declaration.__init__(self, Declaration.TYPE, code_object)
     self._type_name = type_name
 
-    self._superclasses = set()
+    self._superclasses = None
     self._methods = None
     self._fields = None
     self._nested_types = None
@@ -354,9 +388,24 @@ class TypeDeclaration(Declaration):
 
   @property
   def superclasses(self):
+    if self._superclasses is None:
+      self._superclasses = set()
+      if self._bytecode_object is not None and self._bytecode_object.lazy_decode:
+        self._bytecode_object.load_superclasses(self)
     return self._superclasses
 
+  @superclasses.setter
+  def superclasses(self, value):
+    self._superclasses = value
+
+  def release(self):
+    Declaration.release(self)
+    self._methods = None
+    self._nested_types = None
+
   def add_superclass(self, type_name):
+    if self._superclasses is None:
+      self._superclasses = set()
     self._superclasses.add(type_name)
 
   @property
@@ -396,7 +445,7 @@ class MethodDeclaration(Declaration):
     self._method_name = method_name
     self._formal_parameters = []
     self._body = None
-    self._labels = dis.findlabels(code_object.co_code)
+    self._labels = None
     self._nested_types = []
 
   @property
@@ -409,6 +458,8 @@ class MethodDeclaration(Declaration):
 
   @property
   def labels(self):
+    if self._labels is None:
+      self._labels = dis.findlabels(self.code_object.co_code)
     return self._labels
 
   @property
@@ -11,6 +11,7 @@
 import opcode
 import types
 import dis
+from bisect import bisect_left
 from ..utils.log import logger
 
 
@@ -32,6 +33,53 @@ def iter_decl(decl):
     pass
 
 
+def get_code_object_bytecode(bytecode, start_offset=0, end_offset=None):
+  """
+    Returns the list of instructions of the code object that starts the ``bytecode``
+    (the first instruction at offset 0), without the instructions of the nested code
+    objects. The instructions can be restricted to the offsets in
+    ``[start_offset, end_offset)``.
+
+    The offset index of the ``CompactBytecode`` is used when available.
+
+    :param bytecode: The decoded bytecode (e.g., the ``bytecode`` of a declaration).
+    :param start_offset: The offset of the first instruction to return.
+    :param end_offset: The offset where to stop. Defaults to the end of the code object.
+  """
+  if len(bytecode) == 0:
+    return []
+
+  if hasattr(bytecode, 'get_code_object_positions'):
+    code_object = bytecode[0][5] if bytecode[0][0] == 0 else bytecode.get_start_code_object()
+    if code_object is None:
+      raise Exception('No code object starts in the bytecode %r' % bytecode)
+    positions = bytecode.get_code_object_positions(code_object)
+    k = bisect_left(positions, bytecode.position_of(0, code_object))
+    if start_offset > 0:
+      start_position = bytecode.position_of(start_offset, code_object)
+      if start_position >= 0:
+        k = bisect_left(positions, start_position)
+      else:
+        while k < len(positions) and bytecode.offset_of(positions[k]) < start_offset:
+          k += 1
+    result = []
+    while k < len(positions):
+      tpl = bytecode[positions[k]]
+      if end_offset is not None and tpl[0] >= end_offset:
+        break
+      result.append(tpl)
+      k += 1
+    return result
+
+  start_index = next((j for j, tpl in enumerate(bytecode) if tpl[0] == 0), None)
+  if start_index is None:
+    raise Exception('No code object starts in the bytecode')
+  code_object = bytecode[start_index][5]
+  return [tpl for tpl in bytecode[start_index:] \
+          if tpl[5] is code_object and tpl[0] >= start_offset \
+          and (end_offset is None or tpl[0] < end_offset)]
+
+
 # Look into the main_co if we get orignal_co, if so we replace it with new_co
 def update_nested_code_object(main_co, original_co, new_co):
   if not main_co:
@@ -64,6 +112,26 @@ def update_nested_code_object(main_co, original_co, new_co):
   return main_co
 
 
+def replace_nested_code_objects(main_co, replacements):
+  """
+    Returns a copy of ``main_co`` where the nested code objects are replaced, all
+    at once, from ``replacements``. The nested code objects are matched by identity.
+
+    :param main_co: The code object that contains the nested code objects.
+    :param replacements: A dict of ``id(nested code object) -> new code object``.
+  """
+  new_co_consts = tuple(replacements.get(id(co_const), co_const) \
+                          if isinstance(co_const, types.CodeType) else co_const \
+                        for co_const in main_co.co_consts)
+  return types.CodeType(main_co.co_argcount, main_co.co_nlocals,
+                        main_co.co_stacksize, main_co.co_flags,
+                        main_co.co_code, new_co_consts,
+                        main_co.co_names, main_co.co_varnames,
+                        main_co.co_filename, main_co.co_name,
+                        main_co.co_firstlineno, main_co.co_lnotab,
+                        main_co.co_freevars, main_co.co_cellvars)
+
+
 def show_bytecode(bytecode, start=0, end=2**32):
   from ..analysis.python.effects import get_stack_effect
 
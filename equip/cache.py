@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+  equip.cache
+  ~~~~~~~~~~~
+
+  Content-addressed cache of instrumented bytecode files.
+
+  :copyright: (c) 2014 by Romain Gaucher (@rgaucher)
+  :license: Apache 2, see LICENSE for more details.
+"""
+import os
+import sys
+import pickle
+import hashlib
+import inspect
+import tempfile
+
+from .utils.log import logger
+from .visitors import CompositeVisitor
+
+
+class InstrumentationCache(object):
+  """
+    Stores the result of the instrumentation of a pyc file under a key computed
+    from the content of the original pyc, the fingerprint of the visitor, the
+    injected code (``on_enter``/``on_exit``) and the version of equip.
+
+    An entry either contains the instrumented pyc, or is empty when the
+    instrumentation did not change the file. The instrumented pyc is also
+    recorded as unchanged so that running the instrumentation again over an
+    already instrumented program is a cache hit.
+
+    The state of a visitor is fingerprinted from its ``cache_key()`` method when it
+    has one, and otherwise from its pickled state. When neither is available, the
+    files instrumented by the visitor are not cached.
+  """
+
+  #: Content of an entry for a file that was not changed by the instrumentation.
+  UNCHANGED = ''
+
+  def __init__(self, cache_dir):
+    self.cache_dir = os.path.abspath(cache_dir)
+    self.hits = 0
+    self.misses = 0
+    # (visitor, wrapping key, selector key, fingerprint) of the last fingerprint
+    self._last_fingerprint = None
+
+
+  def make_key(self, bytecode_file, visitor, wrapping_code, selector=None):
+    """
+      Computes the cache key of a bytecode file for the given instrumentation. Returns
+      ``None`` when the visitor cannot be fingerprinted (see ``fingerprint``).
+
+      :param bytecode_file: Absolute path of the file containing the bytecode (pyc).
+      :param visitor: The visitor applied on the bytecode.
+      :param wrapping_code: The ``on_enter``/``on_exit`` code of the ``Instrumentation``.
+      :param selector: The ``Selector`` of the instrumented declarations, if any.
+    """
+    with open(bytecode_file, 'rb') as fd:
+      content = fd.read()
+    return self.make_content_key(content, visitor, wrapping_code, selector)
+
+
+  def make_declarations_key(self, content):
+    """
+      Computes the key of the serialized declarations of a bytecode file (see
+      ``BytecodeObject.dump_declarations``).
+
+      :param content: The content of the bytecode file.
+    """
+    from . import __version__
+    hasher = hashlib.sha1('declarations:' + __version__)
+    hasher.update(content)
+    return hasher.hexdigest()
+
+
+  def make_content_key(self, content, visitor, wrapping_code, selector=None, path=None):
+    """
+      Computes the cache key of the ``content`` of a bytecode (or source) file. See
+      ``make_key``.
+
+      :param path: The path of the file, when the content alone does not tell where
+                   the module comes from (e.g., a python source).
+    """
+    fingerprint = self.fingerprint(visitor, wrapping_code, selector)
+    if fingerprint is None:
+      return None
+    hasher = hashlib.sha1(content)
+    hasher.update(fingerprint)
+    if path is not None:
+      hasher.update(os.path.abspath(path))
+    return hasher.hexdigest()
+
+
+  def fingerprint(self, visitor, wrapping_code, selector=None):
+    """
+      Returns the fingerprint of the instrumentation. It covers the source of the
+      modules that define the visitor class (and its bases), the state of the visitor,
+      the selector, the injected code and the equip version.
+
+      Returns ``None`` (and logs an error) when the state of a visitor cannot be
+      fingerprinted: it has no ``cache_key()`` method and cannot be pickled.
+
+      :param visitor: The visitor, list of visitors or ``CompositeVisitor``.
+      :param wrapping_code: The ``on_enter``/``on_exit`` code of the ``Instrumentation``.
+      :param selector: The ``Selector`` of the instrumented declarations, if any.
+    """
+    wrapping_key = tuple(sorted(wrapping_code.items()))
+    selector_key = repr(selector)
+    last = self._last_fingerprint
+    if last is not None and last[0] is visitor and last[1] == wrapping_key \
+       and last[2] == selector_key:
+      return last[3]
+
+    from . import __version__
+
+    hasher = hashlib.sha1(__version__)
+    hasher.update(repr(wrapping_key))
+    hasher.update(selector_key)
+    visitors = visitor if isinstance(visitor, (list, tuple, CompositeVisitor)) else (visitor,)
+    if isinstance(visitor, CompositeVisitor):
+      hasher.update(repr(visitor.selector))
+    for klass in [k for v in visitors for k in type(v).__mro__]:
+      if klass.__module__ == '__builtin__' or klass.__module__.startswith('equip.'):
+        continue
+      hasher.update(klass.__module__ + '.' + klass.__name__)
+      hasher.update(InstrumentationCache.get_module_source(klass.__module__))
+
+    fingerprint = None
+    for v in visitors:
+      state = InstrumentationCache.get_visitor_state(v)
+      if state is None:
+        logger.error("Cannot fingerprint the visitor %s: it has no cache_key() method and "
+                     "cannot be pickled. The instrumentation is not cached.", type(v).__name__)
+        break
+      hasher.update(state)
+    else:
+      fingerprint = hasher.hexdigest()
+
+    self._last_fingerprint = (visitor, wrapping_key, selector_key, fingerprint)
+    return fingerprint
+
+
+  @staticmethod
+  def get_visitor_state(visitor):
+    """
+      Returns the serialized state of the ``visitor``, from its ``cache_key()`` method
+      when it has one, or its pickled state. Returns ``None`` if it cannot be pickled.
+    """
+    cache_key = getattr(visitor, 'cache_key', None)
+    if cache_key is not None:
+      return 'cache_key:' + repr(cache_key())
+    try:
+      return pickle.dumps(visitor, 0)
+    except Exception:
+      return None
+
+
+  @staticmethod
+  def get_module_source(module_name):
+    module = sys.modules.get(module_name)
+    try:
+      source_file = inspect.getsourcefile(module)
+      with open(source_file, 'rb') as fd:
+        return fd.read()
+    except Exception:
+      logger.debug("No source found for the module %s", module_name)
+      return module_name
+
+
+  def entry_path(self, key):
+    return os.path.join(self.cache_dir, key[:2], key)
+
+
+  def get_entry(self, key):
+    """
+      Returns the content of the entry ``key``, or ``None`` if it is not in the cache.
+    """
+    try:
+      with open(self.entry_path(key), 'rb') as fd:
+        content = fd.read()
+    except IOError:
+      self.misses += 1
+      return None
+    self.hits += 1
+    return content
+
+
+  def restore(self, key, bytecode_file):
+    """
+      Restores the instrumented bytecode file from the cache. Returns ``None``
+      if there is no entry for the ``key``, otherwise ``True`` if the file was
+      rewritten, and ``False`` when the cached instrumentation left it unchanged.
+
+      :param key: The key computed by ``make_key``.
+      :param bytecode_file: Absolute path of the file containing the bytecode (pyc).
+    """
+    content = self.get_entry(key)
+    if content is None:
+      return None
+    if content == InstrumentationCache.UNCHANGED:
+      return False
+    InstrumentationCache.write_atomic(bytecode_file, content)
+    logger.debug("Restored %s from the cache", bytecode_file)
+    return True
+
+
+  def store(self, key, bytecode_file, written, visitor, wrapping_code, selector=None):
+    """
+      Records the outcome of the instrumentation of ``bytecode_file``.
+
+      :param key: The key of the original bytecode file.
+      :param bytecode_file: Absolute path of the file containing the bytecode (pyc).
+      :param written: ``True`` if the instrumentation rewrote the bytecode file.
+      :param visitor: The visitor applied on the bytecode.
+      :param wrapping_code: The ``on_enter``/``on_exit`` code of the ``Instrumentation``.
+      :param selector: The ``Selector`` of the instrumented declarations, if any.
+    """
+    try:
+      if not written:
+        self.write_entry(key, InstrumentationCache.UNCHANGED)
+        return
+      with open(bytecode_file, 'rb') as fd:
+        content = fd.read()
+      self.write_entry(key, content)
+      self.write_entry(self.make_content_key(content, visitor, wrapping_code, selector),
+                       InstrumentationCache.UNCHANGED)
+    except (IOError, OSError), ex:
+      logger.error("Cannot store %s in the cache: %s", bytecode_file, ex)
+
+
+  def write_entry(self, key, content):
+    path = self.entry_path(key)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+      try:
+        os.makedirs(directory)
+      except OSError:
+        # Another worker may have created it
+        if not os.path.isdir(directory):
+          raise
+    InstrumentationCache.write_atomic(path, content)
+
+
+  @staticmethod
+  def write_atomic(path, content):
+    """
+      Writes the file through a temporary file and a rename, so concurrent readers
+      never see a partial file.
+    """
+    mode = os.stat(path).st_mode if os.path.exists(path) else 0644
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+      with os.fdopen(fd, 'wb') as tmp_fd:
+        tmp_fd.write(content)
+      os.chmod(tmp_path, mode & 0777)
+      os.rename(tmp_path, path)
+    except:
+      if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+      raise
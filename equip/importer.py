@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+  equip.importer
+  ~~~~~~~~~~~~~~
+
+  Import hook that instruments the modules when they are imported, instead of
+  rewriting the bytecode files.
+
+  :copyright: (c) 2014 by Romain Gaucher (@rgaucher)
+  :license: Apache 2, see LICENSE for more details.
+"""
+import os
+import imp
+import sys
+import marshal
+import threading
+from fnmatch import fnmatch
+
+from .utils.log import logger
+from .prog import Program
+from .cache import InstrumentationCache
+from .bytecode import BytecodeObject
+from .visitors import CompositeVisitor
+
+
+class InstrumentationFinder(object):
+  """
+    A PEP 302 meta path finder that runs the visitors over the code objects of the
+    modules being imported. Only the imported modules pay the instrumentation cost,
+    and the bytecode files on disk are left untouched. The hook is registered with
+    ``install`` and removed with ``uninstall``::
+
+      finder = InstrumentationFinder(CounterInstrumentationVisitor(),
+                                     modules=('myapp', 'myapp.*'))
+      finder.install()
+
+    The instrumented code objects are memoized in the process, and optionally stored
+    in a side cache directory so that other processes do not instrument them again.
+  """
+
+  #: Modules that are never instrumented, as they are used by the instrumentation.
+  EXCLUDED_MODULES = ('equip', 'equip.*')
+
+  def __init__(self, visitors, modules=None, on_enter=None, on_exit=None, cache_dir=None,
+               locations=None):
+    """
+      :param visitors: The visitor, or list of visitors, to run over each imported module.
+      :param modules: Glob patterns of the full names of the modules to instrument.
+      :param on_enter: A tuple ``(python_code, import_code)`` to insert at the beginning
+                       of the modules. See ``Instrumentation.on_enter``.
+      :param on_exit: A tuple ``(python_code, import_code)`` to insert at the end of
+                      the modules. See ``Instrumentation.on_exit``.
+      :param cache_dir: Directory where the instrumented code objects are cached.
+      :param locations: Directories of the program: the modules loaded from them are
+                        instrumented as well. When neither ``modules`` nor ``locations``
+                        is given, it defaults to the directory of the main script (the
+                        first entry of ``sys.path``), so the standard library and the
+                        installed packages are not instrumented.
+    """
+    if not isinstance(visitors, (list, tuple)):
+      visitors = [visitors]
+    self.visitors = list(visitors)
+    self.composite_visitor = CompositeVisitor(self.visitors)
+    self.modules = tuple(modules) if modules else None
+    if isinstance(locations, basestring):
+      locations = (locations,)
+    if not locations and self.modules is None:
+      locations = (sys.path[0] if sys.path and sys.path[0] else os.getcwd(),)
+    self.locations = tuple(os.path.abspath(l) for l in locations) if locations else None
+    self.wrapping_code = {
+      'on_enter': on_enter,
+      'on_exit': on_exit
+    }
+    self.cache = InstrumentationCache(cache_dir) if cache_dir else None
+    self._memo = {}
+    self._local = threading.local()
+
+
+  def install(self):
+    """
+      Registers the finder in ``sys.meta_path``.
+    """
+    if self not in sys.meta_path:
+      sys.meta_path.insert(0, self)
+    return self
+
+
+  def uninstall(self):
+    """
+      Removes the finder from ``sys.meta_path``. The modules already imported
+      remain instrumented.
+    """
+    while self in sys.meta_path:
+      sys.meta_path.remove(self)
+
+
+  def should_instrument(self, fullname, pathname=None):
+    """
+      Returns ``True`` if the module ``fullname`` (loaded from ``pathname``, if known)
+      is instrumented: either its name matches the ``modules`` patterns, or it is
+      located in one of the ``locations``.
+    """
+    for pattern in InstrumentationFinder.EXCLUDED_MODULES:
+      if fnmatch(fullname, pattern):
+        return False
+    if self.modules is not None:
+      for pattern in self.modules:
+        if fnmatch(fullname, pattern):
+          return True
+    if self.locations is None:
+      return False
+    if pathname is None:
+      # Decided once the module is found
+      return True
+    pathname = os.path.abspath(pathname)
+    for location in self.locations:
+      if pathname.startswith(location + os.sep):
+        return True
+    return False
+
+
+  def find_module(self, fullname, path=None):
+    # Imports triggered by the instrumentation itself go through the regular import
+    if getattr(self._local, 'busy', False) or not self.should_instrument(fullname):
+      return None
+
+    name = fullname.rpartition('.')[2]
+    try:
+      fd, pathname, description = imp.find_module(name, path)
+    except ImportError:
+      return None
+    if fd is not None:
+      fd.close()
+
+    kind = description[2]
+    package_path = None
+    if kind == imp.PKG_DIRECTORY:
+      package_path = pathname
+      try:
+        fd, pathname, description = imp.find_module('__init__', [package_path])
+      except ImportError:
+        return None
+      if fd is not None:
+        fd.close()
+      kind = description[2]
+
+    if kind not in (imp.PY_SOURCE, imp.PY_COMPILED) \
+       or not self.should_instrument(fullname, pathname):
+      return None
+    return InstrumentationLoader(self, pathname, kind, package_path)
+
+
+  def get_code(self, pathname, kind):
+    """
+      Returns the instrumented code object of the module located at ``pathname``.
+
+      :param pathname: The path of the source or bytecode file of the module.
+      :param kind: Either ``imp.PY_SOURCE`` or ``imp.PY_COMPILED``.
+    """
+    stat = os.stat(pathname)
+    memo_key = (pathname, stat.st_mtime, stat.st_size)
+    if memo_key in self._memo:
+      return self._memo[memo_key]
+
+    if kind == imp.PY_SOURCE and not Program.is_stale(pathname):
+      pathname, kind = pathname + 'c', imp.PY_COMPILED
+
+    with open(pathname, 'rb') as fd:
+      content = fd.read()
+
+    cache_key = None
+    if self.cache is not None:
+      # The code objects hold the path of their module, so identical modules of
+      # different packages do not share their entry
+      cache_key = self.cache.make_content_key(content, self.visitors, self.wrapping_code,
+                                              path=pathname)
+    if cache_key is not None:
+      entry = self.cache.get_entry(cache_key)
+      if entry is not None and entry[:4] == imp.get_magic():
+        code_object = marshal.loads(entry[4:])
+        self._memo[memo_key] = code_object
+        return code_object
+
+    if kind == imp.PY_SOURCE:
+      code_object = compile(content, pathname, 'exec')
+      pyc_file = pathname + 'c'
+    else:
+      code_object = marshal.loads(content[8:])
+      pyc_file = pathname
+
+    self._local.busy = True
+    try:
+      code_object = self.instrument(pyc_file, code_object)
+    finally:
+      self._local.busy = False
+
+    if cache_key is not None:
+      self.cache.write_entry(cache_key, imp.get_magic() + marshal.dumps(code_object))
+    self._memo[memo_key] = code_object
+    return code_object
+
+
+  def instrument(self, pyc_file, code_object):
+    """
+      Runs the visitors over ``code_object`` and returns the instrumented code object.
+
+      :param pyc_file: The path of the bytecode file of the module, used as its
+                       ``module_path``.
+      :param code_object: The code object of the module.
+    """
+    from .rewriter.simple import GLOBAL_IMPORTS_ADDED
+
+    logger.debug("Instrument on import: %s", pyc_file)
+    # The module is instrumented again (e.g., its source changed), so the imports
+    # need to be inserted again too.
+    GLOBAL_IMPORTS_ADDED.discard(pyc_file)
+
+    code = BytecodeObject(pyc_file)
+    code.parse_code(code_object)
+    if code.get_module() is None:
+      return code_object
+
+    code.accept(self.composite_visitor)
+
+    if self.wrapping_code['on_enter']:
+      code.add_enter_code(*self.wrapping_code['on_enter'])
+
+    if self.wrapping_code['on_exit']:
+      code.add_exit_code(*self.wrapping_code['on_exit'])
+
+    code.commit()
+    new_code_object = code.get_module().code_object
+    code.release()
+    return new_code_object
+
+
+
+class InstrumentationLoader(object):
+  """
+    The PEP 302 loader returned by the ``InstrumentationFinder``. It executes
+    the instrumented code object in a new module.
+
+    It also implements the optional loader methods (``get_code``, ``get_source``,
+    ``is_package`` and ``get_filename``) used by ``pkgutil``, ``runpy`` and
+    ``linecache``.
+  """
+
+  def __init__(self, finder, pathname, kind, package_path=None):
+    self.finder = finder
+    self.pathname = pathname
+    self.kind = kind
+    self.package_path = package_path
+
+
+  def get_filename(self, fullname):
+    return self.pathname
+
+
+  def is_package(self, fullname):
+    return self.package_path is not None
+
+
+  def get_code(self, fullname):
+    """
+      Returns the instrumented code object of the module.
+    """
+    return self.finder.get_code(self.pathname, self.kind)
+
+
+  def get_source(self, fullname):
+    """
+      Returns the source of the module, or ``None`` if it is only available as
+      bytecode.
+    """
+    source_file = self.pathname if self.kind == imp.PY_SOURCE else self.pathname[:-1]
+    if not os.path.isfile(source_file):
+      return None
+    with open(source_file, 'rU') as fd:
+      return fd.read()
+
+
+  def load_module(self, fullname):
+    code_object = self.get_code(fullname)
+
+    is_reload = fullname in sys.modules
+    module = sys.modules.setdefault(fullname, imp.new_module(fullname))
+    module.__file__ = self.pathname
+    module.__loader__ = self
+    if self.package_path is not None:
+      module.__path__ = [self.package_path]
+      module.__package__ = fullname
+    else:
+      module.__package__ = fullname.rpartition('.')[0]
+
+    try:
+      exec code_object in module.__dict__
+    except:
+      if not is_reload:
+        del sys.modules[fullname]
+      raise
+    return sys.modules[fullname]
+
+
+def install(visitors, modules=None, on_enter=None, on_exit=None, cache_dir=None,
+            locations=None):
+  """
+    Creates and installs an ``InstrumentationFinder``. See its constructor for the
+    description of the parameters.
+  """
+  return InstrumentationFinder(visitors, modules, on_enter, on_exit, cache_dir,
+                               locations).install()
+
+
+def uninstall():
+  """
+    Removes all the ``InstrumentationFinder`` from ``sys.meta_path``.
+  """
+  for finder in [f for f in sys.meta_path if isinstance(f, InstrumentationFinder)]:
+    finder.uninstall()
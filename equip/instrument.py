@@ -8,9 +8,18 @@
   :copyright: (c) 2014 by Romain Gaucher (@rgaucher)
   :license: Apache 2, see LICENSE for more details.
 """
+import os
+import pickle
+import traceback
+import multiprocessing
+from collections import deque
+
 from .prog import Program
+from .cache import InstrumentationCache
+from .shadow import ShadowTree
+from .selector import Selector
 from .bytecode import BytecodeObject
-from .visitors import MethodVisitor
+from .visitors import MethodVisitor, CompositeVisitor
 
 from .utils.log import logger
 
@@ -26,7 +35,8 @@ class Instrumentation(object):
   """
 
   #: The list of known options
-  KNOWN_OPTIONS = ('force-rebuild',)
+  KNOWN_OPTIONS = ('force-rebuild', 'jobs', 'cache-dir', 'include', 'exclude',
+                   'stream', 'max-in-flight', 'shadow-dir', 'lazy-decode')
 
 
   def __init__(self, location=None):
@@ -34,6 +44,10 @@ class Instrumentation(object):
     self._location = location
     self.program = None
     self.apply_ran = False
+    self.results = {}
+    self.errors = {}
+    self._cache = None
+    self._shadow = None
     self.wrapping_code = {
       'on_enter': None,
       'on_exit': None
@@ -76,6 +90,40 @@ class Instrumentation(object):
       self._location = value
 
 
+  @property
+  def cache(self):
+    """
+      The ``InstrumentationCache`` used when the ``cache-dir`` option is set,
+      ``None`` otherwise.
+    """
+    cache_dir = self.get_option('cache-dir')
+    if not cache_dir:
+      return None
+    if self._cache is None or self._cache.cache_dir != os.path.abspath(cache_dir):
+      self._cache = InstrumentationCache(cache_dir)
+    return self._cache
+
+
+  @property
+  def shadow(self):
+    """
+      The ``ShadowTree`` used when the ``shadow-dir`` option is set, ``None``
+      otherwise. In that case, the original bytecode files are left untouched
+      and the instrumented ones are written in the shadow tree.
+    """
+    shadow_dir = self.get_option('shadow-dir')
+    if not shadow_dir:
+      return None
+    locations = self._location
+    if isinstance(locations, basestring):
+      locations = (locations,)
+    locations = [os.path.abspath(l) for l in locations or ()]
+    if self._shadow is None or self._shadow.shadow_dir != os.path.abspath(shadow_dir) \
+       or self._shadow.locations != locations:
+      self._shadow = ShadowTree(shadow_dir, locations)
+    return self._shadow
+
+
   def prepare_program(self):
     """
       Builds the representation of the program, and compiles all source files
@@ -86,34 +134,230 @@ class Instrumentation(object):
     return self.program is not None
 
 
-  def apply(self, visitor, rewrite=False):
+  def apply(self, visitor, rewrite=False, jobs=None, stream=None, selector=None):
     """
       Runs the visitor over all matching types (e.g., MethodDeclaration, etc.).
 
-      :param visitor: The instance of the visitor to run over the program.
+      When ``jobs`` is greater than 1, the bytecode files are instrumented in a pool
+      of worker processes. The visitor is then shipped to the workers either by its
+      import path (e.g., ``'mypackage.visitors:CounterVisitor'``, instantiated without
+      arguments in each worker), or pickled when an instance is supplied. At most
+      ``max-in-flight`` files (option, defaults to twice the number of jobs) are
+      submitted to the pool at a time.
+
+      In streaming mode, the bytecode files are discovered (and compiled if needed)
+      while the instrumentation runs, and the representation of each module is released
+      as soon as it is written. The memory used is then bounded by the largest modules
+      being processed, not by the size of the program.
+
+      The outcome for each file is recorded in ``results`` (``True`` when the pyc was
+      rewritten). A file that fails to be instrumented does not stop the others: the
+      traceback is logged and recorded in ``errors``, whether the file was processed
+      serially or in a worker. Both are keyed by the path of the bytecode file.
+
+      When the ``shadow-dir`` option is set and the files are rewritten, the whole
+      program is first mirrored in the ``ShadowTree``, so the modules that are not
+      instrumented and the data files are available in both trees.
+
+      :param visitor: The instance of the visitor to run over the program, or the
+                      import path of its class. A list of visitors (or import paths)
+                      is run in a single traversal of each module, see
+                      ``CompositeVisitor``.
       :param rewrite: Whether the instrumentation should overwrite the bytecode
                       file (pyc) at the end. Default is `False`.
+      :param jobs: The number of worker processes. Defaults to the ``jobs`` option,
+                   or 1 if it is not set.
+      :param stream: Whether to run in streaming mode. Defaults to the ``stream``
+                     option.
+      :param selector: A ``Selector`` (or its string form) of the modules and
+                       declarations to instrument. The modules without matching
+                       declarations are not decoded.
     """
     self.apply_ran = True
-    bytecode_files = self.program.bytecode_files
+    self.results = {}
+    self.errors = {}
+
+    if jobs is None:
+      jobs = self.get_option('jobs') or 1
+    if stream is None:
+      stream = bool(self.get_option('stream'))
+    if isinstance(selector, basestring):
+      selector = Selector.parse(selector)
+
+    shadow = self.shadow if rewrite else None
+    if shadow is not None:
+      shadow.populate()
+
+    if stream:
+      bytecode_files = self.program.iter_bytecode_files()
+    else:
+      bytecode_files = self.program.bytecode_files
+
+    if jobs > 1:
+      self.__apply_parallel(visitor, bytecode_files, rewrite, jobs, stream, selector)
+      return
+
+    visitor = Instrumentation.load_visitors(visitor)
     for bc_file in bytecode_files:
-      self.instrument(visitor, bc_file, rewrite)
+      try:
+        self.results[bc_file] = self.instrument(visitor, bc_file, rewrite, release=stream,
+                                                selector=selector)
+      except Exception:
+        error = traceback.format_exc()
+        logger.error("Cannot instrument %s:\n%s", bc_file, error)
+        self.results[bc_file] = False
+        self.errors[bc_file] = error
+
+
+  def __apply_parallel(self, visitor, bytecode_files, rewrite, jobs, release, selector):
+    if isinstance(visitor, basestring) \
+       or (isinstance(visitor, (list, tuple)) and all(isinstance(v, basestring) for v in visitor)):
+      visitor_payload = (True, visitor)
+    else:
+      try:
+        visitor_payload = (False, pickle.dumps(visitor, pickle.HIGHEST_PROTOCOL))
+      except Exception, ex:
+        raise Exception('Cannot pickle visitor %s (%s), use its import path instead'
+                        % (visitor, ex))
+
+    state = (self._location, self.options, self.wrapping_code)
+    max_in_flight = max(self.get_option('max-in-flight') or 2 * jobs, 1)
+
+    def collect(async_result):
+      bc_file, written, error = async_result.get()
+      self.results[bc_file] = written
+      if error is not None:
+        logger.error("Cannot instrument %s:\n%s", bc_file, error)
+        self.errors[bc_file] = error
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+      # The results are collected in submission order, so they are deterministic
+      # regardless of which worker finished first.
+      pending = deque()
+      for bc_file in bytecode_files:
+        if len(pending) >= max_in_flight:
+          collect(pending.popleft())
+        task = (bc_file, visitor_payload, rewrite, release, selector, state)
+        pending.append(pool.apply_async(_instrument_worker, (task,)))
+      while pending:
+        collect(pending.popleft())
+      pool.close()
+    except:
+      pool.terminate()
+      raise
+    finally:
+      pool.join()
+
+
+  def get_module_name(self, bytecode_file):
+    """
+      Returns the full name of the module of ``bytecode_file``, relative to the
+      location that contains it (e.g., ``payments.handlers``).
+    """
+    locations = self._location
+    if isinstance(locations, basestring):
+      locations = (locations,)
+    path = os.path.abspath(bytecode_file)
+    for location in locations or ():
+      location = os.path.abspath(location)
+      if path.startswith(location + os.sep):
+        path = path[len(location) + 1:]
+        break
+    else:
+      path = os.path.basename(path)
+    module_name = os.path.splitext(path)[0].replace(os.sep, '.')
+    if module_name.endswith('.__init__'):
+      module_name = module_name[:-len('.__init__')]
+    return module_name
+
+
+  @staticmethod
+  def load_visitor(visitor_path):
+    """
+      Imports and instantiates the visitor class from its import path. Both
+      ``'package.module:ClassName'`` and ``'package.module.ClassName'`` are accepted.
+
+      :param visitor_path: The import path of the visitor class.
+    """
+    if ':' in visitor_path:
+      module_name, class_name = visitor_path.split(':', 1)
+    else:
+      module_name, class_name = visitor_path.rsplit('.', 1)
+    module = __import__(module_name, fromlist=[class_name])
+    return getattr(module, class_name)()
 
 
-  def instrument(self, visitor, bytecode_file, rewrite=False):
+  @staticmethod
+  def load_visitors(visitor):
+    """
+      Resolves the import paths in ``visitor``, which is either a visitor, an import
+      path, or a list of them. A list is returned as a ``CompositeVisitor``.
+    """
+    if isinstance(visitor, basestring):
+      return Instrumentation.load_visitor(visitor)
+    if isinstance(visitor, (list, tuple)):
+      return CompositeVisitor([Instrumentation.load_visitor(v) if isinstance(v, basestring) else v \
+                               for v in visitor])
+    return visitor
+
+
+  def instrument(self, visitor, bytecode_file, rewrite=False, release=False, selector=None):
     """
       Loads the representation of the bytecode in `bytecode_file`, and apply
       the visitor to the representation.
 
+      When the ``cache-dir`` option is set and the file is rewritten, the result
+      is looked up in the ``InstrumentationCache`` first, in which case the visitor
+      is not executed. When the ``shadow-dir`` option is set, the file is rewritten
+      in the instrumented tree of the ``ShadowTree``.
+
       :param visitor: The instance of the visitor to run over the representation
                       of the bytecode.
       :param bytecode_file: Absolute path of the file containing the bytecode (pyc).
       :param rewrite: Whether the instrumentation should overwrite the bytecode
                       file (pyc) at the end. Default is `False`.
+      :param release: Whether to release the representation of the bytecode once the
+                      instrumentation is done. The declarations handed to the visitor
+                      cannot be used afterwards. Default is `False`.
+      :param selector: A ``Selector`` of the declarations to instrument. The module is
+                       skipped when it does not contain any matching declaration.
+
+      Returns ``True`` if the bytecode file was rewritten.
     """
     logger.debug("File: %s", bytecode_file)
-    code = BytecodeObject(bytecode_file)
-    code.accept(visitor)
+    output_file = bytecode_file
+    shadow = self.shadow if rewrite else None
+    if shadow is not None:
+      output_file = shadow.prepare(bytecode_file)
+
+    if selector is not None and not selector.matches_module(self.get_module_name(bytecode_file)):
+      return False
+
+    cache = self.cache if rewrite else None
+    if cache is not None:
+      cache_key = cache.make_key(bytecode_file, visitor, self.wrapping_code, selector)
+      if cache_key is None:
+        cache = None
+      else:
+        restored = cache.restore(cache_key, output_file)
+        if restored is not None:
+          return restored
+
+    visitors = visitor
+    if selector is not None:
+      visitors = CompositeVisitor(visitor if isinstance(visitor, (list, tuple)) else [visitor],
+                                  selector=selector)
+
+    written = False
+    code = BytecodeObject(bytecode_file, lazy_decode=bool(self.get_option('lazy-decode')))
+    if selector is not None:
+      code_object = code.read()
+      if not selector.select_code(code_object):
+        logger.debug("No selected declaration in %s", bytecode_file)
+        return False
+      code.parse_code(code_object)
+    code.accept(visitors)
 
     if rewrite:
       if self.wrapping_code['on_enter']:
@@ -122,8 +366,16 @@ class Instrumentation(object):
       if self.wrapping_code['on_exit']:
         code.add_exit_code(*self.wrapping_code['on_exit'])
 
+      code.commit()
       if code.has_changes:
-        code.write()
+        written = bool(code.write(output_file))
+
+      if cache is not None:
+        cache.store(cache_key, output_file, written, visitor, self.wrapping_code, selector)
+
+    if release:
+      code.release()
+    return written
 
 
   def on_enter(self, python_code, import_code=None):
@@ -196,3 +448,25 @@ class Instrumentation(object):
       # Print the bytecode for each method
       simple_visitor = SimpleMethodVisitor()
       code.accept(simple_visitor)
+
+
+def _instrument_worker(task):
+  """
+    Entry point of the worker processes used by ``Instrumentation.apply``. It
+    rebuilds the instrumentation state and instruments one bytecode file.
+  """
+  bc_file, (by_path, visitor_payload), rewrite, release, selector, state = task
+  location, options, wrapping_code = state
+  try:
+    if by_path:
+      visitor = Instrumentation.load_visitors(visitor_payload)
+    else:
+      visitor = Instrumentation.load_visitors(pickle.loads(visitor_payload))
+
+    instr = Instrumentation(location)
+    instr.options = dict(options)
+    instr.wrapping_code = dict(wrapping_code)
+    written = instr.instrument(visitor, bc_file, rewrite, release, selector)
+    return bc_file, written, None
+  except Exception:
+    return bc_file, False, traceback.format_exc()
@@ -9,10 +9,13 @@
   :license: Apache 2, see LICENSE for more details.
 """
 import os
-import compileall
+import imp
+import struct
+import py_compile
+import multiprocessing
 
 from .utils.log import logger
-from .utils.files import scan_dir
+from .utils.files import iter_files
 
 
 class Program(object):
@@ -33,16 +36,15 @@ class Program(object):
   def create_program(self, skip_rebuild=False):
     """
       Creates the structure of the program with its source files and
-      binary files. When the ``Instrument`` option ``force-rebuild``
+      binary files. The sources with a missing or out-of-date bytecode file
+      are compiled. When the ``Instrument`` option ``force-rebuild``
       is set, it will trigger the compilation of all python source files.
 
       :param skip_rebuild: Force skipping the build. Mostly here due to the
                            recursive nature of this function.
     """
-    self.program_files = []
+    self.program_files = list(self.iter_program_files(('py', 'pyc')))
     self._bytecode_files = []
-    for location in self.input_location:
-      scan_dir(location, self.program_files, ('py', 'pyc'))
 
     # Do we need to compile all the files?
     py_files, pyc_files = Program.split_program_source_bc(self.program_files)
@@ -50,20 +52,118 @@ class Program(object):
     logger.debug("Force rebuilding? %s", self.options.get('force-rebuild'))
 
     if not skip_rebuild:
-      if len(py_files) != len(pyc_files) or self.instrumentation.get_option('force-rebuild'):
-        self.compile_program()
+      if self.instrumentation.get_option('force-rebuild'):
+        self.compile_program(py_files)
+        return
+      stale_files = Program.find_stale_sources(py_files)
+      if stale_files:
+        self.compile_program(stale_files)
+        return
+
+    self._bytecode_files = list(pyc_files)
+    logger.debug("Bytecode := %s", pyc_files)
+
+
+  def compile_program(self, source_files=None):
+    """
+      Compiles the program. The compilation runs in a pool of worker processes
+      when the ``jobs`` option is greater than 1.
+
+      :param source_files: The list of source files to compile. Defaults to all
+                           the source files of the program.
+    """
+    if source_files is None:
+      source_files = list(self.iter_program_files(('py',)))
+
+    jobs = self.instrumentation.get_option('jobs') or 1
+    logger.debug("Compiling %d source files (jobs=%d)", len(source_files), jobs)
+
+    if jobs > 1 and len(source_files) > 1:
+      pool = multiprocessing.Pool(min(jobs, len(source_files)))
+      try:
+        errors = pool.map(_compile_worker, source_files)
+        pool.close()
+      except:
+        pool.terminate()
+        raise
+      finally:
+        pool.join()
     else:
-      self._bytecode_files = list(pyc_files)
-      logger.debug("Bytecode := %s", pyc_files)
+      errors = [_compile_worker(source_file) for source_file in source_files]
 
+    for error in errors:
+      if error is not None:
+        logger.error("Compilation error: %s", error)
 
-  def compile_program(self):
+    self.create_program(skip_rebuild=True)
+
+
+  def iter_program_files(self, l_ext=None):
     """
-      Compiles the program.
+      Lazily yields the files of the program, as filtered by the ``include``
+      and ``exclude`` options of the ``Instrument``.
+
+      :param l_ext: The list of accepted file extensions. Defaults to all files.
     """
+    include = self.instrumentation.get_option('include')
+    exclude = self.instrumentation.get_option('exclude')
+    seen = set()
     for location in self.input_location:
-      compileall.compile_dir(location, quiet=True)
-    self.create_program(skip_rebuild=True)
+      for program_file in iter_files(location, l_ext, include, exclude):
+        if program_file not in seen:
+          seen.add(program_file)
+          yield program_file
+
+
+  def iter_bytecode_files(self):
+    """
+      Lazily yields the bytecode files of the program. Contrary to ``bytecode_files``,
+      the list of files is never built: the sources are compiled one at a time, as
+      they are encountered, when they are out-of-date (or always if the ``Instrument``
+      option ``force-rebuild`` is set).
+    """
+    force_rebuild = self.instrumentation.get_option('force-rebuild')
+    yielded = set()
+    for program_file in self.iter_program_files(('py', 'pyc')):
+      if program_file.lower().endswith('.py'):
+        if force_rebuild or Program.is_stale(program_file):
+          error = _compile_worker(program_file)
+          if error is not None:
+            logger.error("Compilation error: %s", error)
+        program_file += 'c'
+        if not os.path.isfile(program_file):
+          continue
+      if program_file not in yielded:
+        yielded.add(program_file)
+        yield program_file
+
+
+  @staticmethod
+  def is_stale(source_file):
+    """
+      Returns ``True`` if the bytecode file of ``source_file`` is missing, or if
+      its header does not match the current interpreter and the modification time
+      of the source.
+
+      :param source_file: The path of the python source file.
+    """
+    try:
+      with open(source_file + 'c', 'rb') as fd:
+        header = fd.read(8)
+      source_mtime = long(os.stat(source_file).st_mtime)
+    except (IOError, OSError):
+      return True
+    if len(header) != 8 or header[:4] != imp.get_magic():
+      return True
+    return struct.unpack('<L', header[4:])[0] != (source_mtime & 0xFFFFFFFFL)
+
+
+  @staticmethod
+  def find_stale_sources(py_files):
+    """
+      Returns the source files that need to be compiled.
+    """
+    return [f for f in py_files if Program.is_stale(f)]
 
 
   @property
@@ -85,3 +185,15 @@ class Program(object):
     return py_files, pyc_files
 
 
+def _compile_worker(source_file):
+  """
+    Compiles one source file. Returns the error message if the compilation
+    failed, ``None`` otherwise.
+  """
+  try:
+    py_compile.compile(source_file, doraise=True)
+  except py_compile.PyCompileError, ex:
+    return ex.msg
+  except (IOError, OSError), ex:
+    return '%s: %s' % (source_file, ex)
+  return None
@@ -10,10 +10,14 @@
   :copyright: (c) 2014 by Romain Gaucher (@rgaucher)
   :license: Apache 2, see LICENSE for more details.
 """
+import math
+import marshal
+import hashlib
 import opcode
 import types
 from dis import findlinestarts
 from array import array
+from bisect import bisect_left, bisect_right
 
 from ..utils.log import logger
 from ..analysis.python.opcodes import *
@@ -36,6 +40,10 @@ PLACEHOLDER = -2
 #: as specified by the ``RETURN_INSTR_TEMPLATE``.
 RETURN_CANARY_NAME = '_______0x42024_retvalue' # yeah...
 
+#: Prefix of the constants added to ``co_consts`` to mark the instrument code
+#: merged in a code object. See ``Merger.get_probe_marker``.
+PROBE_MARKER_PREFIX = '_______0x42024_probe:'
+
 
 #: The template that dictates how return values are being captured.
 RETURN_INSTR_TEMPLATE = (
@@ -45,6 +53,80 @@ RETURN_INSTR_TEMPLATE = (
 )
 
 
+def get_constant_key(value):
+  """
+    Returns the key of a constant in the ``co_consts`` pool. The constants that are
+    equal but have different types (e.g., ``0``, ``0.0`` and ``False``), or a
+    different sign of zero, get different keys. The code objects are compared by
+    identity.
+  """
+  if isinstance(value, types.CodeType):
+    return (types.CodeType, id(value))
+  elif isinstance(value, float):
+    return (float, value, math.copysign(1.0, value))
+  elif isinstance(value, complex):
+    return (complex, value, math.copysign(1.0, value.real), math.copysign(1.0, value.imag))
+  elif isinstance(value, tuple):
+    return (tuple, tuple(get_constant_key(val) for val in value))
+  return (type(value), value)
+
+
+class Pool(object):
+  """
+    The values of a tuple field of the code object (e.g., ``co_consts``) during a
+    merge, indexed by key so that adding and finding a value takes constant time.
+    The values are frozen back to a tuple by ``to_tuple``.
+  """
+
+  def __init__(self, values, key=None):
+    """
+      :param values: The initial values (e.g., the field of the original code object).
+      :param key: The function that computes the key of a value. Defaults to the value.
+    """
+    self.key = key
+    self.values = []
+    self.indices = {}
+    for value in values:
+      self.indices.setdefault(self.get_key(value), len(self.values))
+      self.values.append(value)
+
+
+  def get_key(self, value):
+    return self.key(value) if self.key is not None else value
+
+
+  def add(self, value):
+    """
+      Appends the ``value`` if it is not in the pool yet. Returns its index.
+    """
+    key = self.get_key(value)
+    index = self.indices.get(key)
+    if index is None:
+      index = self.indices[key] = len(self.values)
+      self.values.append(value)
+    return index
+
+
+  def index(self, value):
+    try:
+      return self.indices[self.get_key(value)]
+    except KeyError:
+      raise ValueError('%r is not in the pool' % (value,))
+
+
+  def __contains__(self, value):
+    return self.get_key(value) in self.indices
+
+
+  def __len__(self):
+    return len(self.values)
+
+
+  def to_tuple(self):
+    return tuple(self.values)
+
+
+
 class CodeObject(object):
   """
     Class responsible for merging two code objects, and generating a new one.
@@ -57,13 +139,19 @@ class CodeObject(object):
 
     self.co_origin = co_origin
     self.fields = dict(zip(CO_FIELDS, [getattr(self.co_origin, f) for f in CO_FIELDS]))
+    # The tuple fields are merged in pools, and frozen back in ``fields`` by ``to_code``
+    self.pools = {}
+    for f in CodeObject.POOL_FIELDS:
+      self.pools[f] = Pool(self.fields[f], key=get_constant_key if f == 'co_consts' else None)
     self.code = array('B')
     self.linestarts = dict(findlinestarts(co_origin))
 
     self.lnotab = array('B')
     self.append_code = self.code.append
     self.insert_code = self.code.insert
-    self.prev_lineno = -1
+    # Offset and line number of the last entry of the lnotab
+    self.lnotab_offset = 0
+    self.lnotab_lineno = co_origin.co_firstlineno
 
     # Used for conversion from a LOAD_NAME in the probe code to a LOAD_FAST
     # in the final bytecode if the names are variable names (in co_varnames)
@@ -85,6 +173,10 @@ class CodeObject(object):
     self.name_to_global.add(global_name)
 
 
+  #: List of fields in the code_object that are tuples of values referenced by the
+  #: bytecode.
+  POOL_FIELDS = ('co_consts', 'co_names', 'co_varnames', 'co_freevars', 'co_cellvars')
+
   #: List of fields in the code_object not to merge. We only keep the ones from
   #: the original code_object.
   MERGE_BACKLIST = ('co_code', 'co_firstlineno', 'co_name', 'co_filename',
@@ -112,22 +204,20 @@ class CodeObject(object):
                                   + 1 # for the return value `RETURN_CANARY_NAME`
       elif f == 'co_names':
         for co_name in getattr(co_other, 'co_names'):
-          if co_name not in self.fields['co_varnames']:
-            self.fields['co_names'] = self.fields['co_names'] + (co_name,)
+          if co_name not in self.pools['co_varnames']:
+            self.pools['co_names'].add(co_name)
           else:
-            # self.fields['co_varnames'] = self.fields['co_varnames'] + (co_name,)
             self.name_to_fast.add(co_name)
       else:
         # Should only be tuples
-        tpl_other = getattr(co_other, f)
+        pool = self.pools[f]
         # We need to keep the ordering, as it matters for the formal parameters
         # which are the first...
-        for val in tpl_other:
-          if val not in self.fields[f]:
-            self.fields[f] = self.fields[f] + (val,)
+        for val in getattr(co_other, f):
+          pool.add(val)
 
-        if f == 'co_varnames' and RETURN_CANARY_NAME not in self.fields[f]:
-          self.fields[f] = self.fields[f] + (RETURN_CANARY_NAME,)
+        if f == 'co_varnames':
+          pool.add(RETURN_CANARY_NAME)
 
 
   def reset_code(self):
@@ -135,6 +225,8 @@ class CodeObject(object):
     self.lnotab = array('B')
     self.append_code = self.code.append
     self.insert_code = self.code.insert
+    self.lnotab_offset = 0
+    self.lnotab_lineno = self.fields['co_firstlineno']
 
 
   def append(self, op, arg, bc_index=-1, lineno=-1):
@@ -191,47 +283,57 @@ class CodeObject(object):
     """
       Writes the bytecode and lnotab.
     """
-    bytecode_inc, line_inc = 0, -1
+    offset = len(self.code)
 
     if op >= opcode.HAVE_ARGUMENT and oparg > 0xffff:
       self.append_code(opcode.EXTENDED_ARG)
       self.append_code((oparg >> 16) & 0xff)
       self.append_code((oparg >> 24) & 0xff)
-      bytecode_inc += 3
 
     self.append_code(op)
-    bytecode_inc += 1
 
     if op >= opcode.HAVE_ARGUMENT:
       self.append_code(oparg & 0xff)
       self.append_code((oparg >> 8) & 0xff)
-      bytecode_inc += 2
 
-    # We also adjust the lnotabs field
-    if self.prev_lineno == -1:
-      line_inc = 0
-    else:
-      line_inc = lineno - self.prev_lineno
+    # We also adjust the lnotab field
+    self.add_lnotab_entry(offset, lineno)
 
-    if line_inc == 0 and bytecode_inc == 0:
-      self.lnotab.append(0)  # bytecode increment
-      self.lnotab.append(0)  # lineno increment
-    else:
-      while bytecode_inc > 255:
+
+  def add_lnotab_entry(self, offset, lineno):
+    """
+      Maps the instructions from ``offset`` to the line ``lineno`` in the lnotab. Like
+      the compiler, an entry is only added when the line number increases; the lnotab
+      cannot represent a line number that decreases, so the previous line is kept.
+
+      :param offset: The offset of the instruction in the new bytecode.
+      :param lineno: The line number of the instruction.
+    """
+    bytecode_inc = offset - self.lnotab_offset
+    line_inc = lineno - self.lnotab_lineno
+    if line_inc <= 0:
+      return
+
+    # Split the increments that do not fit in a byte, as in the compiler
+    if bytecode_inc > 255:
+      for _ in xrange(bytecode_inc // 255):
         self.lnotab.append(255)
         self.lnotab.append(0)
-        bytecode_inc -= 255
+      bytecode_inc %= 255
 
-      while line_inc > 255:
+    if line_inc > 255:
+      self.lnotab.append(bytecode_inc)
+      self.lnotab.append(255)
+      bytecode_inc = 0
+      for _ in xrange(1, line_inc // 255):
         self.lnotab.append(0)
         self.lnotab.append(255)
-        line_inc -= 255
-
-      # Add the remainder
-      self.lnotab.append(bytecode_inc)
-      self.lnotab.append(line_inc)
+      line_inc %= 255
 
-    self.prev_lineno = lineno
+    self.lnotab.append(bytecode_inc)
+    self.lnotab.append(line_inc)
+    self.lnotab_offset = offset
+    self.lnotab_lineno = lineno
 
 
   def get_instruction_size(self, op, arg=None, bc_index=0):
@@ -239,7 +341,8 @@ class CodeObject(object):
     if op < opcode.HAVE_ARGUMENT:
       return 1
     if oparg > 0xffff:
-      return 5
+      # EXTENDED_ARG prefix
+      return 6
     return 3
 
 
@@ -263,20 +366,27 @@ class CodeObject(object):
 
 
   def add_get_cellvars_freevars(self, varname):
-    if varname in self.fields['co_cellvars']:
-      return self.fields['co_cellvars'].index(varname)
-    elif varname in self.fields['co_freevars']:
-      return self.fields['co_freevars'].index(varname)
-    else:
-      return self.add_get_tuple(varname, 'co_freevars')
+    # The free variables are indexed after the cell variables
+    cellvars = self.pools['co_cellvars']
+    if varname in cellvars:
+      return cellvars.index(varname)
+    return len(cellvars) + self.add_get_tuple(varname, 'co_freevars')
+
+  def add_marker(self, marker):
+    """
+      Adds the constant ``marker`` to ``co_consts``. It is not referenced by the bytecode.
+    """
+    self.pools['co_consts'].add(marker)
 
   # This is now just a getter since all fields have been merged already
   def add_get_tuple(self, value, field_name):
-    return self.fields[field_name].index(value)
+    return self.pools[field_name].index(value)
 
 
   # Create a new code_object with the info from this class
   def to_code(self):
+    for f in CodeObject.POOL_FIELDS:
+      self.fields[f] = self.pools[f].to_tuple()
     return types.CodeType(self.fields['co_argcount'], self.fields['co_nlocals'],
                           self.fields['co_stacksize'], self.fields['co_flags'],
                           self.code.tostring(), self.fields['co_consts'],
@@ -342,8 +452,14 @@ class Merger(object):
     if not co_input:
       raise Exception('Input code_object is None')
 
+    marker = Merger.get_probe_marker(co_input, location, ins_lineno, ins_offset)
+    if Merger.is_marked(co_source, marker):
+      logger.debug("Already instrumented code object. Skipping")
+      return
+
     new_co = CodeObject(co_source)
     new_co.merge_fields(co_input)
+    new_co.add_marker(marker)
     new_co.reset_code()
 
     bc_source = BytecodeObject.get_parsed_code(co_source)
@@ -363,11 +479,6 @@ class Merger(object):
     if location == Merger.MODULE_EXIT:
       new_bytecode = Merger.merge_exit(new_co, bc_source, bc_input, ins_import_names)
     else:
-
-      if Merger.already_instrumented(bc_source, bc_input):
-        logger.debug("Already instrumented code object. Skipping")
-        return
-
       # list [(bc elements), instrument_code frame counter)]
       bytecode = Merger.get_final_bytecode(bc_source, bc_input,
                                            co_source, co_input,
@@ -388,6 +499,62 @@ class Merger(object):
     return final_new_co
 
 
+  @staticmethod
+  def merge_all(co_source, insertions, ins_import_names=None):
+    """
+      Merges several instrument code objects in one pass: the fields are merged, the
+      jumps resolved and the new code object created only once. The result is the
+      same as merging the insertions one after the other, except that an insertion
+      is not checked against the other ones for being already instrumented (see
+      ``get_probe_marker``).
+
+      Several insertions ``BEFORE`` are inlined in the reverse order (the last one
+      runs first), and several insertions ``AFTER`` are inlined in order, like
+      successive merges do. The ``MODULE_EXIT`` insertions are merged afterwards.
+
+      Returns ``None`` when no insertion was applied.
+
+      :param co_source: The original code object.
+      :param insertions: The list of ``(co_input, location, ins_lineno, ins_offset)``.
+      :param ins_import_names: The names imported by the instrument code.
+    """
+    new_co = CodeObject(co_source)
+
+    inputs = []
+    exit_insertions = []
+    for co_input, location, ins_lineno, ins_offset in insertions:
+      if not co_input:
+        raise Exception('Input code_object is None')
+      if location == Merger.MODULE_EXIT:
+        exit_insertions.append((co_input, location, ins_lineno, ins_offset))
+        continue
+      marker = Merger.get_probe_marker(co_input, location, ins_lineno, ins_offset)
+      if Merger.is_marked(co_source, marker):
+        logger.debug("Already instrumented code object. Skipping")
+        continue
+      bc_input = BytecodeObject.get_parsed_code(co_input)[:-2]
+      new_co.merge_fields(co_input)
+      new_co.add_marker(marker)
+      inputs.append((bc_input, location, ins_lineno, ins_offset))
+
+    final_new_co = None
+    if inputs:
+      bc_source = BytecodeObject.get_parsed_code(co_source)
+      new_co.reset_code()
+      for name in ins_import_names or ():
+        new_co.add_global_name(name)
+
+      bytecode = Merger.get_batch_bytecode(bc_source, co_source, inputs)
+      for bc_tpl in Merger.resolve_jump_targets(bytecode, new_co):
+        new_co.append(bc_tpl[0][2], bc_tpl[0][3], bc_tpl[0][0], bc_tpl[0][1])
+      final_new_co = new_co.to_code()
+
+    for co_input, location, ins_lineno, ins_offset in exit_insertions:
+      final_new_co = Merger.merge(final_new_co or co_source, co_input, location,
+                                  ins_lineno, ins_offset, ins_import_names) or final_new_co
+    return final_new_co
+
+
   @staticmethod
   def merge_exit(new_co, bc_source, bc_input, ins_import_names=None):
     """
@@ -403,7 +570,7 @@ class Merger(object):
     i = 0
     while i < length:
       current_index, lineno, op, arg, cflow_in, code_object = bc_source[i]
-      if code_object != co_source:
+      if code_object is not co_source:
         i += 1
         continue
 
@@ -445,10 +612,38 @@ class Merger(object):
     return new_bytecode
 
 
+  @staticmethod
+  def get_probe_marker(co_input, location=UNKNOWN, ins_lineno=-1, ins_offset=-1):
+    """
+      Returns the marker of the instrument code ``co_input`` inserted at ``location``.
+      The marker is added to the ``co_consts`` of the instrumented code object, so
+      that the same insertion is skipped when the code object is instrumented again.
+      It contains a digest of the serialized instrument code object.
+
+      :param co_input: The instrument code object.
+      :param location: The location of the instrumentation (e.g., ``BEFORE``).
+      :param ins_lineno: The line number of the insertion, if any.
+      :param ins_offset: The bytecode offset of the insertion, if any.
+    """
+    digest = hashlib.sha1(marshal.dumps(co_input)).hexdigest()
+    return '%s%s:%d:%d:%d' % (PROBE_MARKER_PREFIX, digest, location, ins_lineno, ins_offset)
+
+
+  @staticmethod
+  def is_marked(co_source, marker):
+    """
+      Checks if the insertion of ``marker`` (see ``get_probe_marker``) was already
+      merged in ``co_source``, without decoding its bytecode.
+    """
+    return marker in co_source.co_consts
+
+
   @staticmethod
   def already_instrumented(bc_source, bc_input):
     """
-      Checks if the instrumentation in bc_input is already in bc_source
+      Checks if the instrumentation in bc_input is already in bc_source, by searching
+      the instructions of ``bc_input`` in ``bc_source``. The merges use the markers
+      of the probes instead (see ``get_probe_marker``).
     """
     op_arg_source = [(tpl[2], tpl[3]) for tpl in bc_source if tpl[2] not in opcode.hasjabs]
     op_arg_input = [(tpl[2], tpl[3]) for tpl in bc_input if tpl[2] not in opcode.hasjabs]
@@ -481,73 +676,113 @@ class Merger(object):
       jump address (resp. offset) can change and we need to track the changes to find
       the new targets.
 
-      The resolver works in two phases:
+      The resolver works in three phases:
 
-      1. Create the list of bytecode indices based on the size of the
-         opcode and its argument.
+      1. Index the positions of the instructions by segment (the original bytecode,
+         or one instance of the instrument bytecode) and original offset.
       2. For each jump opcode, take its argument and resolve it in the same
-         part of the bytecode (e.g., instrument bytecode or original bytecode).
+         segment. A target outside of the segment (e.g., the end of the instrument
+         code) is resolved at the same distance in the final bytecode.
+      3. Compute the offsets of the final bytecode. A jump argument larger than
+         0xffff requires an ``EXTENDED_ARG`` prefix, which moves the next instructions,
+         so the offsets are computed again until no jump grows.
+
+      The ``EXTENDED_ARG`` of the original bytecode are dropped, as the prefixes are
+      emitted by the ``CodeObject`` from the new arguments.
 
       :param bytecode: The structure computed by ``get_final_bytecode`` which overlays
                        the final bytecode sequences and its origin.
       :param new_co: The currently created ``CodeObject``.
     """
-    new_bytecode = []
-    bc_indices = Merger.build_bytecode_offsets(new_co, bytecode)
-    length = len(bc_indices)
+    length = len(bytecode)
+    sizes = [0] * length
+    # (segment, original offset) -> positions in the final bytecode
+    segment_positions = {}
+    jumps = []
+    for j in xrange(length):
+      index, _, op, arg, _, _ = bytecode[j][0]
+      key = (bytecode[j][1], index)
+      if op == EXTENDED_ARG:
+        # A jump to the prefix lands on the prefixed instruction
+        segment_positions.setdefault(key, []).append(j + 1)
+        continue
+      segment_positions.setdefault(key, []).append(j)
+      if CodeObject.is_jump_op(op):
+        jumps.append(j)
+        sizes[j] = 3
+      else:
+        sizes[j] = new_co.get_instruction_size(op=op, arg=arg, bc_index=index)
+
+    bc_indices = Merger.get_bytecode_offsets(sizes)
+    # new offset -> position in the final bytecode
+    bc_positions = dict((bc_indices[j], j) for j in xrange(length) if sizes[j] > 0)
 
-    def find_target_index(target, j, instr_counter, current_index, op):
-      direction = 1
-      is_absolute = False
+    def find_target_index(j):
+      index, _, op, arg, _, _ = bytecode[j][0]
       if op in opcode.hasjabs:
-        direction = 1 if target > current_index else -1
-        is_absolute = True
+        target, increment = arg, arg - index
+        direction = 1 if target > index else -1
       else:
-        direction = 1 if target >= 0 else -1
-      bound = -1 if direction < 0 else length
+        target, increment = index + 3 + arg, arg + 3
+        direction = 1 if arg >= 0 else -1
 
       # Search in the same instrumentation code if the target address is
-      # already present. If so, we just return that one.
-      k = j
-      while k != bound:
-        if bytecode[k][0][0] == target and bytecode[k][1] == instr_counter:
-          return k
-        k += direction
+      # already present. If so, we take the closest one in the direction of
+      # the jump.
+      positions = segment_positions.get((bytecode[j][1], target))
+      if positions:
+        if direction > 0:
+          k = bisect_left(positions, j)
+          if k < len(positions):
+            return positions[k]
+        else:
+          k = bisect_right(positions, j)
+          if k > 0:
+            return positions[k - 1]
 
       # If we didn't find a match for the jump, we need to look outside of the
       # bounds of the same source code.
-      k = j
-      current_pos = bc_indices[j]
-      increment = (bytecode[j][0][3] - bytecode[j][0][0]) if is_absolute else (bytecode[j][0][3] + 3)
-      idx = bc_indices.index(current_pos + increment)
-      return idx
+      return bc_positions[bc_indices[j] + increment]
 
+    targets = dict((j, find_target_index(j)) for j in jumps)
 
-    i = 0
-    for bc_tpl in bytecode:
-      op, arg, index, instr = bc_tpl[0][2], bc_tpl[0][3], bc_tpl[0][0], bc_tpl[1]
-      if not CodeObject.is_jump_op(op):
-        new_bytecode.append(((bc_indices[i], bc_tpl[0][1], bc_tpl[0][2], \
-                              bc_tpl[0][3], bc_tpl[0][4], bc_tpl[0][5]), \
-                             instr))
-      else:
-        new_address = -1
-        target_address = arg if op in opcode.hasjabs else (index + 3 + arg)
-        target_index = find_target_index(target_address, i, instr, index, op)
-
-        if op in opcode.hasjrel:
-          new_address = bc_indices[target_index] - bc_indices[i] - 3
+    new_args = {}
+    while True:
+      grown = False
+      for j in jumps:
+        if bytecode[j][0][2] in opcode.hasjrel:
+          new_args[j] = bc_indices[targets[j]] - bc_indices[j] - sizes[j]
         else:
-          new_address = bc_indices[target_index]
-
-        new_bytecode.append(((bc_indices[i], bc_tpl[0][1], bc_tpl[0][2], \
-                              new_address, bc_tpl[0][4], bc_tpl[0][5]), \
-                             instr))
-      i += 1
+          new_args[j] = bc_indices[targets[j]]
+        if new_args[j] > 0xffff and sizes[j] == 3:
+          sizes[j] = 6
+          grown = True
+      if not grown:
+        break
+      # The offsets only grow, so a jump that needs a prefix keeps it
+      bc_indices = Merger.get_bytecode_offsets(sizes)
 
+    new_bytecode = []
+    for j in xrange(length):
+      if sizes[j] == 0:
+        continue
+      bc_tpl = bytecode[j]
+      new_bytecode.append(((bc_indices[j], bc_tpl[0][1], bc_tpl[0][2], \
+                            new_args.get(j, bc_tpl[0][3]), bc_tpl[0][4], bc_tpl[0][5]), \
+                           bc_tpl[1]))
     return new_bytecode
 
 
+  @staticmethod
+  def get_bytecode_offsets(sizes):
+    bc_indices = []
+    current_size = 0
+    for size in sizes:
+      bc_indices.append(current_size)
+      current_size += size
+    return bc_indices
+
+
   @staticmethod
   def get_final_bytecode(bc_source, bc_input, co_source, co_input, \
                          location, ins_lineno, ins_offset=-1):
@@ -566,44 +801,66 @@ class Merger(object):
                          the injection location is ``LINENO``.
       :param ins_offset: Not used.
     """
+    return Merger.get_batch_bytecode(bc_source, co_source,
+                                     [(bc_input, location, ins_lineno, ins_offset)])
+
+
+  @staticmethod
+  def get_batch_bytecode(bc_source, co_source, inputs):
+    """
+      Computes the final sequences of opcodes for several instrument bytecodes. See
+      ``get_final_bytecode``.
+
+      :param bc_source: The bytecode of the orignal code.
+      :param co_source: The orignal code object.
+      :param inputs: The list of ``(bc_input, location, ins_lineno, ins_offset)``, where
+                     ``bc_input`` is the instrument bytecode to inject.
+    """
     bytecode = []
     instr_counter = 0
 
+    # The code inserted before an instruction runs in the reverse order of the
+    # insertions, as each insertion is done in front of the previous ones.
+    before_inputs = [ins for ins in reversed(inputs) \
+                     if ins[1] in (Merger.BEFORE, Merger.MODULE_ENTER, Merger.LINENO)]
+    after_inputs = [ins for ins in inputs if ins[1] == Merger.AFTER]
+    instruction_inputs = [ins for ins in inputs if ins[1] == Merger.INSTRUCTION]
+    exit_inputs = [ins for ins in inputs if ins[1] == Merger.MODULE_EXIT]
+
     i, length = 0, len(bc_source)
     current_index, lineno = -1, -1
     while i < length:
       current_index, lineno, op, arg, cflow_in, code_object = bc_source[i]
-      if code_object != co_source:
+      if code_object is not co_source:
         i += 1
         continue
 
-      if location in (Merger.BEFORE, Merger.MODULE_ENTER) and i == 0:
-        instr_counter += 1
-        Merger.inline_instrument(bytecode, bc_input, lineno, instr_counter,
-                                 location=location)
+      for bc_input, location, ins_lineno, _ in before_inputs:
+        if (location != Merger.LINENO and i == 0) \
+           or (location == Merger.LINENO and lineno == ins_lineno):
+          instr_counter += 1
+          Merger.inline_instrument(bytecode, bc_input, lineno, instr_counter,
+                                   location=location)
 
-      elif location == Merger.LINENO and lineno == ins_lineno:
-        instr_counter += 1
-        Merger.inline_instrument(bytecode, bc_input, lineno, instr_counter,
-                                 location=location)
-
-      elif location == Merger.AFTER and op == RETURN_VALUE:
-        instr_counter += 1
-        Merger.inline_instrument(bytecode, bc_input, lineno, instr_counter,
-                                 template=RETURN_INSTR_TEMPLATE, location=location)
+      if op == RETURN_VALUE:
+        for bc_input, location, _, _ in after_inputs:
+          instr_counter += 1
+          Merger.inline_instrument(bytecode, bc_input, lineno, instr_counter,
+                                   template=RETURN_INSTR_TEMPLATE, location=location)
 
       # Append current code
       bytecode.append(((current_index, lineno, op, arg, cflow_in, code_object), -1))
 
-      if location == Merger.INSTRUCTION:
+      for bc_input, location, _, _ in instruction_inputs:
         instr_counter += 1
         Merger.inline_instrument(bytecode, bc_input, lineno, instr_counter,
                                  location=location)
 
-      if location == Merger.MODULE_EXIT and i == length - 3:
-        instr_counter += 1
-        Merger.inline_instrument(bytecode, bc_input, lineno, -1,
-                                 location=location)
+      if i == length - 3:
+        for bc_input, location, _, _ in exit_inputs:
+          instr_counter += 1
+          Merger.inline_instrument(bytecode, bc_input, lineno, -1,
+                                   location=location)
       i += 1
 
     return bytecode
@@ -10,7 +10,8 @@
   :license: Apache 2, see LICENSE for more details.
 """
 import os
-import copy
+import types
+from contextlib import contextmanager
 
 from ..utils.log import logger
 from ..bytecode.decl import ModuleDeclaration, \
@@ -33,6 +34,42 @@ if __name__ == '__main__':
 %s
 """
 
+class InsertionPlan(object):
+  """
+    The insertions recorded by a ``SimpleRewriter`` in batch mode, grouped by
+    declaration in the order they were recorded. Identical insertions (same
+    declaration, code and location) are only recorded once.
+  """
+
+  def __init__(self):
+    # [(target decl, [(co_input, location, ins_lineno, ins_offset)])]
+    self.targets = []
+    self._target_positions = {}
+    self._keys = set()
+
+
+  def add(self, target_decl, formatted_code, injected_co, \
+          location, ins_lineno=-1, ins_offset=-1):
+    key = (id(target_decl), formatted_code, location, ins_lineno, ins_offset)
+    if key in self._keys:
+      logger.debug("Skip duplicated insertion in %s", target_decl)
+      return False
+    self._keys.add(key)
+
+    position = self._target_positions.get(id(target_decl))
+    if position is None:
+      position = len(self.targets)
+      self._target_positions[id(target_decl)] = position
+      self.targets.append((target_decl, []))
+    self.targets[position][1].append((injected_co, location, ins_lineno, ins_offset))
+    return True
+
+
+  def __len__(self):
+    return len(self._keys)
+
+
+
 class SimpleRewriter(object):
   """
     The current main rewriter that works for one ``Declaration`` object. Using this
@@ -62,7 +99,6 @@ class SimpleRewriter(object):
 
   def __init__(self, decl):
     self.decl = decl
-    self.original_decl = copy.deepcopy(self.decl)
 
     self.module = None
     if isinstance(self.module, ModuleDeclaration):
@@ -71,6 +107,57 @@ class SimpleRewriter(object):
       self.module = self.decl.parent_module
 
     self.import_lives = set()
+    self.plan = None
+
+
+  def begin_batch(self):
+    """
+      Starts recording the insertions in an ``InsertionPlan`` instead of applying
+      them one by one. They are applied by ``apply_batch``.
+    """
+    if self.plan is None:
+      self.plan = InsertionPlan()
+    return self
+
+
+  def apply_batch(self):
+    """
+      Applies the recorded insertions: each declaration gets all its insertions
+      in one merge.
+    """
+    plan, self.plan = self.plan, None
+    if not plan:
+      return self
+
+    self.inspect_all_globals()
+    for target_decl, insertions in plan.targets:
+      new_co = Merger.merge_all(target_decl.code_object, insertions, self.import_lives)
+      if new_co:
+        self.replace_code_object(target_decl, new_co)
+    return self
+
+
+  @contextmanager
+  def batch(self):
+    """
+      Records the insertions done in the ``with`` block, and applies them at the end
+      of the block, with one merge per declaration::
+
+        with SimpleRewriter(meth_decl).batch() as rewriter:
+          rewriter.insert_import('import probes', module_import=True)
+          rewriter.insert_before('probes.enter({method_name!r})')
+          rewriter.insert_after('probes.exit({method_name!r})')
+
+      Identical insertions are only applied once. The insertions are discarded if
+      the block raises an exception.
+    """
+    self.begin_batch()
+    try:
+      yield self
+    except:
+      self.plan = None
+      raise
+    self.apply_batch()
 
 
   def insert_before(self, python_code):
@@ -106,11 +193,12 @@ class SimpleRewriter(object):
       the one of the current declaration object (``decl``). The insertion is done by
       the ``Merger``.
 
-      When the injection is done, this method will go and recursively update all
-      references to the old `code_object` in the parents (when a parent changes, it is
-      as well updated and its new ``code_object`` propagated upwards). This process is
-      required as Python's code objects are nested in parent's code objects, and they
-      are all read-only. This process breaks any references that were hold on previously
+      When the injection is done, all the references to the old `code_object` in the
+      parents need to be updated (when a parent changes, it is as well updated and its
+      new ``code_object`` propagated upwards). This process is required as Python's code
+      objects are nested in parent's code objects, and they are all read-only. The
+      parents are rebuilt once, when the ``BytecodeObject`` is committed (e.g., when it
+      is written). This process breaks any references that were hold on previously
       used code objects (e.g., don't do that when the instrumented code is running).
 
       :param python_code: The code to be formatted and inserted.
@@ -125,9 +213,6 @@ class SimpleRewriter(object):
     """
 
     target_decl = self.decl if not ins_module else self.module
-    original_decl = self.original_decl
-    if ins_module and not isinstance(original_decl, ModuleDeclaration):
-      original_decl = original_decl.parent_module
 
     formatted_code = SimpleRewriter.format_code(target_decl, python_code, location)
     injected_co = SimpleRewriter.get_code_object(formatted_code)
@@ -139,6 +224,11 @@ class SimpleRewriter(object):
       for import_stmt in import_stmts:
         self.import_lives = self.import_lives | import_stmt.live_names
 
+    if self.plan is not None:
+      self.plan.add(target_decl, formatted_code, injected_co,
+                    location, ins_lineno, ins_offset)
+      return self
+
     self.inspect_all_globals()
 
     working_co = target_decl.code_object
@@ -152,25 +242,39 @@ class SimpleRewriter(object):
     if not new_co:
       return self
 
+    self.replace_code_object(target_decl, new_co)
+    return self
+
+
+  def replace_code_object(self, target_decl, new_co):
+    """
+      Replaces the code object of ``target_decl`` by ``new_co``, and propagates the
+      change to the code objects of its parents. When the declaration belongs to a
+      ``BytecodeObject``, the parents are only rebuilt by ``BytecodeObject.commit``.
+    """
+    bytecode_object = target_decl.bytecode_object
+    if bytecode_object is not None:
+      bytecode_object.replace_code_object(target_decl, new_co)
+      return
+
     original_co = target_decl.code_object
     target_decl.code_object = new_co
     target_decl.has_changes = True
+    BytecodeObject.invalidate_parsed_code(original_co)
 
-    # Recursively apply this to the parent cos
+    # Recursively apply this to the parent cos. A parent nests the current code
+    # object of its child, so the code objects are read along the way.
     parent = target_decl.parent
-    original_parent = original_decl.parent
-
     while parent is not None:
       # inspect the parent cos and update the consts for
       # the original to the current sub-CO
+      original_parent_co = parent.code_object
+      BytecodeObject.invalidate_parsed_code(original_parent_co)
       parent.update_nested_code_object(original_co, new_co)
-      original_co = original_parent.code_object
+      original_co = original_parent_co
       new_co = parent.code_object
-      original_parent = original_parent.parent
       parent = parent.parent
 
-    return self
-
 
   def insert_import(self, import_code, module_import=True):
     """
@@ -237,12 +341,19 @@ class SimpleRewriter(object):
   def inspect_all_globals(self):
     if not self.module:
       return
-    co_module = self.module.code_object
-    bc_module = BytecodeObject.get_parsed_code(co_module)
-
-    for bc_tpl in bc_module:
-      if bc_tpl[2] == LOAD_GLOBAL:
-        self.import_lives.add(bc_tpl[3])
+    bytecode_object = self.module.bytecode_object
+    if bytecode_object is not None:
+      self.import_lives.update(bytecode_object.get_global_names())
+      return
+    # Decode each code object on its own, so the ones that did not change since
+    # the previous insertion are found in the decoding cache.
+    worklist = [self.module.code_object]
+    while worklist:
+      code_object = worklist.pop()
+      for bc_tpl in BytecodeObject.get_parsed_code(code_object, recursive=False):
+        if bc_tpl[2] == LOAD_GLOBAL:
+          self.import_lives.add(bc_tpl[3])
+      worklist.extend(c for c in code_object.co_consts if isinstance(c, types.CodeType))
 
 
   @staticmethod
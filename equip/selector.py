@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+  equip.selector
+  ~~~~~~~~~~~~~~
+
+  Selection of the declarations to instrument.
+
+  :copyright: (c) 2014 by Romain Gaucher (@rgaucher)
+  :license: Apache 2, see LICENSE for more details.
+"""
+import re
+import types
+import opcode
+from fnmatch import fnmatch
+
+from .bytecode import BytecodeObject
+from .bytecode.decl import TypeDeclaration, MethodDeclaration
+from .bytecode.utils import get_code_object_bytecode
+from .analysis.python.effects import get_stack_effect
+
+
+# Opcodes that load the first name of a dotted name, and the ones that
+# extend it.
+NAME_LOADS = set(opcode.opmap[name] for name in ('LOAD_NAME', 'LOAD_GLOBAL', 'LOAD_FAST',
+                                                 'LOAD_DEREF'))
+LOAD_ATTR = opcode.opmap['LOAD_ATTR']
+LOAD_CONST = opcode.opmap['LOAD_CONST']
+MAKE_FUNCTIONS = set((opcode.opmap['MAKE_FUNCTION'], opcode.opmap['MAKE_CLOSURE']))
+MAKE_CLOSURE = opcode.opmap['MAKE_CLOSURE']
+CALL_FUNCTION = opcode.opmap['CALL_FUNCTION']
+BUILD_CLASS = opcode.opmap['BUILD_CLASS']
+
+# Opcodes that end the statement before a declaration
+STATEMENT_ENDS = set(op for name, op in opcode.opmap.items() \
+                     if name.startswith(('STORE_', 'DELETE_', 'SETUP_', 'IMPORT_', 'PRINT_')) \
+                     or name in ('POP_TOP', 'POP_BLOCK', 'RETURN_VALUE', 'END_FINALLY',
+                                 'EXEC_STMT', 'YIELD_VALUE'))
+STATEMENT_ENDS.update(opcode.hasjrel)
+STATEMENT_ENDS.update(opcode.hasjabs)
+
+SELECTOR_KEYS = ('module', 'class', 'method', 'decorator', 'lines')
+
+
+class Selector(object):
+  """
+    Selects the declarations to instrument from the name of their module, the name
+    of their class, the name of the method, their decorators or their lines::
+
+      selector = Selector(module='payments.*', method='^handle_')
+      instr.apply(HandlerVisitor(), rewrite=True, selector=selector)
+
+    A selector can also be parsed from a string of ``key=value`` terms, with the keys
+    ``module``, ``class``, ``method``, ``decorator`` and ``lines``::
+
+      instr.apply(HandlerVisitor(), rewrite=True,
+                  selector='module=payments.* class=*Handler decorator=route lines=10-200')
+
+    The modules are first filtered from their name and from an index of the code
+    objects they contain (names, lines and referenced names), so the modules without
+    matching declarations are never decoded. The class, method and block visitors
+    are then only called on the matching declarations.
+  """
+
+  def __init__(self, module=None, type_name=None, method_name=None, decorator=None, lines=None):
+    """
+      :param module: Glob pattern of the full name of the module (e.g., ``payments.*``).
+      :param type_name: Glob pattern of the name of the class. For a method, it is the
+                        name of its enclosing class.
+      :param method_name: Regular expression searched in the name of the method. The
+                          classes are not selected when it is set.
+      :param decorator: Name of a decorator of the declaration. A dotted decorator
+                        (e.g., ``app.route``) matches by its full name or its suffix
+                        (e.g., ``route``).
+      :param lines: Tuple ``(start, end)`` of lines the declaration must overlap.
+                    Either bound can be ``None``.
+    """
+    self.module = module
+    self.type_name = type_name
+    self.method_name = method_name
+    self.decorator = decorator
+    self.lines = lines
+    self.method_re = re.compile(method_name) if method_name is not None else None
+
+
+  @staticmethod
+  def parse(text):
+    """
+      Parses a selector from a string of space separated ``key=value`` terms.
+
+      :param text: The selector, e.g. ``'module=payments.* method=^handle_ lines=10-40'``.
+    """
+    kwargs = {}
+    for term in text.split():
+      if '=' not in term:
+        raise Exception('Invalid selector term `%s` (expected key=value)' % term)
+      key, value = term.split('=', 1)
+      if key not in SELECTOR_KEYS:
+        raise Exception('Unknown selector key `%s` (expected one of %s)' \
+                        % (key, ', '.join(SELECTOR_KEYS)))
+      if key == 'lines':
+        kwargs['lines'] = Selector.parse_lines(value)
+      elif key == 'class':
+        kwargs['type_name'] = value
+      elif key == 'method':
+        kwargs['method_name'] = value
+      else:
+        kwargs[key] = value
+    return Selector(**kwargs)
+
+
+  @staticmethod
+  def parse_lines(value):
+    try:
+      if '-' not in value:
+        return (int(value), int(value))
+      start, end = value.split('-', 1)
+      return (int(start) if start else None, int(end) if end else None)
+    except ValueError:
+      raise Exception('Invalid line range `%s` (expected start-end)' % value)
+
+
+  @property
+  def selects_declarations(self):
+    """
+      ``True`` if the selector restricts the declarations, not only the modules.
+    """
+    return self.type_name is not None or self.method_name is not None \
+           or self.decorator is not None or self.lines is not None
+
+
+  def matches_module(self, module_name):
+    """
+      Returns ``True`` if the module named ``module_name`` can be selected.
+    """
+    return self.module is None or fnmatch(module_name, self.module)
+
+
+  def overlaps(self, lines):
+    if self.lines is None:
+      return True
+    start, end = self.lines
+    return (end is None or lines[0] <= end) and (start is None or lines[1] >= start)
+
+
+  def matches_decorator(self, decorators):
+    for decorator in decorators:
+      if decorator == self.decorator or decorator.endswith('.' + self.decorator):
+        return True
+    return False
+
+
+  def match(self, is_type, name, class_name, lines):
+    if not self.overlaps(lines):
+      return False
+    if is_type:
+      if self.method_name is not None:
+        return False
+      class_name = name
+    elif self.method_re is not None and not self.method_re.search(name):
+      return False
+    if self.type_name is not None:
+      return class_name is not None and fnmatch(class_name, self.type_name)
+    return True
+
+
+  def select_code(self, code_object):
+    """
+      Returns ``True`` if ``code_object`` (of a module) may contain a declaration that
+      matches, without decoding its bytecode. The decorators are only checked for
+      being referenced by the enclosing code object.
+
+      :param code_object: The code object of the module.
+    """
+    if not self.selects_declarations:
+      return True
+    nodes, lines = BytecodeObject.get_code_object_tree(code_object)
+
+    # id(code object) -> name of the class it belongs to
+    class_names = {id(code_object): None}
+    for co, parent_co in nodes[1:]:
+      is_type = BytecodeObject.is_class_code_object(co)
+      class_name = co.co_name if is_type else class_names[id(parent_co)]
+      class_names[id(co)] = class_name
+      if not self.match(is_type, co.co_name, class_names[id(parent_co)], lines[id(co)]):
+        continue
+      if self.decorator is not None:
+        referenced = parent_co.co_names + parent_co.co_varnames \
+                   + parent_co.co_cellvars + parent_co.co_freevars
+        if self.decorator.split('.')[-1] not in referenced:
+          continue
+      return True
+    return False
+
+
+  def matches(self, decl):
+    """
+      Returns ``True`` if the declaration ``decl`` is selected. A module declaration
+      is only selected when the selector does not restrict the classes, methods or
+      decorators.
+    """
+    if isinstance(decl, TypeDeclaration):
+      is_type, name = True, decl.type_name
+    elif isinstance(decl, MethodDeclaration):
+      is_type, name = False, decl.method_name
+    else:
+      return self.type_name is None and self.method_name is None \
+             and self.decorator is None and self.overlaps(decl.lines)
+
+    class_name = None
+    parent = decl.parent
+    while parent is not None:
+      if isinstance(parent, TypeDeclaration):
+        class_name = parent.type_name
+        break
+      parent = parent.parent
+
+    if not self.match(is_type, name, class_name, decl.lines):
+      return False
+    if self.decorator is not None:
+      return self.matches_decorator(Selector.get_decorators(decl))
+    return True
+
+
+  @staticmethod
+  def get_decorators(decl):
+    """
+      Returns the dotted names of the decorators of ``decl``, found in the bytecode of
+      its parent. Only the decorators called on the function (or class) are returned,
+      not the names referenced by the default values of the parameters, the bases of
+      a class, or the arguments of the decorators.
+    """
+    parent = decl.parent
+    if parent is None:
+      return []
+    bytecode = get_code_object_bytecode(parent.bytecode)
+    code_object = decl.code_object
+
+    def is_decl_code(arg):
+      return arg is code_object \
+             or (isinstance(arg, types.CodeType) and arg.co_name == code_object.co_name \
+                 and arg.co_firstlineno == code_object.co_firstlineno)
+
+    length = len(bytecode)
+    position = 0
+    while position < length:
+      if bytecode[position][2] == LOAD_CONST and is_decl_code(bytecode[position][3]):
+        break
+      position += 1
+    else:
+      return []
+
+    # The values consumed with the code object: the default values and the closure
+    # of the function, and the name and bases of the class
+    k = position + 1
+    num_operands = 0
+    if k < length and bytecode[k][2] in MAKE_FUNCTIONS:
+      num_operands = bytecode[k][3] + (1 if bytecode[k][2] == MAKE_CLOSURE else 0)
+      k += 1
+    if isinstance(decl, TypeDeclaration):
+      if k + 1 < length and bytecode[k][2] == CALL_FUNCTION and bytecode[k + 1][2] == BUILD_CLASS:
+        num_operands += 2
+        k += 2
+
+    # The decorators are called right after the function (or class) is built
+    num_decorators = 0
+    while k < length and bytecode[k][2] == CALL_FUNCTION and bytecode[k][3] == 1:
+      num_decorators += 1
+      k += 1
+    if num_decorators == 0:
+      return []
+
+    # Each decorator is one value pushed below the operands
+    names = []
+    end = Selector.get_values_start(bytecode, position, num_operands)
+    for _ in xrange(num_decorators):
+      start = Selector.get_values_start(bytecode, end, 1)
+      if start < 0:
+        break
+      name = None
+      for _, _, op, arg, _, _ in bytecode[start:end]:
+        if name is None and op in NAME_LOADS:
+          name = arg
+        elif name is not None and op == LOAD_ATTR:
+          name = name + '.' + arg
+        else:
+          break
+      if name is not None:
+        names.insert(0, name)
+      end = start
+    return names
+
+
+  @staticmethod
+  def get_values_start(bytecode, end, count):
+    """
+      Returns the position of the first instruction that computes the last ``count``
+      values pushed on the stack before ``end``, or -1 if they are not computed in
+      the same statement.
+    """
+    position = end
+    while count > 0 and position >= 0:
+      position -= 1
+      if position < 0 or bytecode[position][2] in STATEMENT_ENDS:
+        return -1
+      pop, push = get_stack_effect(bytecode[position][2], bytecode[position][3])
+      count += pop - push
+    return position if count == 0 else -1
+
+
+  def __repr__(self):
+    terms = []
+    for key, value in (('module', self.module), ('class', self.type_name),
+                       ('method', self.method_name), ('decorator', self.decorator)):
+      if value is not None:
+        terms.append('%s=%s' % (key, value))
+    if self.lines is not None:
+      terms.append('lines=%s-%s' % tuple('' if l is None else l for l in self.lines))
+    return 'Selector(%s)' % ' '.join(terms)
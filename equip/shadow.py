@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+  equip.shadow
+  ~~~~~~~~~~~~
+
+  Mirror trees of the original and instrumented bytecode, with an atomic switch
+  between the two.
+
+  :copyright: (c) 2014 by Romain Gaucher (@rgaucher)
+  :license: Apache 2, see LICENSE for more details.
+"""
+import os
+import errno
+import shutil
+
+from .utils.log import logger
+from .utils.files import iter_files
+
+
+class ShadowTree(object):
+  """
+    Keeps two mirrors of the program under the ``shadow_dir``: one with the original
+    bytecode files, and one with the instrumented ones. The ``current`` symlink points
+    to the active tree, and it should be the one added to the ``PYTHONPATH``::
+
+      shadow_dir/
+        original/       <- original pyc files (and hard links to the sources)
+        instrumented/   <- instrumented pyc files (and hard links to the sources)
+        current -> instrumented
+
+    Switching between the two trees is a single ``rename`` of the symlink, so it
+    takes effect atomically for the processes started afterwards.
+
+    The whole program is mirrored by ``populate``, including the modules that are
+    not instrumented and the data files: the bytecode files are copied, since they
+    are rewritten in place, and every other file is hard linked.
+  """
+
+  ORIGINAL = 'original'
+  INSTRUMENTED = 'instrumented'
+  CURRENT = 'current'
+
+  def __init__(self, shadow_dir, locations=None):
+    """
+      :param shadow_dir: The directory that contains the mirror trees.
+      :param locations: The locations of the program (see ``Instrumentation.location``).
+                        The files are mirrored relatively to the location that contains
+                        them.
+    """
+    self.shadow_dir = os.path.abspath(shadow_dir)
+    if isinstance(locations, basestring):
+      locations = (locations,)
+    self.locations = [os.path.abspath(l) for l in locations or ()]
+
+
+  def tree_path(self, tree):
+    return os.path.join(self.shadow_dir, tree)
+
+
+  @property
+  def current_path(self):
+    """
+      The path of the symlink to the active tree.
+    """
+    return self.tree_path(ShadowTree.CURRENT)
+
+
+  def relative_path(self, program_file):
+    """
+      Returns the path of ``program_file`` relative to the location that contains it.
+    """
+    program_file = os.path.abspath(program_file)
+    for location in self.locations:
+      if program_file.startswith(location + os.sep):
+        return program_file[len(location) + 1:]
+    raise Exception('File %s is not in the program locations %s' % (program_file, self.locations))
+
+
+  def mirror_path(self, program_file, tree):
+    return os.path.join(self.tree_path(tree), self.relative_path(program_file))
+
+
+  def populate(self):
+    """
+      Mirrors every file of the program locations in both trees. The bytecode files
+      are copied, the other files are hard linked.
+    """
+    count = 0
+    for location in self.locations:
+      for program_file in iter_files(location):
+        if program_file.startswith(self.shadow_dir + os.sep):
+          continue
+        is_bytecode = os.path.splitext(program_file)[1] in ('.pyc', '.pyo')
+        for tree in (ShadowTree.ORIGINAL, ShadowTree.INSTRUMENTED):
+          if is_bytecode:
+            ShadowTree.copy_file(program_file, self.mirror_path(program_file, tree))
+          else:
+            ShadowTree.link_file(program_file, self.mirror_path(program_file, tree))
+        count += 1
+    logger.debug("Mirrored %d files in %s", count, self.shadow_dir)
+
+
+  def prepare(self, bytecode_file):
+    """
+      Returns the path where the instrumented ``bytecode_file`` should be written.
+      The bytecode file (and its source, if any) is mirrored in both trees, unless
+      ``populate`` already did (it did not for the files compiled while streaming).
+
+      :param bytecode_file: Absolute path of the file containing the bytecode (pyc).
+    """
+    output_file = self.mirror_path(bytecode_file, ShadowTree.INSTRUMENTED)
+    if self.is_mirrored(bytecode_file):
+      return output_file
+
+    source_file = bytecode_file[:-1]
+    for tree in (ShadowTree.ORIGINAL, ShadowTree.INSTRUMENTED):
+      ShadowTree.copy_file(bytecode_file, self.mirror_path(bytecode_file, tree))
+      if os.path.isfile(source_file):
+        ShadowTree.link_file(source_file, self.mirror_path(source_file, tree))
+    return output_file
+
+
+  def is_mirrored(self, bytecode_file):
+    """
+      Returns ``True`` if the copy of ``bytecode_file`` in the original tree is up to
+      date (same size and modification time), and it is in the instrumented tree.
+    """
+    try:
+      stat = os.stat(bytecode_file)
+      mirror_stat = os.stat(self.mirror_path(bytecode_file, ShadowTree.ORIGINAL))
+    except OSError:
+      return False
+    return stat.st_size == mirror_stat.st_size \
+           and stat.st_mtime == mirror_stat.st_mtime \
+           and os.path.isfile(self.mirror_path(bytecode_file, ShadowTree.INSTRUMENTED))
+
+
+  def activate(self, tree):
+    """
+      Points the ``current`` symlink to the ``tree`` (either ``ORIGINAL`` or
+      ``INSTRUMENTED``). The symlink is replaced atomically.
+    """
+    if tree not in (ShadowTree.ORIGINAL, ShadowTree.INSTRUMENTED):
+      raise Exception('Unknown shadow tree `%s`' % tree)
+    ShadowTree.make_dirs(self.tree_path(tree))
+
+    tmp_link = self.current_path + '.tmp.%d' % os.getpid()
+    if os.path.lexists(tmp_link):
+      os.remove(tmp_link)
+    os.symlink(tree, tmp_link)
+    os.rename(tmp_link, self.current_path)
+    logger.debug("Shadow tree %s now points to %s", self.current_path, tree)
+
+
+  @property
+  def active(self):
+    """
+      Returns the name of the active tree, or ``None`` if none was activated.
+    """
+    try:
+      return os.readlink(self.current_path)
+    except OSError:
+      return None
+
+
+  @staticmethod
+  def make_dirs(directory):
+    try:
+      os.makedirs(directory)
+    except OSError, ex:
+      if ex.errno != errno.EEXIST:
+        raise
+
+
+  @staticmethod
+  def copy_file(src, dst):
+    ShadowTree.make_dirs(os.path.dirname(dst))
+    shutil.copy2(src, dst)
+
+
+  @staticmethod
+  def link_file(src, dst):
+    """
+      Hard links ``src`` to ``dst``, or copies it when a link cannot be created.
+      The modification time is kept either way, so the mirrored bytecode stays
+      fresh with respect to its source.
+    """
+    ShadowTree.make_dirs(os.path.dirname(dst))
+    if os.path.lexists(dst):
+      if os.path.samefile(src, dst):
+        return
+      os.remove(dst)
+    try:
+      os.link(src, dst)
+    except OSError:
+      shutil.copy2(src, dst)
@@ -7,6 +7,17 @@
   :license: Apache 2, see LICENSE for more details.
 """
 import os
+from fnmatch import fnmatch
+
+# ``scandir`` avoids a stat call per entry. It is part of the standard library
+# from Python 3.5 and available as a backport for 2.7.
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
 
 __normalize_path = lambda x: os.path.abspath(x)
 
@@ -21,24 +32,105 @@ def good_ext(fext, l=None):
   return fext.lower() in l if l else False
 
 
-def scan_dir(directory, files, l_ext=None):
-  names = os.listdir(directory)
-  for name in names:
-    srcname = __normalize_path(os.path.join(directory, name))
+def match_patterns(rel_path, name, patterns, is_dir=False):
+  """
+    Returns ``True`` if the relative path or the name of an entry matches one
+    of the glob ``patterns``. A pattern ending with ``/`` only matches directories.
+  """
+  for pattern in patterns:
+    if pattern.endswith('/'):
+      if not is_dir:
+        continue
+      pattern = pattern[:-1]
+    if fnmatch(name, pattern) or fnmatch(rel_path, pattern):
+      return True
+  return False
+
+
+def list_entries(directory):
+  """
+    Returns the sorted list of ``(name, is_dir, is_file, is_symlink)`` for the
+    entries of ``directory``.
+  """
+  entries = []
+  if scandir is not None:
+    for entry in scandir(directory):
+      entries.append((entry.name, entry.is_dir(), entry.is_file(), entry.is_symlink()))
+  else:
+    for name in os.listdir(directory):
+      path = os.path.join(directory, name)
+      entries.append((name, os.path.isdir(path), os.path.isfile(path), os.path.islink(path)))
+  entries.sort()
+  return entries
+
+
+def iter_files(directory, l_ext=None, include=None, exclude=None):
+  """
+    Yields the absolute paths of the files under ``directory``. The walk is
+    iterative, and each file is yielded once.
+
+    :param directory: The root directory to scan.
+    :param l_ext: The list of accepted file extensions. Defaults to all files.
+    :param include: Glob patterns the files must match (on their name, or path
+                    relative to ``directory``). Defaults to all files.
+    :param exclude: Glob patterns of the files and directories to skip (e.g.,
+                    ``('tests/', 'vendor/')``).
+  """
+  if isinstance(include, basestring):
+    include = (include,)
+  if isinstance(exclude, basestring):
+    exclude = (exclude,)
+  l_ext = set(e.lower() for e in l_ext) if l_ext else None
+
+  root = __normalize_path(directory)
+  root_length = len(root) + 1
+  # Real paths of the symlinked directories already walked, to avoid cycles
+  seen_links = set()
+  stack = [root]
+  while stack:
+    current = stack.pop()
     try:
-      if os.path.isdir(srcname):
-        try:
-          scan_dir(srcname, files, l_ext)
-        except:
-          continue
-      elif os.path.isfile(srcname) \
-           and (not l_ext \
-                or good_ext(srcname[srcname.rfind('.')+1:], l_ext)):
-        if srcname not in files:
-          files.append(srcname)
-    except IOError, error:
+      entries = list_entries(current)
+    except (IOError, OSError):
       continue
 
+    subdirs = []
+    for name, is_dir, is_file, is_symlink in entries:
+      path = current + os.sep + name
+      rel_path = path[root_length:]
+      if is_dir:
+        if exclude and match_patterns(rel_path, name, exclude, is_dir=True):
+          continue
+        if is_symlink:
+          real_path = os.path.realpath(path)
+          if real_path in seen_links or (root + os.sep).startswith(real_path + os.sep):
+            continue
+          seen_links.add(real_path)
+        subdirs.append(path)
+      elif is_file:
+        if l_ext is not None and file_extension(name) not in l_ext:
+          continue
+        if exclude and match_patterns(rel_path, name, exclude):
+          continue
+        if include and not match_patterns(rel_path, name, include):
+          continue
+        yield path
+
+    # Keep the traversal in lexicographic order
+    subdirs.reverse()
+    stack.extend(subdirs)
+
+
+def scan_dir(directory, files, l_ext=None, include=None, exclude=None):
+  """
+    Appends the files under ``directory`` to the list ``files``. See ``iter_files``.
+  """
+  known = set(files)
+  for srcname in iter_files(directory, l_ext, include, exclude):
+    if srcname not in known:
+      known.add(srcname)
+      files.append(srcname)
+
 
 def list_dir(directory):
   subdirs = os.listdir(directory)
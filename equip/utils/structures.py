@@ -8,10 +8,10 @@
   :copyright: (c) 2014 by Romain Gaucher (@rgaucher)
   :license: Apache 2, see LICENSE for more details.
 """
-
-
+import threading
 from bisect import bisect_left, bisect_right
 from itertools import izip
+from collections import OrderedDict
 
 
 class intervalmap(object):
@@ -114,3 +114,77 @@ class intervalmap(object):
         ))
     return '{'+', '.join(s)+'}'
 
+
+class lrucache(object):
+  """
+    A bounded mapping that evicts the least recently used entries. It keeps
+    statistics about the lookups (``hits``, ``misses`` and ``evictions``).
+  """
+  def __init__(self, maxsize=128):
+    """
+      :param maxsize: The maximum number of entries.
+    """
+    self.maxsize = maxsize
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key, default=None):
+    """
+      Returns the value associated with ``key`` and marks it as the most recently
+      used, or ``default`` if it is not in the cache.
+    """
+    with self._lock:
+      if key not in self._entries:
+        self.misses += 1
+        return default
+      value = self._entries.pop(key)
+      self._entries[key] = value
+      self.hits += 1
+      return value
+
+  def put(self, key, value):
+    """
+      Adds the value to the cache, and evicts the least recently used entry
+      when the cache is full.
+    """
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = value
+      while len(self._entries) > self.maxsize:
+        self._entries.popitem(last=False)
+        self.evictions += 1
+
+  def discard(self, key):
+    """
+      Removes the entry associated with ``key``, if any.
+    """
+    with self._lock:
+      self._entries.pop(key, None)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def stats(self):
+    """
+      Returns a dict with the size of the cache and its statistics.
+    """
+    return {
+      'size': len(self._entries),
+      'maxsize': self.maxsize,
+      'hits': self.hits,
+      'misses': self.misses,
+      'evictions': self.evictions,
+    }
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def __repr__(self):
+    return 'lrucache(%r)' % self.stats()
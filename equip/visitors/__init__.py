@@ -14,3 +14,4 @@ from .classes import ClassVisitor
 from .methods import MethodVisitor
 from .modules import ModuleVisitor
 from .blocks import BlockVisitor
+from .composite import CompositeVisitor
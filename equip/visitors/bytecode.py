@@ -10,9 +10,22 @@
 """
 
 import opcode
+import logging
 from ..utils.log import logger
 
 
+#: Handler tables of the visitor classes, keyed by class. See ``BytecodeVisitor.get_handlers``.
+HANDLER_TABLES = {}
+
+# Marks the opcodes that have no visitor method at all
+MISSING_HANDLER = object()
+
+# Marks the opcodes whose visitor method is not a plain method of the class (e.g., a
+# static method, a callable object, or an attribute of the instance). They are
+# dispatched through ``getattr`` on the visitor.
+GETATTR_HANDLER = object()
+
+
 class BytecodeVisitor(object):
   """
     A visitor to visit each instruction in the bytecode. For example,
@@ -27,6 +40,10 @@ class BytecodeVisitor(object):
 
     Prints whenever a ``CALL_FUNCTION`` opcode is visited and prints out
     its number of arguments (the oparg for this opcode).
+
+    The visitor methods are resolved once per visitor class, and bound once per
+    visitor on its first visit. The opcodes whose visitor method is not overridden
+    are skipped.
   """
 
   def __init__(self):
@@ -37,10 +54,67 @@ class BytecodeVisitor(object):
     return 'visit_' + name.lower().replace('+', '_')
 
 
+  @classmethod
+  def get_handlers(cls):
+    """
+      Returns the table of the visitor methods of this class, indexed by opcode.
+      The entry is ``None`` when the method is not overridden, the function of the
+      method, or ``GETATTR_HANDLER`` when the visitor method is another kind of
+      callable.
+    """
+    handlers = HANDLER_TABLES.get(cls)
+    if handlers is None:
+      handlers = [None] * 256
+      for op in xrange(256):
+        method_name = BytecodeVisitor.toMethodName(opcode.opname[op])
+        meth = getattr(cls, method_name, None)
+        if meth is None:
+          handlers[op] = MISSING_HANDLER
+          continue
+        func = getattr(meth, 'im_func', None)
+        if func is getattr(BytecodeVisitor, method_name).im_func:
+          continue
+        if func is not None and getattr(meth, 'im_self', None) is None:
+          handlers[op] = func
+        else:
+          handlers[op] = GETATTR_HANDLER
+      HANDLER_TABLES[cls] = handlers
+    return handlers
+
+
+  def get_instance_handlers(self):
+    """
+      Returns the table of the bound visitor methods of this visitor, indexed by
+      opcode. The entry is ``None`` when the method is not overridden (neither by the
+      class nor by the instance), and ``MISSING_HANDLER`` when there is no method.
+
+      The table is built on the first call and kept on the visitor, so the visitor
+      methods set on the instance afterwards are not seen.
+    """
+    handlers = self.__dict__.get('_bound_handlers')
+    if handlers is None:
+      handlers = list(self.get_handlers())
+      for name in self.__dict__:
+        for op in METHOD_OPCODES.get(name, ()):
+          handlers[op] = GETATTR_HANDLER
+      for op, handler in enumerate(handlers):
+        if handler is not None and handler is not MISSING_HANDLER:
+          handlers[op] = getattr(self, BytecodeVisitor.toMethodName(opcode.opname[op]))
+      self._bound_handlers = handlers
+    return handlers
+
+
+  def __getstate__(self):
+    # The bound visitor methods are resolved again after unpickling
+    state = self.__dict__.copy()
+    state.pop('_bound_handlers', None)
+    return state
+
+
   def visit(self, index, op, arg=None, lineno=None, cflow_in=False):
     """
-      Callback of the visitor. It dynamically constructs the name
-      of the specialized visitor to call based on the name of the opcode.
+      Callback of the visitor. It calls the specialized visitor method
+      of the opcode (e.g., ``visit_call_function`` for ``CALL_FUNCTION``).
 
       :param index: Bytecode index.
       :param op: The opcode that is currently visited.
@@ -48,19 +122,25 @@ class BytecodeVisitor(object):
       :param lineno: The line number associated with the opcode.
       :param cflow_in: ``True`` if the current ``index`` is the target of a jump.
     """
-    # Let's start with a slow impl of the jump table, with
-    # reflection
-    method_name = BytecodeVisitor.toMethodName(opcode.opname[op])
-    if hasattr(self, method_name):
-      meth = getattr(self, method_name)
-      if op < opcode.HAVE_ARGUMENT:
-        logger.debug("%03d %26s" % (lineno, method_name))
-        return meth()
-      else:
-        logger.debug("%03d %26s( %s )" % (lineno, method_name, repr(arg)))
-        return meth(arg)
+    try:
+      meth = self._bound_handlers[op]
+    except AttributeError:
+      meth = self.get_instance_handlers()[op]
+    if meth is None:
+      return None
+    if meth is MISSING_HANDLER:
+      logger.error("Method not found: %s", BytecodeVisitor.toMethodName(opcode.opname[op]))
+      return None
+
+    if op < opcode.HAVE_ARGUMENT:
+      if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%03d %26s", lineno, BytecodeVisitor.toMethodName(opcode.opname[op]))
+      return meth()
     else:
-      logger.error("Method not found: %s" % method_name)
+      if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%03d %26s( %s )", lineno, BytecodeVisitor.toMethodName(opcode.opname[op]),
+                     repr(arg))
+      return meth(arg)
 
 
   # 2.7 specific visitors. See https://docs.python.org/2/library/dis.html
@@ -425,3 +505,10 @@ class BytecodeVisitor(object):
 
   def visit_map_add(self, oparg):
     pass
+
+
+# Visitor method name -> opcodes, to find the visitor methods set on an instance
+METHOD_OPCODES = {}
+for _op in xrange(256):
+  METHOD_OPCODES.setdefault(BytecodeVisitor.toMethodName(opcode.opname[_op]), []).append(_op)
+del _op
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+  equip.visitors.composite
+  ~~~~~~~~~~~~~~~~~~~~~~~~
+
+  Runs several visitors in a single traversal of the program.
+
+  :copyright: (c) 2014 by Romain Gaucher (@rgaucher)
+  :license: Apache 2, see LICENSE for more details.
+"""
+from .bytecode import BytecodeVisitor
+from .classes import ClassVisitor
+from .methods import MethodVisitor
+from .modules import ModuleVisitor
+from .blocks import BlockVisitor
+
+
+class CompositeVisitor(object):
+  """
+    Groups visitors of any kind (``ModuleVisitor``, ``ClassVisitor``, ``MethodVisitor``,
+    ``BlockVisitor`` and ``BytecodeVisitor``) so that they all run during one walk
+    of the declarations tree, instead of one walk per visitor::
+
+      visitor = CompositeVisitor([CallCounterVisitor(), TimingVisitor(), CoverageVisitor()])
+      bytecode_object.accept(visitor)
+
+    The bytecode of the module is iterated once for all the bytecode visitors, and
+    the control flow graph of each declaration is built once and handed to all the
+    block visitors.
+
+    For each declaration, the visitors are called in the order they were supplied.
+  """
+
+  def __init__(self, visitors=None, selector=None):
+    """
+      :param visitors: The list of visitors to run.
+      :param selector: A ``Selector`` of the declarations handed to the class, method
+                       and block visitors. Defaults to all the declarations.
+    """
+    self.selector = selector
+    self.visitors = []
+    self.module_visitors = []
+    self.class_visitors = []
+    self.method_visitors = []
+    self.block_visitors = []
+    self.bytecode_visitors = []
+    for visitor in visitors or ():
+      self.add(visitor)
+
+
+  def add(self, visitor):
+    """
+      Adds a visitor. A nested ``CompositeVisitor`` is flattened.
+    """
+    if isinstance(visitor, CompositeVisitor):
+      if visitor.selector is not None and visitor.selector is not self.selector:
+        raise Exception('Cannot add a CompositeVisitor with a different selector')
+      for nested_visitor in visitor.visitors:
+        self.add(nested_visitor)
+      return
+
+    if isinstance(visitor, BytecodeVisitor):
+      self.bytecode_visitors.append(visitor)
+    elif isinstance(visitor, ModuleVisitor):
+      self.module_visitors.append(visitor)
+    elif isinstance(visitor, ClassVisitor):
+      self.class_visitors.append(visitor)
+    elif isinstance(visitor, MethodVisitor):
+      self.method_visitors.append(visitor)
+    elif isinstance(visitor, BlockVisitor):
+      self.block_visitors.append(visitor)
+    else:
+      raise Exception('Unknown kind of visitor: %s' % visitor)
+    self.visitors.append(visitor)
+
+
+  def __len__(self):
+    return len(self.visitors)
+
+
+  def __iter__(self):
+    return iter(self.visitors)
@@ -0,0 +1,154 @@
+import pytest
+from testutils import get_co, get_bytecode
+
+from equip import BytecodeObject
+from equip.bytecode import CompactBytecode, BytecodeView
+
+
+NESTED_PROGRAM = """
+import sys
+
+class Foo(object):
+  def __init__(self, a):
+    self.a = a < 2
+
+  def bar(self, *args):
+    def inner():
+      return args
+    return inner
+
+def baz(x):
+  for i in range(x):
+    if i > 3:
+      break
+  return [y for y in sys.argv]
+
+print baz(10)
+"""
+
+
+def get_list_bytecode(co):
+  bytecode = []
+  BytecodeObject.parse_code_object(co, bytecode)
+  return bytecode
+
+
+def test_same_instructions():
+  co = get_co(NESTED_PROGRAM)
+  bytecode = get_bytecode(co)
+  assert isinstance(bytecode, CompactBytecode)
+
+  expected = get_list_bytecode(co)
+  assert len(bytecode) == len(expected)
+  assert list(bytecode) == expected
+  for i in range(len(expected)):
+    assert bytecode[i] == expected[i]
+    assert bytecode[i][5] is expected[i][5]
+  assert bytecode[-1] == expected[-1]
+
+
+def test_views():
+  co = get_co(NESTED_PROGRAM)
+  bytecode = get_bytecode(co)
+  expected = get_list_bytecode(co)
+
+  view = bytecode[10:-5]
+  assert isinstance(view, BytecodeView)
+  assert list(view) == expected[10:-5]
+  assert list(view[3:]) == expected[13:-5]
+  assert view[-1] == expected[-6]
+  assert list(view[:-2]) == expected[10:-7]
+  assert list(bytecode[5:3]) == []
+  assert bytecode[::2] == expected[::2]
+
+  with pytest.raises(IndexError):
+    view[len(view)]
+
+
+def test_declarations_bytecode():
+  co = get_co(NESTED_PROGRAM)
+  bytecode_object = BytecodeObject('<string>')
+  bytecode_object.parse_code(co)
+  expected = get_list_bytecode(co)
+
+  for decl in bytecode_object.declarations:
+    assert len(decl.bytecode) > 0
+    assert decl.bytecode[0][5] is decl.code_object
+    if decl.is_module():
+      assert list(decl.bytecode) == expected
+
+
+def test_parsed_code_cache():
+  from equip.bytecode.code import PARSED_CODE_CACHE
+  co = get_co(NESTED_PROGRAM)
+  bytecode = get_bytecode(co)
+  assert get_bytecode(co) is bytecode
+
+  hits = PARSED_CODE_CACHE.hits
+  assert get_bytecode(co) is bytecode
+  assert PARSED_CODE_CACHE.hits == hits + 1
+
+  # Equal, but different code objects are decoded again
+  other_co = get_co(NESTED_PROGRAM)
+  assert get_bytecode(other_co) is not bytecode
+
+  BytecodeObject.invalidate_parsed_code(co)
+  assert get_bytecode(co) is not bytecode
+
+  own_bytecode = BytecodeObject.get_parsed_code(co, recursive=False)
+  assert all(tpl[5] is co for tpl in own_bytecode)
+
+
+def test_decode_flags_and_lines():
+  from dis import findlabels, findlinestarts
+  co = get_co(NESTED_PROGRAM)
+  bytecode = get_bytecode(co)
+
+  code_objects = set(tpl[5] for tpl in bytecode)
+  assert len(code_objects) == 6
+  for code_object in code_objects:
+    labels = findlabels(code_object.co_code)
+    linestarts = dict(findlinestarts(code_object))
+    lineno = -1
+    for index, lineno_tpl, op, arg, cflow_in, _ in [t for t in bytecode if t[5] is code_object]:
+      lineno = linestarts.get(index, lineno)
+      assert lineno_tpl == lineno
+      assert cflow_in == (index in labels)
+
+
+def test_offset_positions():
+  from equip.bytecode.utils import get_code_object_bytecode
+  co = get_co(NESTED_PROGRAM)
+  bytecode = get_bytecode(co)
+  expected = get_list_bytecode(co)
+
+  for code_object in set(tpl[5] for tpl in expected):
+    for position, tpl in enumerate(expected):
+      if tpl[5] is code_object:
+        assert bytecode.position_of(tpl[0], code_object) == position
+        assert bytecode.offset_of(position) == tpl[0]
+    own_positions = [i for i, tpl in enumerate(expected) if tpl[5] is code_object]
+    assert list(bytecode.get_code_object_positions(code_object)) == own_positions
+  assert bytecode.position_of(1) == -1
+
+  view = bytecode[10:]
+  assert view.position_of(view[0][0]) == 0
+  assert view.offset_of(2) == expected[12][0]
+  assert list(view.get_code_object_positions()) \
+      == [i - 10 for i, tpl in enumerate(expected) if i >= 10 and tpl[5] is expected[10][5]]
+
+  own_bytecode = [tpl for tpl in expected if tpl[5] is co]
+  assert get_code_object_bytecode(bytecode) == own_bytecode
+  assert get_code_object_bytecode(expected) == own_bytecode
+  start, end = own_bytecode[3][0], own_bytecode[8][0]
+  assert get_code_object_bytecode(bytecode, start, end) == own_bytecode[3:8]
+  assert get_code_object_bytecode(expected, start, end) == own_bytecode[3:8]
+
+  # A view that starts in the middle of a code object
+  nested_start = [i for i, tpl in enumerate(expected) if i > 0 and tpl[0] == 0][0]
+  nested_co = expected[nested_start][5]
+  nested_bytecode = [tpl for tpl in expected if tpl[5] is nested_co]
+  assert get_code_object_bytecode(bytecode[nested_start - 1:]) == nested_bytecode
+  assert get_code_object_bytecode(expected[nested_start - 1:]) == nested_bytecode
+  with pytest.raises(Exception):
+    get_code_object_bytecode(bytecode[1:nested_start])
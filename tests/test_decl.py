@@ -1,7 +1,7 @@
 import pytest
 from testutils import get_co, get_bytecode
 
-from equip import BytecodeObject
+from equip import BytecodeObject, BytecodeVisitor
 from equip.bytecode import MethodDeclaration, TypeDeclaration, ModuleDeclaration
 from equip.bytecode.utils import show_bytecode, iter_decl
 
@@ -105,6 +105,28 @@ def test_nested_methods_lambdas():
   assert len(nested_1_2_decl.children) == 0
 
 
+def test_get_decl_index():
+  co_simple = get_co(SIMPLE_PROGRAM)
+  bytecode_object = BytecodeObject('<string>')
+  bytecode_object.parse_code(co_simple)
+
+  for decl in bytecode_object.declarations:
+    assert decl.bytecode_object is bytecode_object
+    assert bytecode_object.get_decl(code_object=decl.code_object) is decl
+
+  assert len(bytecode_object.get_decl(type_name='Foo').methods) == 1
+  assert len(bytecode_object.get_decl(method_name='__init__')) == 2
+  assert bytecode_object.get_decl(method_name='unknown') is None
+
+  # The index follows the code object replacements
+  main_decl = bytecode_object.get_decl(method_name='main')
+  original_co = main_decl.code_object
+  new_co = get_co('def main(): pass').co_consts[0]
+  main_decl.code_object = new_co
+  assert bytecode_object.get_decl(code_object=new_co) is main_decl
+  assert bytecode_object.get_decl(code_object=original_co) is None
+
+
 INHERITANCE_CASE = """
 class Base:
   pass
@@ -147,3 +169,114 @@ def test_inheritance():
     if not isinstance(decl, TypeDeclaration):
       continue
       assert len(decl.superclasses) == TEST_CASE[decl.type_name]
+
+
+NESTED_LINES_PROGRAM = """
+def outer():
+  x = 1
+  def inner():
+    return [
+      x
+    ]
+
+class Foo:
+  def bar(self):
+    pass
+"""
+
+def test_declaration_lines():
+  co_simple = get_co(NESTED_LINES_PROGRAM)
+  bytecode_object = BytecodeObject('<string>')
+  bytecode_object.parse_code(co_simple)
+
+  # The end line accounts for the nested declarations
+  assert bytecode_object.get_decl(method_name='outer').lines == (3, 6)
+  assert bytecode_object.get_decl(method_name='inner').lines == (6, 6)
+  assert bytecode_object.get_decl(type_name='Foo').lines == (9, 11)
+  assert bytecode_object.main_module.lines[:2] == (1, 11)
+
+
+def test_lazy_decode():
+  co_simple = get_co(SIMPLE_PROGRAM)
+  eager = BytecodeObject('<string>')
+  eager.parse_code(co_simple)
+  lazy = BytecodeObject('<string>', lazy_decode=True)
+  lazy.parse_code(co_simple)
+
+  assert len(lazy.declarations) == len(eager.declarations)
+  for decl in eager.declarations:
+    lazy_decl = lazy.get_decl(code_object=decl.code_object)
+    assert type(lazy_decl) == type(decl)
+    assert lazy_decl.lines[:2] == decl.lines[:2]
+    assert [c.code_object for c in lazy_decl.children] == [c.code_object for c in decl.children]
+    if isinstance(decl, TypeDeclaration):
+      assert lazy_decl.superclasses == decl.superclasses
+
+  # The methods are decoded on their own, the module only when needed
+  some_value = lazy.get_decl(method_name='some_value')
+  assert list(some_value.bytecode) == list(eager.get_decl(method_name='some_value').bytecode)
+  assert lazy._bytecode is None
+  assert lazy.main_module.imports == eager.main_module.imports
+
+  # The bytecode visitors decode the declaration they visit
+  class RecordOpsVisitor(BytecodeVisitor):
+    def __init__(self):
+      BytecodeVisitor.__init__(self)
+      self.ops = []
+
+    def visit(self, index, op, arg=None, lineno=None, cflow_in=False):
+      self.ops.append((index, op))
+
+  def record_ops(decl):
+    visitor = RecordOpsVisitor()
+    decl.accept(visitor)
+    return visitor.ops
+
+  lazy_main = lazy.get_decl(method_name='main')
+  assert lazy_main._bytecode is None
+  assert record_ops(lazy_main) == record_ops(eager.get_decl(method_name='main'))
+  assert record_ops(lazy_main)
+
+
+def test_declarations_cache(tmpdir):
+  import py_compile
+  from equip.cache import InstrumentationCache
+
+  source_file = tmpdir.join('simple.py')
+  source_file.write(SIMPLE_PROGRAM)
+  py_compile.compile(str(source_file), doraise=True)
+  pyc_file = str(source_file) + 'c'
+  cache = InstrumentationCache(str(tmpdir.join('cache')))
+
+  eager = BytecodeObject(pyc_file, cache=cache)
+  eager.parse()
+  assert cache.misses == 1 and not eager.lazy_decode
+
+  loaded = BytecodeObject(pyc_file, cache=cache)
+  loaded.parse()
+  assert cache.hits == 1 and loaded.lazy_decode
+  assert loaded._bytecode is None
+
+  assert len(loaded.declarations) == len(eager.declarations)
+  for decl in eager.declarations:
+    loaded_decl = loaded.get_decl(code_object=decl.code_object)
+    assert type(loaded_decl) == type(decl)
+    assert loaded_decl.lines == decl.lines
+    assert [c.code_object for c in loaded_decl.children] == [c.code_object for c in decl.children]
+    if isinstance(decl, TypeDeclaration):
+      assert loaded_decl.superclasses == decl.superclasses
+    elif isinstance(decl, MethodDeclaration):
+      assert loaded_decl.formal_params == decl.formal_params
+  assert loaded.main_module.imports == eager.main_module.imports
+  assert loaded._bytecode is None
+
+  some_value = loaded.get_decl(method_name='some_value')
+  assert list(some_value.bytecode) == list(eager.get_decl(method_name='some_value').bytecode)
+
+  # A corrupted or outdated entry is ignored
+  with open(cache.entry_path(cache.make_declarations_key(open(pyc_file, 'rb').read())), 'wb') as fd:
+    fd.write('garbage')
+  reparsed = BytecodeObject(pyc_file, cache=cache)
+  reparsed.parse()
+  assert not reparsed.lazy_decode
+  assert len(reparsed.declarations) == len(eager.declarations)
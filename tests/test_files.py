@@ -0,0 +1,48 @@
+import os
+import shutil
+import tempfile
+import pytest
+
+from equip.utils.files import iter_files, scan_dir
+
+
+TREE = ('a.py', 'a.pyc', 'README', 'pkg/__init__.py', 'pkg/b.py',
+        'pkg/tests/test_b.py', 'vendor/lib.py', 'vendor/sub/deep.py')
+
+
+@pytest.fixture
+def tree_dir(request):
+  root = tempfile.mkdtemp()
+  for name in TREE:
+    path = os.path.join(root, name)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    open(path, 'w').close()
+  request.addfinalizer(lambda: shutil.rmtree(root))
+  return root
+
+
+def relative(root, files):
+  return [f[len(root) + 1:] for f in files]
+
+
+def test_iter_files(tree_dir):
+  files = relative(tree_dir, iter_files(tree_dir, ('py',)))
+  assert files == ['a.py', 'pkg/__init__.py', 'pkg/b.py', 'pkg/tests/test_b.py',
+                   'vendor/lib.py', 'vendor/sub/deep.py']
+  assert len(list(iter_files(tree_dir))) == len(TREE)
+
+
+def test_iter_files_patterns(tree_dir):
+  files = relative(tree_dir, iter_files(tree_dir, ('py', 'pyc'), exclude=('tests/', 'vendor/')))
+  assert files == ['a.py', 'a.pyc', 'pkg/__init__.py', 'pkg/b.py']
+
+  files = relative(tree_dir, iter_files(tree_dir, include='pkg/*', exclude='__init__.py'))
+  assert files == ['pkg/b.py', 'pkg/tests/test_b.py']
+
+
+def test_scan_dir_dedup(tree_dir):
+  files = []
+  scan_dir(tree_dir, files, ('py',))
+  scan_dir(os.path.join(tree_dir, 'pkg'), files, ('py',))
+  assert len(files) == 6
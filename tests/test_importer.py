@@ -0,0 +1,133 @@
+import os
+import imp
+import sys
+import shutil
+import tempfile
+import pytest
+
+from equip import SimpleRewriter, MethodVisitor
+from equip.importer import InstrumentationFinder, install, uninstall
+
+
+CALLS = []
+
+HOOKED_MODULE = """
+def foo(a):
+  return bar(a) + 1
+
+def bar(a):
+  return a * 2
+"""
+
+
+class RecordCallsVisitor(MethodVisitor):
+  def __init__(self):
+    MethodVisitor.__init__(self)
+
+  def visit(self, meth_decl):
+    rewriter = SimpleRewriter(meth_decl)
+    rewriter.insert_import('from tests.test_importer import CALLS', module_import=True)
+    rewriter.insert_before("CALLS.append('{method_name}')")
+
+
+@pytest.fixture
+def hooked_dir(request):
+  root = tempfile.mkdtemp()
+  os.makedirs(os.path.join(root, 'hooked_pkg'))
+  for name in ('hooked_module.py', 'hooked_pkg/__init__.py', 'hooked_pkg/inner.py'):
+    with open(os.path.join(root, name), 'w') as fd:
+      fd.write(HOOKED_MODULE)
+  sys.path.insert(0, root)
+
+  def finalize():
+    uninstall()
+    sys.path.remove(root)
+    for name in ('hooked_module', 'hooked_pkg', 'hooked_pkg.inner'):
+      sys.modules.pop(name, None)
+    shutil.rmtree(root)
+    del CALLS[:]
+
+  request.addfinalizer(finalize)
+  return root
+
+
+def test_instrument_on_import(hooked_dir):
+  finder = install(RecordCallsVisitor(), modules=('hooked_*',))
+  assert finder in sys.meta_path
+
+  import hooked_module
+  import hooked_pkg.inner
+  assert hooked_module.foo(2) == 5
+  assert hooked_pkg.inner.foo(1) == 3
+  assert hooked_pkg.foo(1) == 3
+  assert CALLS == ['foo', 'bar'] * 3
+
+  # The bytecode files are not modified
+  assert not os.path.exists(os.path.join(hooked_dir, 'hooked_module.pyc'))
+
+
+def test_uninstall(hooked_dir):
+  install(RecordCallsVisitor(), modules=('other_*',))
+  import hooked_module
+  uninstall()
+  assert not [f for f in sys.meta_path if isinstance(f, InstrumentationFinder)]
+  assert hooked_module.foo(2) == 5
+  assert CALLS == []
+
+
+def test_side_cache(hooked_dir):
+  cache_dir = os.path.join(hooked_dir, 'cache')
+  finder = InstrumentationFinder(RecordCallsVisitor(), modules=('hooked_*',),
+                                 cache_dir=cache_dir)
+  path = os.path.join(hooked_dir, 'hooked_module.py')
+  code_object = finder.get_code(path, imp.PY_SOURCE)
+  assert finder.get_code(path, imp.PY_SOURCE) is code_object
+  assert finder.cache.misses == 1
+
+  other_finder = InstrumentationFinder(RecordCallsVisitor(), modules=('hooked_*',),
+                                       cache_dir=cache_dir)
+  cached_code_object = other_finder.get_code(path, imp.PY_SOURCE)
+  assert other_finder.cache.hits == 1
+  assert cached_code_object.co_code == code_object.co_code
+
+
+def test_default_locations(hooked_dir):
+  finder = InstrumentationFinder(RecordCallsVisitor())
+  assert finder.locations == (os.path.abspath(hooked_dir),)
+  assert finder.find_module('hooked_module') is not None
+  # The standard library is not instrumented
+  assert finder.find_module('colorsys') is None
+
+  finder = InstrumentationFinder(RecordCallsVisitor(), modules=('hooked_pkg',))
+  assert finder.locations is None
+  assert finder.find_module('hooked_module') is None
+
+
+def test_loader_protocol(hooked_dir):
+  import pkgutil
+  import runpy
+  install(RecordCallsVisitor(), locations=hooked_dir)
+
+  loader = pkgutil.get_loader('hooked_pkg')
+  assert loader.is_package('hooked_pkg')
+  assert loader.get_source('hooked_pkg') == HOOKED_MODULE
+  assert loader.get_filename('hooked_pkg') == os.path.join(hooked_dir, 'hooked_pkg', '__init__.py')
+
+  loader = pkgutil.get_loader('hooked_module')
+  assert not loader.is_package('hooked_module')
+  assert 'CALLS' in loader.get_code('hooked_module').co_names
+
+  namespace = runpy.run_module('hooked_module')
+  assert namespace['foo'](2) == 5
+  assert CALLS == ['foo', 'bar']
+
+
+def test_side_cache_identical_modules(hooked_dir):
+  cache_dir = os.path.join(hooked_dir, 'cache')
+  finder = InstrumentationFinder(RecordCallsVisitor(), modules=('hooked_*',),
+                                 cache_dir=cache_dir)
+  first = os.path.join(hooked_dir, 'hooked_module.py')
+  second = os.path.join(hooked_dir, 'hooked_pkg', 'inner.py')
+  assert finder.get_code(first, imp.PY_SOURCE).co_filename == first
+  assert finder.get_code(second, imp.PY_SOURCE).co_filename == second
+  assert finder.cache.misses == 2
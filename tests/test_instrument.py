@@ -0,0 +1,357 @@
+import os
+import shutil
+import tempfile
+import pytest
+
+from equip import Instrumentation, SimpleRewriter, MethodVisitor, BytecodeObject
+
+
+PROGRAM_FILES = {
+  'first.py': """
+def foo(a, b):
+  return a + b
+
+class Bar(object):
+  def baz(self):
+    return foo(1, 2)
+""",
+  'second.py': """
+def qux():
+  for i in range(10):
+    if i % 2:
+      continue
+  return i
+""",
+  'sub/__init__.py': '',
+  'sub/third.py': """
+def one():
+  return 1
+
+def two():
+  return one() + 1
+""",
+}
+
+
+class InsertBeforeVisitor(MethodVisitor):
+  def __init__(self):
+    MethodVisitor.__init__(self)
+
+  def visit(self, meth_decl):
+    rewriter = SimpleRewriter(meth_decl)
+    rewriter.insert_before("instr_{method_name} = {lineno}")
+
+
+def make_program(root):
+  for name, content in PROGRAM_FILES.items():
+    path = os.path.join(root, name)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as fd:
+      fd.write(content)
+
+
+def instrument_program(root, visitor, jobs):
+  instr = Instrumentation(root)
+  instr.set_option('force-rebuild')
+  assert instr.prepare_program()
+  instr.apply(visitor, rewrite=True, jobs=jobs)
+  return instr
+
+
+# Returns the marshalled code of each pyc, without the header and with the
+# location of the program stripped from the file names.
+def read_bytecode_files(instr):
+  output = {}
+  for bc_file in instr.program.bytecode_files:
+    with open(bc_file, 'rb') as fd:
+      content = fd.read()[8:].replace(instr.location, '')
+      output[os.path.basename(bc_file)] = content
+  return output
+
+
+@pytest.fixture
+def program_dirs(request):
+  dirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+  for d in dirs:
+    make_program(d)
+  request.addfinalizer(lambda: [shutil.rmtree(d) for d in dirs])
+  return dirs
+
+
+def test_parallel_apply_matches_serial(program_dirs):
+  serial_root, parallel_root = program_dirs
+
+  serial = instrument_program(serial_root, InsertBeforeVisitor(), jobs=1)
+  parallel = instrument_program(parallel_root, InsertBeforeVisitor(), jobs=2)
+
+  assert not parallel.errors
+  assert sorted(os.path.basename(k) for k, v in parallel.results.items() if v) \
+      == ['first.pyc', 'second.pyc', 'third.pyc']
+  assert read_bytecode_files(serial) == read_bytecode_files(parallel)
+
+
+def test_parallel_apply_visitor_path(program_dirs):
+  root = program_dirs[0]
+  instr = instrument_program(root, 'tests.test_instrument:InsertBeforeVisitor', jobs=2)
+  assert not instr.errors
+  assert len([k for k, v in instr.results.items() if v]) == 3
+
+
+def test_parallel_apply_errors(program_dirs):
+  root = program_dirs[0]
+  instr = instrument_program(root, 'tests.test_instrument:UnknownVisitor', jobs=2)
+  assert len(instr.errors) == len(instr.program.bytecode_files)
+  assert 'UnknownVisitor' in instr.errors.values()[0]
+
+
+class FailingVisitor(InsertBeforeVisitor):
+  def visit(self, meth_decl):
+    if meth_decl.method_name == 'qux':
+      raise ValueError('Cannot visit qux')
+    InsertBeforeVisitor.visit(self, meth_decl)
+
+
+def test_serial_apply_errors(program_dirs):
+  root = program_dirs[0]
+  instr = instrument_program(root, FailingVisitor(), jobs=1)
+  assert [os.path.basename(k) for k in instr.errors] == ['second.pyc']
+  assert 'Cannot visit qux' in instr.errors.values()[0]
+  assert sorted(os.path.basename(k) for k, v in instr.results.items() if v) \
+      == ['first.pyc', 'third.pyc']
+
+
+class CountingVisitor(InsertBeforeVisitor):
+  visited = 0
+
+  def visit(self, meth_decl):
+    CountingVisitor.visited += 1
+    InsertBeforeVisitor.visit(self, meth_decl)
+
+
+def test_cache_restores_instrumented_files(program_dirs):
+  root, cache_dir = program_dirs
+  shutil.rmtree(cache_dir)
+
+  instr = Instrumentation(root)
+  instr.set_option('force-rebuild')
+  instr.set_option('cache-dir', cache_dir)
+  assert instr.prepare_program()
+
+  CountingVisitor.visited = 0
+  instr.apply(CountingVisitor(), rewrite=True)
+  assert CountingVisitor.visited == 5
+  assert instr.cache.misses == 4
+  instrumented = read_bytecode_files(instr)
+
+  # Running again on the instrumented program is free
+  CountingVisitor.visited = 0
+  instr.apply(CountingVisitor(), rewrite=True)
+  assert CountingVisitor.visited == 0
+  assert instr.results.values().count(True) == 0
+
+  # Fresh bytecode is restored from the cache
+  for bc_file in instr.program.bytecode_files:
+    os.remove(bc_file)
+  instr.program.compile_program()
+  assert read_bytecode_files(instr) != instrumented
+  instr.apply(CountingVisitor(), rewrite=True)
+  assert CountingVisitor.visited == 0
+  assert instr.results.values().count(True) == 3
+  assert read_bytecode_files(instr) == instrumented
+
+
+class UnpicklableVisitor(CountingVisitor):
+  def __init__(self):
+    CountingVisitor.__init__(self)
+    self.callback = lambda: None
+
+
+class KeyedVisitor(UnpicklableVisitor):
+  def cache_key(self):
+    return 'keyed'
+
+
+def test_cache_unfingerprintable_visitor(program_dirs):
+  root, cache_dir = program_dirs
+  shutil.rmtree(cache_dir)
+
+  instr = Instrumentation(root)
+  instr.set_option('force-rebuild')
+  instr.set_option('cache-dir', cache_dir)
+  assert instr.prepare_program()
+
+  # Without a cache_key(), the visitor cannot be pickled and the cache is disabled
+  visitor = UnpicklableVisitor()
+  assert instr.cache.fingerprint(visitor, instr.wrapping_code) is None
+  CountingVisitor.visited = 0
+  instr.apply(visitor, rewrite=True)
+  assert CountingVisitor.visited == 5
+  assert instr.cache.misses == 0
+  assert not os.path.exists(cache_dir) or not os.listdir(cache_dir)
+
+  # The cache_key() is used instead of the pickled state
+  instr.apply(KeyedVisitor(), rewrite=True)
+  assert instr.cache.misses == 4
+  CountingVisitor.visited = 0
+  instr.apply(KeyedVisitor(), rewrite=True)
+  assert CountingVisitor.visited == 0
+
+
+def test_cache_fingerprint_selector(program_dirs):
+  from equip.selector import Selector
+  root, cache_dir = program_dirs
+
+  instr = Instrumentation(root)
+  instr.set_option('cache-dir', cache_dir)
+  cache = instr.cache
+  visitor = InsertBeforeVisitor()
+  first = cache.fingerprint(visitor, instr.wrapping_code, Selector(method_name='foo'))
+  # The memo is a single slot keyed on the caller's visitor
+  assert cache.fingerprint(visitor, instr.wrapping_code, Selector(method_name='foo')) == first
+  assert cache._last_fingerprint[0] is visitor
+  assert cache.fingerprint(visitor, instr.wrapping_code, Selector(method_name='bar')) != first
+  assert cache.fingerprint(visitor, instr.wrapping_code) != first
+
+
+def test_streaming_apply(program_dirs):
+  batch_root, stream_root = program_dirs
+
+  batch = instrument_program(batch_root, InsertBeforeVisitor(), jobs=1)
+
+  instr = Instrumentation(stream_root)
+  instr.set_option('max-in-flight', 1)
+  assert instr.prepare_program()
+  instr.apply(InsertBeforeVisitor(), rewrite=True, jobs=2, stream=True)
+  assert not instr.errors
+  assert len(instr.results) == 4
+  assert read_bytecode_files(batch) == read_bytecode_files(instr)
+
+  # The bytecode files are already compiled and instrumented
+  instr.apply(InsertBeforeVisitor(), rewrite=True, stream=True)
+  assert sorted(instr.results) == sorted(instr.program.bytecode_files)
+
+
+def test_shadow_tree(program_dirs):
+  from equip.shadow import ShadowTree
+  root, shadow_dir = program_dirs
+  shutil.rmtree(shadow_dir)
+
+  instr = Instrumentation(root)
+  instr.set_option('shadow-dir', shadow_dir)
+  assert instr.prepare_program()
+  original = read_bytecode_files(instr)
+  instr.apply(InsertBeforeVisitor(), rewrite=True)
+  assert instr.results.values().count(True) == 3
+
+  # The program is untouched, and mirrored in both trees
+  assert read_bytecode_files(instr) == original
+  shadow = instr.shadow
+  for bc_file in instr.program.bytecode_files:
+    rel_path = bc_file[len(root) + 1:]
+    original_bc = os.path.join(shadow_dir, 'original', rel_path)
+    instrumented_bc = os.path.join(shadow_dir, 'instrumented', rel_path)
+    assert open(original_bc, 'rb').read() == open(bc_file, 'rb').read()
+    assert os.path.samefile(os.path.join(shadow_dir, 'original', rel_path[:-1]), bc_file[:-1])
+    if not rel_path.endswith('__init__.pyc'):
+      assert open(instrumented_bc, 'rb').read() != open(bc_file, 'rb').read()
+
+  assert shadow.active is None
+  shadow.activate(ShadowTree.INSTRUMENTED)
+  assert shadow.active == ShadowTree.INSTRUMENTED
+  shadow.activate(ShadowTree.ORIGINAL)
+  assert os.path.realpath(shadow.current_path) == os.path.join(shadow_dir, 'original')
+
+
+def test_shadow_tree_mirrors_program(program_dirs):
+  root, shadow_dir = program_dirs
+  shutil.rmtree(shadow_dir)
+  with open(os.path.join(root, 'sub', 'data.json'), 'w') as fd:
+    fd.write('{}')
+
+  instr = Instrumentation(root)
+  instr.set_option('shadow-dir', shadow_dir)
+  instr.set_option('exclude', 'sub/')
+  assert instr.prepare_program()
+  instr.apply(InsertBeforeVisitor(), rewrite=True)
+  assert instr.results.values().count(True) == 2
+
+  # The excluded module and the data file are mirrored in both trees
+  for tree in ('original', 'instrumented'):
+    for rel_path in ('sub/third.py', 'sub/data.json'):
+      assert os.path.samefile(os.path.join(shadow_dir, tree, rel_path),
+                              os.path.join(root, rel_path))
+
+
+def test_shadow_tree_copies(program_dirs, monkeypatch):
+  from equip.shadow import ShadowTree
+  root, shadow_dir = program_dirs
+  shutil.rmtree(shadow_dir)
+  copied = []
+  copy_file = ShadowTree.copy_file
+  def record_copy(src, dst):
+    copied.append(src)
+    copy_file(src, dst)
+  monkeypatch.setattr(ShadowTree, 'copy_file', staticmethod(record_copy))
+
+  instr = Instrumentation(root)
+  instr.set_option('force-rebuild')
+  instr.set_option('shadow-dir', shadow_dir)
+  assert instr.prepare_program()
+  assert instr.shadow is instr.shadow
+  instr.apply(InsertBeforeVisitor(), rewrite=True)
+  # Each bytecode file is copied once in each tree
+  assert sorted(copied) == sorted(instr.program.bytecode_files * 2)
+
+  # A bytecode file compiled after the shadow trees were populated is mirrored
+  del copied[:]
+  bc_file = instr.program.bytecode_files[0]
+  stat = os.stat(bc_file)
+  os.utime(bc_file, (stat.st_atime, stat.st_mtime + 10))
+  instr.instrument(InsertBeforeVisitor(), bc_file, rewrite=True)
+  assert copied == [bc_file, bc_file]
+
+
+def test_lazy_decode_matches_eager(program_dirs):
+  eager_root, lazy_root = program_dirs
+  eager = instrument_program(eager_root, InsertBeforeVisitor(), jobs=1)
+
+  lazy = Instrumentation(lazy_root)
+  lazy.set_option('force-rebuild')
+  lazy.set_option('lazy-decode')
+  assert lazy.prepare_program()
+  lazy.apply(InsertBeforeVisitor(), rewrite=True)
+  assert read_bytecode_files(eager) == read_bytecode_files(lazy)
+
+
+class InsertAfterVisitor(MethodVisitor):
+  def __init__(self):
+    MethodVisitor.__init__(self)
+
+  def visit(self, meth_decl):
+    rewriter = SimpleRewriter(meth_decl)
+    rewriter.insert_after("after_{method_name} = {lineno}")
+
+
+def test_apply_visitors_list(program_dirs):
+  sequential_root, fused_root = program_dirs
+  sequential = Instrumentation(sequential_root)
+  sequential.set_option('force-rebuild')
+  assert sequential.prepare_program()
+  for bc_file in sequential.program.bytecode_files:
+    code = BytecodeObject(bc_file)
+    code.accept(InsertBeforeVisitor())
+    code.accept(InsertAfterVisitor())
+    if code.has_changes:
+      code.write()
+
+  visitors = ['tests.test_instrument:InsertBeforeVisitor', InsertAfterVisitor()]
+  fused = instrument_program(fused_root, visitors, jobs=1)
+  assert read_bytecode_files(sequential) == read_bytecode_files(fused)
+
+  shutil.rmtree(fused_root)
+  make_program(fused_root)
+  paths = ['tests.test_instrument:InsertBeforeVisitor', 'tests.test_instrument:InsertAfterVisitor']
+  parallel = instrument_program(fused_root, paths, jobs=2)
+  assert not parallel.errors
+  assert read_bytecode_files(sequential) == read_bytecode_files(parallel)
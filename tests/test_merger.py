@@ -28,3 +28,309 @@ def test_already_merged():
   assert Merger.already_instrumented(instrumented, instrument)
 
 
+
+
+BATCH_PROGRAM = """
+import sys
+
+def foo(a, b):
+  if a:
+    return b
+  for i in range(a):
+    if i > b:
+      break
+  return a + b
+
+class Bar(object):
+  def baz(self, x):
+    while x:
+      x -= 1
+    return x
+"""
+
+
+def rewrite_methods(co, batch):
+  from equip import BytecodeObject, SimpleRewriter
+  from equip.rewriter.simple import GLOBAL_IMPORTS_ADDED
+  GLOBAL_IMPORTS_ADDED.clear()
+
+  bytecode_object = BytecodeObject('<string>')
+  bytecode_object.parse_code(co)
+  for method_name in ('foo', 'baz'):
+    rewriter = SimpleRewriter(bytecode_object.get_decl(method_name=method_name))
+    if batch:
+      rewriter.begin_batch()
+    rewriter.insert_import('import os', module_import=True)
+    rewriter.insert_before("os.getenv('enter_{method_name}')")
+    rewriter.insert_before("os.getenv('first_{method_name}', {lineno})")
+    rewriter.insert_after("os.getenv('exit_{method_name}', {return_value})")
+    rewriter.insert_after("os.getenv('last_{method_name}')")
+    if batch:
+      # Duplicated probes are only inserted once
+      rewriter.insert_before("os.getenv('first_{method_name}', {lineno})")
+      assert len(rewriter.plan) == (5 if method_name == 'foo' else 4)
+      rewriter.apply_batch()
+  bytecode_object.commit()
+  return bytecode_object.get_module().code_object
+
+
+def test_batch_insertions():
+  co = get_co(BATCH_PROGRAM)
+  sequential_co = rewrite_methods(co, batch=False)
+  batch_co = rewrite_methods(co, batch=True)
+
+  # Same code as the successive merges. The line numbers of the probes are the
+  # ones of the instrumented instructions, instead of being decoded again from the
+  # intermediate code objects.
+  get_foo = lambda module_co: [c for c in module_co.co_consts if getattr(c, 'co_name', None) == 'foo'][0]
+  for field in ('co_code', 'co_consts', 'co_names', 'co_varnames', 'co_nlocals', 'co_stacksize'):
+    assert getattr(get_foo(batch_co), field) == getattr(get_foo(sequential_co), field)
+
+  namespace = {}
+  exec batch_co in namespace
+  assert namespace['foo'](0, 2) == 2
+  assert namespace['foo'](1, 2) == 2
+  assert namespace['Bar']().baz(3) == 0
+  assert set(['enter_baz', 'first_baz', 'exit_baz', 'last_baz']) \
+         <= set(namespace['Bar'].baz.im_func.func_code.co_consts)
+
+
+def test_batch_context():
+  from equip import BytecodeObject, SimpleRewriter
+  bytecode_object = BytecodeObject('<string>')
+  bytecode_object.parse_code(get_co(BATCH_PROGRAM))
+  decl = bytecode_object.get_decl(method_name='foo')
+  original_co = decl.code_object
+
+  with pytest.raises(ValueError):
+    with SimpleRewriter(decl).batch() as rewriter:
+      rewriter.insert_before("x = 1")
+      raise ValueError()
+  assert decl.code_object is original_co and rewriter.plan is None
+
+  with SimpleRewriter(decl).batch() as rewriter:
+    rewriter.insert_before("x = 1")
+    assert decl.code_object is original_co
+  assert decl.code_object is not original_co
+
+
+NESTED_PROGRAM = """
+class Outer(object):
+  def first(self):
+    def inner():
+      return 1
+    return inner()
+
+  def second(self, x):
+    return x + 1
+"""
+
+
+def test_deferred_propagation(monkeypatch):
+  from equip import BytecodeObject, SimpleRewriter
+  from equip.rewriter.simple import GLOBAL_IMPORTS_ADDED
+  import equip.bytecode.code
+  GLOBAL_IMPORTS_ADDED.clear()
+  rebuilt = []
+  replace_nested_code_objects = equip.bytecode.code.replace_nested_code_objects
+  def count_rebuilds(main_co, replacements):
+    rebuilt.append(main_co.co_name)
+    return replace_nested_code_objects(main_co, replacements)
+  monkeypatch.setattr(equip.bytecode.code, 'replace_nested_code_objects', count_rebuilds)
+
+  bytecode_object = BytecodeObject('<string>')
+  bytecode_object.parse_code(get_co(NESTED_PROGRAM))
+  module_decl = bytecode_object.get_module()
+  class_co = bytecode_object.get_decl(type_name='Outer').code_object
+  for decl in sorted(bytecode_object.declarations, key=lambda d: d.lines):
+    if decl.is_type() or decl.is_module():
+      continue
+    rewriter = SimpleRewriter(decl)
+    rewriter.insert_import('import os', module_import=True)
+    rewriter.insert_before("os.getenv('enter_{method_name}')")
+    rewriter.insert_after("os.getenv('exit_{method_name}')")
+  # The parents still hold the original code objects
+  assert class_co in module_decl.code_object.co_consts
+  assert rebuilt == []
+
+  # Checking for changes does not commit them
+  assert bytecode_object.has_changes
+  assert rebuilt == []
+
+  bytecode_object.commit()
+  assert sorted(rebuilt) == ['<module>', 'Outer', 'first']
+  new_co = module_decl.code_object
+  assert class_co not in new_co.co_consts
+  assert bytecode_object.has_changes
+  bytecode_object.commit()
+  assert bytecode_object.get_module().code_object is new_co
+
+  namespace = {}
+  exec new_co in namespace
+  outer = namespace['Outer']
+  assert outer().first() == 1
+  assert outer().second(1) == 2
+  first_co = outer.first.im_func.func_code
+  inner_co = [c for c in first_co.co_consts if getattr(c, 'co_name', None) == 'inner'][0]
+  assert set(['enter_first', 'exit_first']) <= set(first_co.co_consts)
+  assert set(['enter_inner', 'exit_inner']) <= set(inner_co.co_consts)
+  assert set(['enter_second', 'exit_second']) <= set(outer.second.im_func.func_code.co_consts)
+
+
+def test_propagation_without_bytecode_object():
+  from equip import BytecodeObject, SimpleRewriter
+  from equip.rewriter.simple import GLOBAL_IMPORTS_ADDED
+  bytecode_object = BytecodeObject('<string>')
+  bytecode_object.parse_code(get_co(NESTED_PROGRAM))
+  module_decl = bytecode_object.get_module()
+  inner_decl = bytecode_object.get_decl(method_name='inner')
+  first_decl = bytecode_object.get_decl(method_name='first')
+  # The parents are then rebuilt right away, for each insertion
+  for decl in bytecode_object.declarations:
+    decl.bytecode_object = None
+
+  GLOBAL_IMPORTS_ADDED.clear()
+  for decl in (inner_decl, first_decl, inner_decl):
+    rewriter = SimpleRewriter(decl)
+    rewriter.insert_import('import os', module_import=True)
+    rewriter.insert_before("os.getenv('enter_{method_name}')")
+    rewriter.insert_after("os.getenv('exit_{method_name}')")
+    assert decl.code_object in decl.parent.code_object.co_consts
+    assert module_decl.has_changes
+
+  namespace = {}
+  exec module_decl.code_object in namespace
+  first_co = namespace['Outer'].first.im_func.func_code
+  inner_co = [c for c in first_co.co_consts if getattr(c, 'co_name', None) == 'inner'][0]
+  assert namespace['Outer']().first() == 1
+  assert inner_co is inner_decl.code_object
+  assert set(['enter_first', 'exit_first']) <= set(first_co.co_consts)
+  assert set(['enter_inner', 'exit_inner']) <= set(inner_co.co_consts)
+
+
+def test_extended_jump_arguments():
+  import os
+  import types
+  import opcode
+  branches = 1700
+  source = "def f(x):\n  y = 0\n" \
+         + "".join("  if x == %d:\n    y = x + %d\n  else:\n    y = x - 1\n" % (i, i) \
+                   for i in range(branches)) \
+         + "  return y\n"
+  namespace = {}
+  exec compile(source, '<string>', 'exec') in namespace
+  co_source = namespace['f'].func_code
+  assert len(co_source.co_code) < 0x10000
+
+  # The probe pushes the jumps to the end of the function past 64K
+  probe = get_co("if os.getenv('enter'):\n  os.getenv('again')\n" * 400)
+  new_co = Merger.merge(co_source, probe, Merger.BEFORE, ins_import_names=set(['os']))
+  assert len(new_co.co_code) > 0x10000
+  assert chr(opcode.EXTENDED_ARG) in new_co.co_code
+
+  instrumented = types.FunctionType(new_co, {'os': os})
+  for x in (0, 5, branches - 1, branches + 1):
+    assert instrumented(x) == namespace['f'](x)
+
+
+def test_merged_constants():
+  import types
+  source = "def f(x):\n  if x == 1:\n    return 0\n  if x == 2:\n    return 0.0\n  return (0.0, 1)\n"
+  namespace = {}
+  exec compile(source, '<string>', 'exec') in namespace
+  co_source = namespace['f'].func_code
+
+  # Equal to the constants of the function, but of other types
+  probe = get_co("results.append((0, 1))\nresults.append(-0.0)\nresults.append(0L)")
+  new_co = Merger.merge(co_source, probe, Merger.BEFORE, ins_import_names=set(['results']))
+  results = []
+  instrumented = types.FunctionType(new_co, {'results': results})
+  assert type(instrumented(1)) is int
+  assert type(instrumented(2)) is float
+  assert type(instrumented(3)[0]) is float
+  assert type(results[0][0]) is int
+  assert str(results[1]) == '-0.0'
+  assert type(results[2]) is long
+
+
+def test_merged_free_variables():
+  import types
+  source = "def outer(a):\n" \
+           "  def f(x):\n" \
+           "    b = x + a\n" \
+           "    return lambda: a + b\n" \
+           "  return f\n"
+  namespace = {}
+  exec compile(source, '<string>', 'exec') in namespace
+  f = namespace['outer'](1)
+  co_source = f.func_code
+  assert co_source.co_cellvars == ('b',) and co_source.co_freevars == ('a',)
+
+  probe = get_co("results.append(1)")
+  new_co = Merger.merge(co_source, probe, Merger.BEFORE, ins_import_names=set(['results']))
+  results = []
+  instrumented = types.FunctionType(new_co, {'results': results}, 'f', None, f.func_closure)
+  assert instrumented(2)() == 4
+  assert results == [1]
+
+
+def test_probe_markers():
+  from equip import BytecodeObject, SimpleRewriter
+  from equip.rewriter.simple import GLOBAL_IMPORTS_ADDED
+  co_source = [c for c in get_co(BATCH_PROGRAM).co_consts if getattr(c, 'co_name', None) == 'foo'][0]
+  probe = get_co("os.getenv('probe')")
+
+  new_co = Merger.merge(co_source, probe, Merger.BEFORE, ins_import_names=set(['os']))
+  assert Merger.get_probe_marker(probe, Merger.BEFORE) in new_co.co_consts
+  assert Merger.merge(new_co, probe, Merger.BEFORE) is None
+  # The same probe at another location is merged
+  assert Merger.merge(new_co, probe, Merger.AFTER) is not None
+  assert Merger.merge_all(new_co, [(probe, Merger.BEFORE, -1, -1)]) is None
+
+  def rewrite(co):
+    GLOBAL_IMPORTS_ADDED.clear()
+    bytecode_object = BytecodeObject('<string>')
+    bytecode_object.parse_code(co)
+    for decl in bytecode_object.declarations:
+      if decl.is_module() or decl.is_type():
+        continue
+      rewriter = SimpleRewriter(decl)
+      rewriter.insert_import('import os', module_import=True)
+      rewriter.insert_before("os.getenv('enter_{method_name}')")
+      rewriter.insert_after("os.getenv('exit_{method_name}', {return_value})")
+    bytecode_object.commit()
+    return bytecode_object
+
+  bytecode_object = rewrite(get_co(BATCH_PROGRAM))
+  assert bytecode_object.has_changes
+  # Instrumenting the instrumented code again does not change it
+  assert not rewrite(bytecode_object.get_module().code_object).has_changes
+
+
+def test_lnotab():
+  import types
+  from dis import findlinestarts
+  from equip import BytecodeObject
+  from equip.rewriter.merger import CodeObject
+  # Large increments of lines and offsets are split in several entries
+  source = "def f(x):\n  y = [x,\n" + "x,\n" * 300 + "x]\n" \
+         + "  z = [" + "x, " * 200 + "x]\n" \
+         + "\n" * 600 + "  return y, z\n"
+  namespace = {}
+  exec compile(source, '<string>', 'exec') in namespace
+  co_source = namespace['f'].func_code
+
+  new_co = CodeObject(co_source)
+  new_co.reset_code()
+  for index, lineno, op, arg, _, _ in BytecodeObject.get_parsed_code(co_source):
+    new_co.append(op, arg, index, lineno)
+  assert new_co.to_code().co_lnotab == co_source.co_lnotab
+
+  probe = get_co("os.getenv('enter')")
+  merged_co = Merger.merge(co_source, probe, Merger.BEFORE, ins_import_names=set(['os']))
+  probe_size = len(merged_co.co_code) - len(co_source.co_code)
+  # One entry per line change, the probe runs on the first line of the body
+  assert list(findlinestarts(merged_co)) \
+      == [(0, 2)] + [(offset + probe_size, lineno) \
+                     for offset, lineno in findlinestarts(co_source)][1:]
+  assert len(merged_co.co_lnotab) == len(co_source.co_lnotab)
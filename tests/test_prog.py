@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import pytest
+
+from equip import Instrumentation, Program
+
+
+PROGRAM_FILES = {
+  'first.py': "def foo():\n  return 1\n",
+  'second.py': "def bar():\n  return 2\n",
+  'sub/__init__.py': '',
+  'sub/third.py': "def baz():\n  return 3\n",
+}
+
+
+@pytest.fixture
+def program_dir(request):
+  root = tempfile.mkdtemp()
+  for name, content in PROGRAM_FILES.items():
+    path = os.path.join(root, name)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as fd:
+      fd.write(content)
+  request.addfinalizer(lambda: shutil.rmtree(root))
+  return root
+
+
+def get_program(root, **options):
+  instr = Instrumentation(root)
+  for key, value in options.items():
+    instr.set_option(key, value)
+  assert instr.prepare_program()
+  return instr.program
+
+
+def pyc_mtimes(program):
+  return dict((os.path.basename(f), os.stat(f).st_mtime) for f in program.bytecode_files)
+
+
+def test_compile_missing_bytecode(program_dir):
+  program = get_program(program_dir, jobs=2)
+  assert len(program.bytecode_files) == 4
+  assert not Program.find_stale_sources([f[:-1] for f in program.bytecode_files])
+
+
+def test_compile_stale_only(program_dir):
+  program = get_program(program_dir)
+  program.bytecode_files
+  for bc_file in program.bytecode_files:
+    os.utime(bc_file, (0, 0))
+
+  # The source is newer than its bytecode
+  source = os.path.join(program_dir, 'second.py')
+  stat = os.stat(source)
+  os.utime(source, (stat.st_atime, stat.st_mtime + 10))
+  assert Program.is_stale(source)
+
+  program.create_program()
+  mtimes = pyc_mtimes(program)
+  assert mtimes.pop('second.pyc') > 0
+  assert mtimes.values() == [0, 0, 0]
+
+
+def test_force_rebuild(program_dir):
+  program = get_program(program_dir, **{'force-rebuild': True})
+  program.bytecode_files
+  for bc_file in program.bytecode_files:
+    os.utime(bc_file, (0, 0))
+
+  program.create_program()
+  assert 0 not in pyc_mtimes(program).values()
+
+
+def test_exclude_files(program_dir):
+  program = get_program(program_dir, exclude='sub/')
+  assert sorted(os.path.basename(f) for f in program.bytecode_files) \
+      == ['first.pyc', 'second.pyc']
+  assert not os.path.exists(os.path.join(program_dir, 'sub', 'third.pyc'))
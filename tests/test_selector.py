@@ -0,0 +1,184 @@
+import os
+import shutil
+import tempfile
+import pytest
+from testutils import get_co
+
+from equip import BytecodeObject, Instrumentation, MethodVisitor, ClassVisitor, \
+                  CompositeVisitor, Selector, SimpleRewriter
+
+
+DECORATED_PROGRAM = """
+import app
+
+def helper(x):
+  return x
+
+class PaymentHandler(object):
+  @app.route('/pay')
+  def handle_pay(self, amount=helper):
+    return amount
+
+  def handle_refund(self):
+    def inner():
+      return 1
+    return inner
+
+  @staticmethod
+  def other():
+    pass
+
+@app.route('/')
+def handle_index():
+  pass
+
+class Unrelated(object):
+  def handle_nothing(self):
+    pass
+"""
+
+
+class RecordVisitor(MethodVisitor):
+  def __init__(self):
+    MethodVisitor.__init__(self)
+    self.names = []
+
+  def visit(self, meth_decl):
+    self.names.append(meth_decl.method_name)
+
+
+class RecordClassesVisitor(ClassVisitor):
+  def __init__(self):
+    ClassVisitor.__init__(self)
+    self.names = []
+
+  def visit(self, type_decl):
+    self.names.append(type_decl.type_name)
+
+
+def select(selector, visitor_class=RecordVisitor):
+  bytecode_object = BytecodeObject('<string>')
+  bytecode_object.parse_code(get_co(DECORATED_PROGRAM))
+  visitor = visitor_class()
+  bytecode_object.accept(CompositeVisitor([visitor], selector=Selector.parse(selector)))
+  return sorted(visitor.names)
+
+
+def test_parse():
+  selector = Selector.parse('module=payments.* class=*Handler method=^handle_ '
+                            'decorator=route lines=10-')
+  assert selector.module == 'payments.*'
+  assert selector.type_name == '*Handler'
+  assert selector.method_name == '^handle_'
+  assert selector.decorator == 'route'
+  assert selector.lines == (10, None)
+  assert Selector.parse(repr(selector)[len('Selector('):-1]).lines == (10, None)
+  assert Selector.parse('lines=4').lines == (4, 4)
+
+  with pytest.raises(Exception):
+    Selector.parse('function=foo')
+  with pytest.raises(Exception):
+    Selector.parse('lines=a-b')
+
+
+def test_select_declarations():
+  assert select('method=^handle_') \
+      == ['handle_index', 'handle_nothing', 'handle_pay', 'handle_refund']
+  assert select('class=*Handler') \
+      == ['handle_pay', 'handle_refund', 'inner', 'other']
+  assert select('class=*Handler method=^handle_') == ['handle_pay', 'handle_refund']
+  assert select('decorator=route') == ['handle_index', 'handle_pay']
+  assert select('decorator=app.route class=Payment*') == ['handle_pay']
+  assert select('decorator=staticmethod') == ['other']
+  assert select('lines=14-15') == ['handle_refund', 'inner']
+  assert select('class=*Handler', RecordClassesVisitor) == ['PaymentHandler']
+  assert select('method=.', RecordClassesVisitor) == []
+
+
+BASES_PROGRAM = """
+import app
+
+class Base(object):
+  pass
+
+@app.register
+class Derived(Base):
+  def method(self, default=app.route):
+    pass
+
+def outer(value):
+  @app.cache(value)
+  @app.route
+  def inner(self, default=Base):
+    return value
+  return inner
+"""
+
+
+def test_get_decorators():
+  bytecode_object = BytecodeObject('<string>')
+  bytecode_object.parse_code(get_co(BASES_PROGRAM))
+  decorators = dict((decl.type_name if decl.is_type() else decl.method_name,
+                     Selector.get_decorators(decl)) \
+                    for decl in bytecode_object.declarations if not decl.is_module())
+  # The bases and the default values are not decorators
+  assert decorators == {
+    'Base': [],
+    'Derived': ['app.register'],
+    'method': [],
+    'outer': [],
+    'inner': ['app.cache', 'app.route'],
+  }
+  assert not Selector.parse('decorator=Base').matches(bytecode_object.get_decl(type_name='Derived'))
+
+
+def test_select_code():
+  co = get_co(DECORATED_PROGRAM)
+  assert Selector.parse('method=^handle_pay$').select_code(co)
+  assert Selector.parse('decorator=route').select_code(co)
+  assert Selector.parse('module=foo').select_code(co)
+  assert not Selector.parse('method=^unknown$').select_code(co)
+  assert not Selector.parse('decorator=unknown').select_code(co)
+  assert not Selector.parse('class=Unrelated lines=1-20').select_code(co)
+
+
+class InsertBeforeVisitor(MethodVisitor):
+  def __init__(self):
+    MethodVisitor.__init__(self)
+
+  def visit(self, meth_decl):
+    rewriter = SimpleRewriter(meth_decl)
+    rewriter.insert_before("instr_{method_name} = {lineno}")
+
+
+def test_apply_selector(request):
+  root = tempfile.mkdtemp()
+  request.addfinalizer(lambda: shutil.rmtree(root))
+  os.makedirs(os.path.join(root, 'payments'))
+  sources = {
+    'payments/__init__.py': '',
+    'payments/handlers.py': 'def handle_pay():\n  pass\n\ndef other():\n  pass\n',
+    'payments/models.py': 'def save():\n  pass\n',
+    'reports.py': 'def handle_report():\n  pass\n',
+  }
+  for name, content in sources.items():
+    with open(os.path.join(root, name), 'w') as fd:
+      fd.write(content)
+
+  instr = Instrumentation(root)
+  instr.set_option('force-rebuild')
+  assert instr.prepare_program()
+  assert instr.get_module_name(os.path.join(root, 'payments', 'handlers.pyc')) \
+      == 'payments.handlers'
+  assert instr.get_module_name(os.path.join(root, 'payments', '__init__.pyc')) == 'payments'
+
+  instr.apply(InsertBeforeVisitor(), rewrite=True, selector='module=payments.* method=^handle_')
+  written = sorted(os.path.relpath(k, root) for k, v in instr.results.items() if v)
+  assert written == ['payments/handlers.pyc']
+
+  code = BytecodeObject(os.path.join(root, 'payments', 'handlers.pyc'))
+  code.parse()
+  names = dict((d.method_name, d.code_object.co_names) for d in code.declarations \
+               if not d.is_module())
+  assert 'instr_handle_pay' in names['handle_pay']
+  assert 'instr_other' not in names['other']
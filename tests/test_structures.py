@@ -0,0 +1,18 @@
+from equip.utils.structures import lrucache
+
+
+def test_lrucache_eviction():
+  cache = lrucache(maxsize=2)
+  cache.put('a', 1)
+  cache.put('b', 2)
+  assert cache.get('a') == 1
+  cache.put('c', 3)
+
+  # 'b' is the least recently used
+  assert 'b' not in cache
+  assert cache.get('b') is None
+  assert cache.get('c') == 3
+  assert cache.stats() == {'size': 2, 'maxsize': 2, 'hits': 2, 'misses': 1, 'evictions': 1}
+
+  cache.discard('a')
+  assert len(cache) == 1
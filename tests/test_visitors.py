@@ -1,7 +1,7 @@
 import pytest
 from testutils import get_co, get_bytecode
 
-from equip import BytecodeObject, BlockVisitor
+from equip import BytecodeObject, BlockVisitor, BytecodeVisitor
 from equip.bytecode import MethodDeclaration, TypeDeclaration, ModuleDeclaration
 from equip.bytecode.utils import show_bytecode
 
@@ -132,3 +132,181 @@ def test_block_visitor():
 
 
 
+
+
+def test_composite_visitor():
+  from equip import MethodVisitor, ClassVisitor, BytecodeVisitor, CompositeVisitor
+
+  class RecordMethodsVisitor(MethodVisitor):
+    def __init__(self):
+      MethodVisitor.__init__(self)
+      self.names = []
+
+    def visit(self, meth_decl):
+      self.names.append(meth_decl.method_name)
+
+  class RecordClassesVisitor(ClassVisitor):
+    def __init__(self):
+      ClassVisitor.__init__(self)
+      self.names = []
+
+    def visit(self, type_decl):
+      self.names.append(type_decl.type_name)
+
+  class RecordCFGVisitor(BlockVisitor):
+    def __init__(self):
+      BlockVisitor.__init__(self)
+      self.control_flows = []
+
+    def new_control_flow(self):
+      self.control_flows.append(self.control_flow)
+
+  class CountReturnsVisitor(BytecodeVisitor):
+    def __init__(self):
+      BytecodeVisitor.__init__(self)
+      self.count = 0
+
+    def visit_return_value(self):
+      self.count += 1
+
+  def make_visitors():
+    return [RecordMethodsVisitor(), RecordClassesVisitor(), RecordCFGVisitor(),
+            RecordCFGVisitor(), CountReturnsVisitor()]
+
+  co_simple = get_co(SIMPLE_PROGRAM + "\nclass Foo(object):\n  def bar(self):\n    pass\n")
+
+  separate = make_visitors()
+  bytecode_object = BytecodeObject('<string>')
+  bytecode_object.parse_code(co_simple)
+  for visitor in separate:
+    bytecode_object.accept(visitor)
+
+  fused = make_visitors()
+  bytecode_object = BytecodeObject('<string>')
+  bytecode_object.parse_code(co_simple)
+  bytecode_object.accept(CompositeVisitor(fused))
+
+  assert fused[0].names == separate[0].names
+  assert 'bar' in fused[0].names
+  assert fused[1].names == separate[1].names == ['Foo']
+  assert fused[4].count == separate[4].count > 0
+
+  # The CFG of each declaration is built once for all the block visitors
+  assert len(fused[2].control_flows) == len(separate[2].control_flows)
+  assert fused[2].control_flows == fused[3].control_flows
+  assert all(cflow is not other for cflow, other \
+             in zip(separate[2].control_flows, separate[3].control_flows))
+  assert set(id(c.decl) for c in fused[2].control_flows) \
+      == set(id(d) for d in bytecode_object.declarations)
+
+  with pytest.raises(Exception):
+    CompositeVisitor([object()])
+
+
+def test_bytecode_visitor_dispatch():
+  import opcode
+  from equip import BytecodeVisitor
+  from equip.visitors.bytecode import MISSING_HANDLER
+
+  class CallFunctionVisitor(BytecodeVisitor):
+    def __init__(self):
+      BytecodeVisitor.__init__(self)
+      self.opargs = []
+
+    def visit_call_function(self, oparg):
+      self.opargs.append(oparg)
+
+  class ReturnVisitor(CallFunctionVisitor):
+    def __init__(self):
+      CallFunctionVisitor.__init__(self)
+      self.returns = 0
+
+    def visit_return_value(self):
+      self.returns += 1
+
+  handlers = [h for h in CallFunctionVisitor.get_handlers() if h not in (None, MISSING_HANDLER)]
+  assert len(handlers) == 1
+  assert CallFunctionVisitor.get_handlers() is CallFunctionVisitor.get_handlers()
+  assert ReturnVisitor.get_handlers()[opcode.opmap['CALL_FUNCTION']] is not None
+  assert BytecodeVisitor.get_handlers()[opcode.opmap['CALL_FUNCTION']] is None
+
+  bytecode = get_bytecode(get_co(SIMPLE_PROGRAM))
+  visitor = ReturnVisitor()
+  for index, lineno, op, arg, cflow_in, _ in bytecode:
+    visitor.visit(index, op, arg=arg, lineno=lineno, cflow_in=cflow_in)
+
+  call_function = opcode.opmap['CALL_FUNCTION']
+  assert visitor.opargs == [tpl[3] for tpl in bytecode if tpl[2] == call_function]
+  assert visitor.returns == len([tpl for tpl in bytecode if tpl[2] == opcode.opmap['RETURN_VALUE']])
+
+  bytecode_object = BytecodeObject('<string>')
+  bytecode_object.parse_code(get_co(SIMPLE_PROGRAM))
+  accepted_visitor = ReturnVisitor()
+  bytecode_object.accept(accepted_visitor)
+  assert accepted_visitor.opargs == visitor.opargs
+  assert accepted_visitor.returns == visitor.returns
+
+
+def test_bytecode_visitor_callables():
+  import opcode
+  from equip import BytecodeVisitor
+
+  calls = []
+
+  class CallableVisitor(BytecodeVisitor):
+    def __init__(self):
+      BytecodeVisitor.__init__(self)
+
+    @staticmethod
+    def visit_call_function(oparg):
+      calls.append(('call_function', oparg))
+
+  def visit_return_value(visitor):
+    calls.append(('return_value', visitor))
+  CallableVisitor.visit_return_value = visit_return_value
+
+  visitor = CallableVisitor()
+  # Visitor method set on the instance
+  visitor.visit_load_global = lambda name: calls.append(('load_global', name))
+
+  bytecode_object = BytecodeObject('<string>')
+  bytecode_object.parse_code(get_co(SIMPLE_PROGRAM))
+  bytecode_object.accept(visitor)
+
+  bytecode = bytecode_object.get_bytecode()
+  expected_calls = len([t for t in bytecode if t[2] == opcode.opmap['CALL_FUNCTION']])
+  assert len([c for c in calls if c[0] == 'call_function']) == expected_calls > 0
+  assert ('return_value', visitor) in calls
+  assert [c[1] for c in calls if c[0] == 'load_global'] \
+      == [t[3] for t in bytecode if t[2] == opcode.opmap['LOAD_GLOBAL']]
+  assert BytecodeVisitor.get_handlers() is not CallableVisitor.get_handlers()
+  assert 'visit_load_global' not in CallableVisitor.__dict__
+
+
+class CountReturnsVisitor(BytecodeVisitor):
+  def __init__(self):
+    BytecodeVisitor.__init__(self)
+    self.returns = 0
+
+  def visit_return_value(self):
+    self.returns += 1
+
+
+def test_bytecode_visitor_bound_handlers():
+  import opcode
+  import pickle
+
+  visitor = CountReturnsVisitor()
+  state = pickle.dumps(visitor, 0)
+  handlers = visitor.get_instance_handlers()
+  assert visitor.get_instance_handlers() is handlers
+  assert handlers[opcode.opmap['RETURN_VALUE']] == visitor.visit_return_value
+  assert handlers[opcode.opmap['POP_TOP']] is None
+
+  # The bound methods are not part of the state of the visitor
+  visitor.visit(0, opcode.opmap['RETURN_VALUE'], lineno=1)
+  assert visitor.returns == 1
+  assert pickle.dumps(visitor, 0) != state
+  visitor.returns = 0
+  assert pickle.dumps(visitor, 0) == state
+  assert '_bound_handlers' not in pickle.loads(state).__dict__